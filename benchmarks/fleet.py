@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""
+Benchmark dyssh against a simulated fleet of hosts.
+
+Starts a stand-in SSH server for each host in this process (see the standin
+module), drives the real Connections class through each phase of a session,
+and writes the results as JSON, so that runs against different versions can
+be compared:
+
+    connect     connect_all() to every host
+    run         run_command_all() (once per --runs)
+    show        rendering :show for every host, and :show all
+    put         put_file_all() of a --file-size byte file
+    get         get_file_all() of the same file
+
+Each phase reports its wall time, the CPU time used, and percentiles of the
+per-host latencies within it. Note that the stand-in servers run in the same
+process, so their work is included in the CPU time and peak RSS.
+
+The host options take a comma-separated list of values, which are handed out
+to the hosts in turn: `--exitcodes 0,0,0,1` makes every fourth host fail.
+
+Example:
+
+    python benchmarks/fleet.py --hosts 100 --latency 0.002 --output 65536 \\
+        --output-file results.json
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'dyssh'))
+
+import paramiko
+
+import config
+import connections
+import dispatcher
+
+import standin
+
+
+PHASES = ('connect', 'run', 'show', 'put', 'get')
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentiles(samples):
+    """
+    Summarise a list of latencies, in seconds, by their nearest-rank
+    percentiles.
+    """
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    r = dict(('p%s' % p, samples[min(len(samples) - 1,
+        max(0, int(round(p / 100.0 * len(samples))) - 1))])
+        for p in PERCENTILES)
+    r['min'] = samples[0]
+    r['max'] = samples[-1]
+    r['mean'] = sum(samples) / len(samples)
+    r['count'] = len(samples)
+    return r
+
+
+def _cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _timed(fnc, samples):
+    """
+    Wrap <fnc> so that how long each call takes is added to <samples>.
+    """
+    def wrapper(*args, **kwargs):
+        started = time.time()
+        try:
+            return fnc(*args, **kwargs)
+        finally:
+            samples.append(time.time() - started)
+    return wrapper
+
+
+class Phase(object):
+    """
+    Measures one phase of the benchmark, used as a context manager.
+    """
+
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+        self.samples = []
+
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = _cpu()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.results[self.name] = {
+            'wall': time.time() - self.wall,
+            'cpu': _cpu() - self.cpu,
+            'latency': percentiles(self.samples),
+        }
+
+
+def _values(text, cast):
+    return [cast(v) for v in text.split(',')]
+
+
+def profiles(args):
+    """
+    The HostProfile of each host, as set by the command-line <args>.
+    """
+    values = itertools.izip(
+        itertools.cycle(_values(args.latency, float)),
+        itertools.cycle(_values(args.handshake, float)),
+        itertools.cycle(_values(args.output, int)),
+        itertools.cycle(_values(args.exitcodes, int)))
+    return [standin.HostProfile(*v) for v in itertools.islice(values,
+        args.hosts)]
+
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always',
+            '--dirty'], cwd = ROOT, stderr = open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """
+    Run the benchmark described by the command-line <args>, and return the
+    results as a dict.
+    """
+    config.config.update({
+        'auto_add_hosts': True,
+        'keepalive_interval': 0,
+        'connect_concurrency': args.connect_concurrency,
+        'transfer_concurrency': args.transfer_concurrency,
+        'execution_backend': args.backend,
+        'working_directory': None,
+    })
+    phases = {}
+    messages = {'info': 0, 'error': 0}
+
+    def count(kind):
+        def fnc(msg):
+            messages[kind] += 1
+            if args.verbose:
+                print >> sys.stderr, msg
+        return fnc
+
+    fleet = standin.Fleet(profiles(args))
+    scratch = tempfile.mkdtemp(prefix = 'dyssh-bench-local-')
+    try:
+        conns = connections.Connections(fleet.addresses(),
+            info_output = count('info'),
+            error_output = count('error'),
+            connect = False)
+        connections.set(conns)
+
+        if 'connect' in args.phases:
+            with Phase(phases, 'connect') as phase:
+                conns.connect = _timed(conns.connect, phase.samples)
+                conns.connect_all()
+                del conns.connect
+
+        if 'run' in args.phases:
+            with Phase(phases, 'run') as phase:
+                for i in range(args.runs):
+                    # The finish listeners have all been called by the time
+                    # run_command_all() returns, so each run's samples are
+                    # complete, and timed from its own start, once it does.
+                    started = time.time()
+                    listener = lambda host, history, started = started: \
+                        phase.samples.append(time.time() - started)
+                    conns.finish_listeners.append(listener)
+                    try:
+                        conns.run_command_all(args.command, None)
+                    finally:
+                        conns.finish_listeners.remove(listener)
+
+        if 'show' in args.phases:
+            with Phase(phases, 'show') as phase:
+                for host in conns.hosts:
+                    history = conns.get_history(host)
+                    if history:
+                        _timed(lambda: ''.join(dispatcher._show_lines(host,
+                            history[-1])), phase.samples)()
+                ''.join(dispatcher._aggregate_lines())
+
+        source = os.path.join(scratch, 'payload')
+        with open(source, 'wb') as f:
+            f.write(os.urandom(args.file_size))
+
+        if 'put' in args.phases:
+            with Phase(phases, 'put') as phase:
+                conns.put_file = _timed(conns.put_file, phase.samples)
+                conns.put_file_all(source, '/payload')
+                del conns.put_file
+
+        if 'get' in args.phases:
+            with Phase(phases, 'get') as phase:
+                conns.get_file = _timed(conns.get_file, phase.samples)
+                conns.get_file_all('/payload', os.path.join(scratch, 'copy'))
+                del conns.get_file
+
+        conns.disconnect_all()
+    finally:
+        fleet.close()
+        shutil.rmtree(scratch, ignore_errors = True)
+
+    return {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'paramiko': paramiko.__version__,
+        'parameters': dict((k, v) for k, v in vars(args).items()
+            if k not in ('output_file', 'verbose')),
+        'phases': phases,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'messages': messages,
+    }
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__,
+        formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hosts', type = int, default = 20,
+        help = 'Number of stand-in hosts.')
+    parser.add_argument('--latency', default = '0',
+        help = 'Seconds added to every packet each host sends.')
+    parser.add_argument('--handshake', default = '0',
+        help = 'Seconds each host spends authenticating.')
+    parser.add_argument('--output', default = '1024',
+        help = 'Bytes of output each host produces for a command.')
+    parser.add_argument('--exitcodes', default = '0',
+        help = 'Exit code each host returns for a command.')
+    parser.add_argument('--command', default = 'true',
+        help = 'The command to run (the stand-ins ignore it).')
+    parser.add_argument('--runs', type = int, default = 3,
+        help = 'How many times to run the command.')
+    parser.add_argument('--file-size', type = int, default = 1024 * 1024,
+        help = 'Size of the file copied by the put and get phases.')
+    parser.add_argument('--phases', default = ','.join(PHASES),
+        type = lambda s: s.split(','),
+        help = 'Comma-separated phases to run (default: all).')
+    parser.add_argument('--backend', default = 'thread',
+        help = 'Execution backend to run commands with.')
+    parser.add_argument('--connect-concurrency', type = int, default = 20)
+    parser.add_argument('--transfer-concurrency', type = int, default = 10)
+    parser.add_argument('--output-file',
+        help = 'Write the JSON results here instead of to stdout.')
+    parser.add_argument('--verbose', action = 'store_true',
+        help = "Print dyssh's messages to stderr.")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    text = json.dumps(results, indent = 2, sort_keys = True)
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print text
+    return os.EX_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,357 @@
+"""
+Stand-in SSH servers for benchmarking dyssh without a real fleet.
+
+A Fleet starts one paramiko server per simulated host, each listening on its
+own port on localhost, in the current process. The servers don't run
+anything: a command sent with a pseudo-terminal (as dyssh's jobs are) produces
+a set amount of output and exits with a set code, as given by the host's
+HostProfile. Each host also gets its own directory for SFTP, and answers
+`sha1sum <path>` so that dyssh can verify transfers.
+
+Latency is simulated by holding back every packet the server sends by the
+profile's latency, and a slow handshake by delaying authentication.
+"""
+
+import hashlib
+import os
+import pipes
+import shlex
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import paramiko
+
+
+# Size of the pieces simulated output is sent in.
+CHUNK_SIZE = 32768
+
+_key = []
+
+
+def server_key():
+    """
+    The host key shared by all stand-ins, generated on first use.
+    """
+    if not _key:
+        _key.append(paramiko.RSAKey.generate(2048))
+    return _key[0]
+
+
+class HostProfile(object):
+    """
+    How a simulated host behaves: <latency> seconds added to each packet it
+    sends, <handshake> seconds spent on authentication, and <output> bytes of
+    output before exiting with <exitcode> for every command.
+    """
+
+    def __init__(self, latency = 0, handshake = 0, output = 0, exitcode = 0):
+        self.latency = latency
+        self.handshake = handshake
+        self.output = output
+        self.exitcode = exitcode
+
+
+    def __repr__(self):
+        return 'HostProfile(latency = %r, handshake = %r, output = %r, ' \
+            'exitcode = %r)' % (self.latency, self.handshake, self.output,
+            self.exitcode)
+
+
+class _DelayedSocket(object):
+    """
+    Wraps a socket so that everything sent on it is held back for <delay>
+    seconds first.
+    """
+
+    def __init__(self, sock, delay):
+        self._sock = sock
+        self._delay = delay
+
+
+    def send(self, data):
+        time.sleep(self._delay)
+        return self._sock.send(data)
+
+
+    def sendall(self, data):
+        time.sleep(self._delay)
+        return self._sock.sendall(data)
+
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class _Server(paramiko.ServerInterface):
+    """
+    Accepts any password, and simulates commands as the host's profile says.
+    """
+
+    def __init__(self, host):
+        self.host = host
+
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+
+    def check_auth_password(self, username, password):
+        if self.host.profile.handshake:
+            time.sleep(self.host.profile.handshake)
+        return paramiko.AUTH_SUCCESSFUL
+
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+    def check_channel_pty_request(self, channel, *args):
+        channel.dyssh_pty = True
+        return True
+
+
+    def check_channel_exec_request(self, channel, command):
+        if getattr(channel, 'dyssh_pty', False):
+            target = self.host.job
+        else:
+            target = self.host.utility
+        t = threading.Thread(target = target, args = (channel, command))
+        t.daemon = True
+        t.start()
+        return True
+
+
+    def check_global_request(self, kind, msg):
+        return True
+
+
+class _SFTP(paramiko.SFTPServerInterface):
+    """
+    SFTP access to a host's directory. Remote paths are taken relative to it.
+    """
+
+    def __init__(self, server, *args, **kwargs):
+        self.root = server.host.root
+
+
+    def _path(self, path):
+        return os.path.join(self.root,
+            os.path.normpath('/' + path).lstrip('/'))
+
+
+    def _call(self, fnc, *args):
+        try:
+            fnc(*args)
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path)
+
+
+    def list_folder(self, path):
+        try:
+            names = os.listdir(self._path(path))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        out = []
+        for name in names:
+            attr = paramiko.SFTPAttributes.from_stat(
+                os.lstat(os.path.join(self._path(path), name)))
+            attr.filename = name
+            out.append(attr)
+        return out
+
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._path(path), flags, 0666)
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _Handle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+
+    def remove(self, path):
+        return self._call(os.remove, self._path(path))
+
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, self._path(oldpath), self._path(newpath))
+
+    posix_rename = rename
+
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, self._path(path))
+
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, self._path(path))
+
+
+    def chattr(self, path, attr):
+        if attr.st_mode is not None:
+            return self._call(os.chmod, self._path(path), attr.st_mode)
+        return paramiko.SFTP_OK
+
+
+class _Handle(paramiko.SFTPHandle):
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.fstat(self.readfile.fileno()))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+def _finish(channel):
+    """
+    End the output on <channel>. The channel is left for the client to close:
+    a command may finish before paramiko has acknowledged the request that
+    started it, and a channel closed before then looks to the client as if the
+    request failed.
+    """
+    try:
+        channel.shutdown_write()
+    except (EOFError, socket.error):
+        pass
+
+
+class StandInHost(object):
+    """
+    One simulated host, listening on a port of its own on localhost and
+    serving each connection in a thread of its own.
+    """
+
+    def __init__(self, profile, root):
+        self.profile = profile
+        self.root = root
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(128)
+        self.port = self.listener.getsockname()[1]
+        self.transports = []
+        t = threading.Thread(target = self._accept)
+        t.daemon = True
+        t.start()
+
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except socket.error:
+                return
+            if self.profile.latency:
+                sock = _DelayedSocket(sock, self.profile.latency)
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(server_key())
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _SFTP)
+            self.transports.append(transport)
+            try:
+                transport.start_server(server = _Server(self))
+            except (paramiko.SSHException, EOFError, socket.error):
+                pass
+
+
+    def job(self, channel, command):
+        """
+        Send the profile's output, then its exit code.
+        """
+        line = 'output from the stand-in on port %s\r\n' % self.port
+        chunk = (line * (CHUNK_SIZE // len(line) + 1))[:CHUNK_SIZE]
+        left = self.profile.output
+        try:
+            while left > 0:
+                channel.sendall(chunk[:left])
+                left -= CHUNK_SIZE
+            channel.send_exit_status(self.profile.exitcode)
+        finally:
+            _finish(channel)
+
+
+    def utility(self, channel, command):
+        """
+        Answer the commands dyssh runs for itself: `sha1sum <path>` gives the
+        digest of a file in the host's directory, and anything else fails as
+        if it wasn't installed.
+        """
+        status = 127
+        try:
+            args = shlex.split(command.split('2>')[0])
+            if len(args) == 2 and args[0] == 'sha1sum':
+                path = os.path.join(self.root,
+                    os.path.normpath('/' + args[1]).lstrip('/'))
+                digest = hashlib.sha1()
+                with open(path, 'rb') as f:
+                    for data in iter(lambda: f.read(1024 * 1024), ''):
+                        digest.update(data)
+                channel.sendall('%s  %s\n' % (digest.hexdigest(),
+                    pipes.quote(args[1])))
+                status = 0
+        except (ValueError, IOError, OSError):
+            status = 1
+        finally:
+            channel.send_exit_status(status)
+            _finish(channel)
+
+
+    def close(self):
+        self.listener.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class Fleet(object):
+    """
+    A stand-in host for each of <profiles>, each with a scratch directory
+    under <root> (a new temporary directory by default).
+    """
+
+    def __init__(self, profiles, root = None):
+        self.root = root or tempfile.mkdtemp(prefix = 'dyssh-bench-')
+        self.hosts = []
+        for i, profile in enumerate(profiles):
+            path = os.path.join(self.root, 'host%s' % i)
+            os.mkdir(path)
+            self.hosts.append(StandInHost(profile, path))
+
+
+    def addresses(self, username = 'bench', password = 'bench'):
+        """
+        The host list to hand to dyssh to reach the fleet.
+        """
+        return ['%s:%s@127.0.0.1:%s' % (username, password, h.port)
+            for h in self.hosts]
+
+
+    def close(self):
+        for host in self.hosts:
+            host.close()
+        shutil.rmtree(self.root, ignore_errors = True)
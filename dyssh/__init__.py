@@ -23,12 +23,18 @@ except ImportError:
     except ImportError:
         raise ImportError("Could not locate either the `optparse` or `argparse` modules.")
 
+import atexit
+import json
 import os
 import sys
 
 import config
 import connections
+import daemon
 import dispatcher
+import inventory
+import records
+import search
 
 from utils.terminal import error
 
@@ -42,7 +48,7 @@ ARGS = {
                 'dyssh to abort the connection attempt. Generally, this is NOT '
                 'something you want to do.',
         'action': 'store_true',
-        'default': False,
+        'default': None,
     },
     ('-c', '--command',): {
         'help': 'The command to run. If `--interactive` is specified, this '
@@ -53,12 +59,61 @@ ARGS = {
     ('-s','--hosts'): {
         'help': 'A comma-seperated list of hosts to connect to on startup.',
     },
+    ('--inventory',): {
+        'help': 'An inventory file of host groups and tags. Hosts can then be '
+                'given as @<group> or tag:<tag>, here, with --hosts, and at '
+                'the prompt.',
+    },
+    ('--stream',): {
+        'help': 'Print the output of every host as it arrives, each line '
+                'prefixed with the host name, instead of only collecting it '
+                'for :show.',
+        'action': 'store_true',
+        'default': None,
+    },
+    ('--aggregate',): {
+        'help': 'When the command has finished everywhere, print each '
+                'distinct output once along with the hosts that produced it.',
+        'action': 'store_true',
+        'default': None,
+    },
+    ('--format',): {
+        'help': 'In batch mode, print the results as "text" (the default) or '
+                'as JSON lines ("jsonl"): one record per host, printed as soon '
+                'as its command finishes.',
+        'choices': ('text', 'jsonl'),
+    },
+    ('--stats',): {
+        'help': 'When done, write how long each phase of connecting, '
+                'running commands and copying files took on each host to this '
+                'file as JSON ("-" for stdout).',
+    },
+    ('--no-pty',): {
+        'help': 'Run commands without a pseudo-terminal, keeping their '
+                'standard error apart and their output byte for byte.',
+        'action': 'store_false',
+        'dest': 'pty',
+        'default': None,
+    },
+    ('--control',): {
+        'help': 'Run commands through the control daemon, which keeps the '
+                'connections open between runs of dyssh. The daemon is '
+                'started if it is not already running.',
+        'action': 'store_true',
+        'default': None,
+    },
+    ('--daemon',): {
+        'help': 'Run the control daemon in the foreground, instead of '
+                'connecting to any hosts.',
+        'action': 'store_true',
+        'default': None,
+    },
     ('-i','--interactive'): {
         'help': 'Specify an interactive session. Otherwise, by default, if a '
                 'command is specified the program will exit automatically when'
                 ' it is complete.',
         'action': "store_true",
-        'default': True,
+        'default': None,
     },
 }
 
@@ -68,21 +123,83 @@ def main(command = None):
     execute after connecting to the hosts.
     """
 
+    if config.get('daemon'):
+        return daemon.main()
+
+    try:
+        hosts = list(inventory.expand(config.get('hosts') or []))
+    except (inventory.InventoryError, IOError, OSError), e:
+        error(text = 'Unable to load the inventory: %s' % e, lvl = 2)
+        return os.EX_DATAERR
+
     connection_info = lambda x: error(text = x)
     connection_error = lambda x: error(text = x, lvl = 2)
-    conns = connections.Connections(config.get('hosts'),
-        info_output = connection_info,
-        error_output = connection_error)
+    if config.get('control'):
+        # The daemon does the connecting.
+        conns = connections.Connections(hosts,
+            info_output = connection_info,
+            error_output = connection_error,
+            backend = 'daemon',
+            connect = False)
+    else:
+        conns = connections.Connections(hosts,
+            info_output = connection_info,
+            error_output = connection_error)
     connections.set(conns)
 
-    if config.get('interactive') or not command:
+    if config.get('grep_index'):
+        index = search.OutputIndex()
+        conns.output_listeners.append(index.feed)
+        conns.finish_listeners.append(index.end)
+        dispatcher.output_index = index
+
+    if config.get('history_db'):
+        try:
+            store = records.Store(os.path.expanduser(config.get('history_db')),
+                int(config.get('history_db_output_limit') or 0),
+                error_output = connection_error)
+        except records.StoreError, e:
+            error(text = 'Not keeping the history: %s' % e, lvl = 1)
+        else:
+            conns.finish_listeners.append(store.add)
+            # Rows still waiting are written on the way out, however that is.
+            atexit.register(store.close)
+            dispatcher.history_store = store
+
+    batch = command and not config.get('interactive')
+    # The records are all that's printed in the jsonl format.
+    jsonl = batch and config.get('format') == 'jsonl'
+    if config.get('stream') and not jsonl:
+        dispatcher.cmd_stream('on')
+
+    if not batch:
         exitcode = dispatcher.run_interactive(command)
     else:
-        exitcode = dispatcher.run(command)
+        exitcode = dispatcher.run(command, wait = True)
+
+    if config.get('stats'):
+        write_stats(conns, config.get('stats'))
 
     return exitcode
 
 
+def write_stats(conns, path):
+    """
+    Write the phase timings of <conns> to the file at <path>, or to stdout if
+    <path> is '-', as JSON.
+    """
+    text = json.dumps(conns.timings.as_dict(), indent = 2, sort_keys = True)
+    if path == '-':
+        print text
+        return
+    try:
+        with open(os.path.expanduser(path), 'w') as f:
+            f.write(text + '\n')
+    except IOError, e:
+        error(text = 'Unable to write the timings to %s: %s' % (path, e),
+            lvl = 2)
+
+
 if __name__ == '__main__':
 
     if 'argparse' in globals():
@@ -0,0 +1,291 @@
+"""
+A non-blocking interface to Connections, for programs that embed dyssh and
+can't afford to wait on a whole fleet.
+
+Every call on an AsyncConnections object returns straight away with a list of
+Future objects, one per host. The blocking paramiko work runs on a bounded
+pool of threads, and each Future resolves to a HostResult as soon as its host
+is done. Callers can block on a single Future, collect them all with gather(),
+consume them in the order they finish with as_completed(), or register a
+callback with Future.add_done_callback() to hand results over to an event loop
+of their own.
+
+    aconns = AsyncConnections(['web1', 'web2'])
+    gather(aconns.connect_all())
+    for result in as_completed(aconns.run_command_all('uptime')):
+        print result.host, result.exitcode, result.output.getvalue()
+"""
+
+import Queue
+import threading
+import time
+
+import connections
+
+from utils import pool
+
+
+class HostResult(object):
+    """
+    The outcome of one operation on one host. <ok> is False if the operation
+    failed, in which case <error> says why. Commands also carry their
+    <exitcode> and captured <output> (an output.OutputBuffer), their <stderr>
+    if it was kept apart (with the 'pty' option off), and <history> is the
+    entry they left in the host's command history.
+    """
+
+    def __init__(self, host, ok = True, error = None, exitcode = None,
+        output = None, history = None, stderr = None):
+        self.host = host
+        self.ok = ok
+        self.error = error
+        self.exitcode = exitcode
+        self.output = output
+        self.stderr = stderr
+        self.history = history
+
+
+    def __repr__(self):
+        if self.ok:
+            state = 'exitcode=%s' % self.exitcode
+        else:
+            state = 'error=%r' % (self.error,)
+        return '<HostResult %s %s>' % (self.host, state)
+
+
+class Future(object):
+    """
+    A HostResult that will be available at some point.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self._result = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+
+    def done(self):
+        return self._done.is_set()
+
+
+    def result(self, timeout = None):
+        """
+        Return the HostResult, waiting up to <timeout> seconds for it (forever
+        if <timeout> is None). Raises RuntimeError on timeout.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self._done.is_set():
+            # Waiting in slices keeps KeyboardInterrupt deliverable.
+            wait = pool.POLL_INTERVAL
+            if timeout is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    raise RuntimeError("Timed out waiting for %s" % self.host)
+            self._done.wait(wait)
+        return self._result
+
+
+    def add_done_callback(self, fnc):
+        """
+        Call fnc(<future>) once the result is available. If it already is,
+        <fnc> is called immediately; otherwise it is called from whichever
+        thread completes the Future.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fnc)
+                return
+        fnc(self)
+
+
+    def _set(self, result):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._result = result
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fnc in callbacks:
+            fnc(self)
+
+
+def gather(futures, timeout = None):
+    """
+    Wait for all of <futures> and return their HostResults, in the same order.
+    """
+    if timeout is not None:
+        deadline = time.time() + timeout
+    results = []
+    for f in futures:
+        if timeout is None:
+            results.append(f.result())
+        else:
+            results.append(f.result(max(0, deadline - time.time())))
+    return results
+
+
+def as_completed(futures, timeout = None):
+    """
+    Iterate over the HostResults of <futures> as they become available. Raises
+    RuntimeError if they haven't all arrived within <timeout> seconds.
+    """
+    futures = list(futures)
+    finished = Queue.Queue()
+    for f in futures:
+        f.add_done_callback(finished.put)
+    if timeout is not None:
+        deadline = time.time() + timeout
+    for i in range(len(futures)):
+        while True:
+            wait = pool.POLL_INTERVAL
+            if timeout is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    raise RuntimeError("Timed out waiting for results")
+            try:
+                f = finished.get(timeout = wait)
+                break
+            except Queue.Empty:
+                continue
+        yield f.result()
+
+
+class AsyncConnections(object):
+    """
+    Wraps a Connections object so that its fleet-wide operations don't block.
+    At most <workers> blocking calls (handshakes, channel setup, transfers) run
+    at once. Unlike Connections, nothing happens on creation; call connect_all()
+    to connect.
+    """
+
+    def __init__(self,
+        host_list,
+        info_output = lambda x: x,
+        error_output = lambda x: x,
+        debug_level = 0,
+        workers = 20
+    ):
+        self.conns = connections.Connections(host_list,
+            info_output = info_output,
+            error_output = error_output,
+            debug_level = debug_level,
+            backend = 'inline',
+            connect = False)
+        self.conns.finish_listeners.append(self._job_finished)
+        self.executor = pool.ThreadPool(workers)
+        self._lock = threading.Lock()
+        self._commands = {}
+
+
+    @property
+    def hosts(self):
+        return self.conns.hosts
+
+
+    def _submit(self, fnc, hosts, finish):
+        """
+        Run fnc(<host>) for each of <hosts> on the executor. finish(<future>,
+        <host>, <result>) turns a successful call into a HostResult; failed
+        calls resolve to a HostResult with ok = False.
+        """
+        futures = []
+        for host in hosts:
+            future = Future(host)
+            futures.append(future)
+
+            def done(host, r, exc_info, future = future):
+                if exc_info:
+                    future._set(HostResult(host, ok = False,
+                        error = exc_info[1]))
+                else:
+                    finish(future, host, r)
+
+            self.executor.submit(fnc, host, done)
+        return futures
+
+
+    def connect_all(self):
+        """
+        Connect to any hosts that are disconnected.
+        """
+        def finish(future, host, r):
+            hostinfo = self.conns.hconn.get(host, {})
+            future._set(HostResult(host,
+                ok = bool(hostinfo.get('connected')),
+                error = hostinfo.get('error')))
+
+        hosts = [h for h in self.conns.hosts
+            if not self.conns.hconn.get(h, {}).get('connected')]
+        return self._submit(self.conns.connect, hosts, finish)
+
+
+    def run_command_all(self, command):
+        """
+        Run <command> on each host. Each Future resolves when the command
+        finishes on its host.
+        """
+        def finish(future, host, history):
+            if history is None:
+                future._set(HostResult(host, ok = False,
+                    error = self.conns.hconn.get(host, {}).get('error')))
+                return
+            with self._lock:
+                if history['exitcode'] is None:
+                    self._commands[id(history)] = future
+                    return
+            future._set(self._command_result(host, history))
+
+        return self._submit(
+            lambda host: self.conns.run_command(host, command),
+            self.conns.hosts, finish)
+
+
+    def _command_result(self, host, history):
+        return HostResult(host,
+            exitcode = history['exitcode'],
+            output = history['output'],
+            stderr = history.get('stderr'),
+            history = history)
+
+
+    def _job_finished(self, host, history):
+        """
+        Called by the job engine as each command completes.
+        """
+        with self._lock:
+            future = self._commands.pop(id(history), None)
+        if future:
+            future._set(self._command_result(host, history))
+
+
+    def get_file_all(self, source, target):
+        """
+        Non-blocking Connections.get_file_all().
+        """
+        return self._submit(
+            lambda host: self.conns.get_file(source, target, host),
+            self.conns.hosts, lambda f, host, r: f._set(HostResult(host)))
+
+
+    def put_file_all(self, source, target):
+        """
+        Non-blocking Connections.put_file_all().
+        """
+        return self._submit(
+            lambda host: self.conns.put_file(source, target, host),
+            self.conns.hosts, lambda f, host, r: f._set(HostResult(host)))
+
+
+    def kill_all(self):
+        self.conns.kill_all()
+
+
+    def close(self):
+        """
+        Stop the executor threads and disconnect from every host.
+        """
+        self.executor.close()
+        self.conns.disconnect_all()
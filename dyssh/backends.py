@@ -0,0 +1,457 @@
+"""
+Execution backends. A backend decides where the work of starting a command on
+each host happens, and keeps track of the jobs it has started:
+
+    inline      Jobs are started one after another from the calling thread
+                and then run on the Connections object's job engine.
+    thread      As inline, but the jobs are started from a pool of threads
+                that is reused from one command to the next.
+    process     A pool of worker processes, each of which owns the
+                connections to its own shard of the hosts and runs its own job
+                engine. Output and exit codes are sent back to the parent
+                over a queue, so the parent's history stays complete. This
+                spreads the SSH crypto for very large fleets across all of the
+                machine's cores.
+    daemon      Jobs are handed to the control daemon (see the daemon
+                module), which keeps its connections open from one run of
+                dyssh to the next, and sends the output back in the same way.
+
+The backend is chosen with the 'execution_backend' config option.
+"""
+
+import signal
+import sys
+import threading
+import time
+import traceback
+import zlib
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+import config
+import records
+
+from utils import pool
+
+
+# Config options that can change during a session and affect how a command is
+# run. These are sent along with every job given to a worker process.
+JOB_SETTINGS = ('working_directory', 'envvars', 'envvar_format',
+    'persistent_shell', 'pty')
+
+
+def create(name, conns):
+    """
+    Return a new backend of type <name> for the Connections object <conns>.
+    """
+    backends = {
+        'inline': InlineBackend,
+        'thread': ThreadBackend,
+        'process': ProcessBackend,
+        'daemon': DaemonBackend,
+    }
+    if name == 'process' and multiprocessing is None:
+        conns._error("The multiprocessing module is unavailable; using the "
+            "thread execution backend instead")
+        name = 'thread'
+    if name not in backends:
+        conns._error("Unknown execution backend '%s'; using the thread "
+            "backend instead" % name)
+        name = 'thread'
+    return backends[name](conns)
+
+
+def _workers(default):
+    """
+    The pool size to use, from the 'backend_workers' config option.
+    """
+    try:
+        return int(config.get('backend_workers') or 0) or default
+    except ValueError:
+        return default
+
+
+class InlineBackend(object):
+    """
+    Start jobs from the calling thread, one host at a time.
+    """
+
+    # Jobs started by local backends can be taken over with Connections.join.
+    joinable = True
+    # Jobs run on the Connections object's own connections.
+    own_connections = False
+
+    def __init__(self, conns):
+        self.conns = conns
+
+
+    def _run(self, host, command):
+        self.conns._info("Starting job on %s" % host)
+        return self.conns.run_command(host, command)
+
+
+    def _start(self, hosts, command):
+        results = []
+        for host in hosts:
+            try:
+                results.append((host, self._run(host, command), None))
+            except Exception:
+                results.append((host, None, sys.exc_info()))
+        return results
+
+
+    def start(self, hosts, command):
+        """
+        Start <command> on each of <hosts>. Returns the hosts on which the job
+        was started.
+        """
+        started = []
+        for host, history, exc_info in self._start(hosts, command):
+            if exc_info:
+                self.conns._error("Unable to start job on %s: %s" % (host,
+                    exc_info[1]))
+            elif history:
+                started.append(host)
+        return started
+
+
+    def wait(self, hosts = None, timeout = None):
+        """
+        Wait for the jobs on <hosts> to finish, for at most <timeout> seconds.
+        Returns the hosts with jobs still running.
+        """
+        return self.conns.engine.wait(hosts, timeout)
+
+
+    def running(self):
+        """
+        Return the hosts with jobs still running.
+        """
+        return self.conns.engine.running()
+
+
+    def kill(self, host):
+        """
+        Order the job on <host> to stop. Returns False if there is no such job.
+        """
+        return self.conns.engine.kill(host)
+
+
+    def close(self):
+        """
+        Release any resources held by the backend.
+        """
+        pass
+
+
+class ThreadBackend(InlineBackend):
+    """
+    Start jobs from a persistent pool of threads.
+    """
+
+    def __init__(self, conns):
+        InlineBackend.__init__(self, conns)
+        self.pool = pool.ThreadPool(_workers(20))
+
+
+    def _start(self, hosts, command):
+        return self.pool.map(lambda host: self._run(host, command), hosts)
+
+
+    def close(self):
+        self.pool.close()
+
+
+class ProcessBackend(object):
+    """
+    Run jobs in a pool of worker processes. Hosts are sharded across the
+    workers by a hash of the host name, so each host's connection always lives
+    in the same worker. Workers are started as soon as the backend is created,
+    before the parent has opened any connections of its own, and are reused
+    for every command after that.
+    """
+
+    joinable = False
+    # The workers connect to the hosts they run jobs on themselves; the
+    # parent's connections are only opened when needed, for transfers.
+    own_connections = True
+
+    def __init__(self, conns):
+        self.conns = conns
+        # seq -> (host, history) for every job the workers are still running.
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.seq = 0
+        self.workers = []
+        self.results = self._results()
+        self._spawn()
+        self.collector = threading.Thread(target = self._collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+
+    def _results(self):
+        """
+        Return the queue the workers send their messages back on.
+        """
+        return multiprocessing.Queue()
+
+
+    def _spawn(self):
+        for i in range(_workers(multiprocessing.cpu_count())):
+            orders = multiprocessing.Queue()
+            p = multiprocessing.Process(target = _worker_main,
+                args = (orders, self.results))
+            p.daemon = True
+            p.start()
+            self.workers.append((p, orders))
+
+
+    def _orders(self, host):
+        """
+        The order queue of the worker that owns <host>.
+        """
+        idx = (zlib.crc32(host) & 0xffffffff) % len(self.workers)
+        return self.workers[idx][1]
+
+
+    def start(self, hosts, command):
+        if not self.workers:
+            self._spawn()
+        settings = dict((k, config.get(k)) for k in JOB_SETTINGS)
+        started = []
+        for host in hosts:
+            history = records.Record(command,
+                self.conns.output_store.buffer())
+            if not settings.get('pty', True):
+                history['stderr'] = self.conns.output_store.buffer()
+            with self.lock:
+                self.seq += 1
+                seq = self.seq
+                self.jobs[seq] = (host, history)
+            self.conns._remember(host, history)
+            self.conns._info("Starting job on %s" % host)
+            self._orders(host).put(('run', host, seq, command, settings))
+            started.append(host)
+        return started
+
+
+    def _collect(self):
+        """
+        Apply the messages sent back by the workers to the parent's history.
+        """
+        while True:
+            try:
+                msg = self.results.get()
+            except (EOFError, IOError):
+                self._lost()
+                return
+            kind = msg[0]
+            if kind == 'info':
+                self.conns._info(msg[1])
+                continue
+            elif kind == 'error':
+                self.conns._error(msg[1])
+                continue
+            elif kind == 'timing':
+                self.conns.timings.record(*msg[1:])
+                continue
+            host, seq = msg[1:3]
+            if kind == 'done':
+                self._done(host, seq, msg[3])
+                continue
+            with self.lock:
+                if seq not in self.jobs:
+                    continue
+                history = self.jobs[seq][1]
+                if kind == 'output':
+                    history['output'].write(msg[3])
+                elif kind == 'stderr':
+                    history['stderr'].write(msg[3])
+                elif kind == 'failed':
+                    # The worker couldn't reach the host; as with the local
+                    # backends, that leaves no history behind.
+                    hist = self.conns.hconn.get(host, {}).get('history', [])
+                    if history in hist:
+                        hist.remove(history)
+                    del self.jobs[seq]
+                self.changed.notify_all()
+            if kind in ('output', 'stderr'):
+                self.conns._job_output(host, history, msg[3])
+
+
+    def _done(self, host, seq, exitcode):
+        """
+        Record that job <seq> on <host> has finished with <exitcode>. As in the
+        job engine, the finish listeners hear about it before wait() does.
+        """
+        with self.lock:
+            if seq not in self.jobs:
+                return
+            history = self.jobs[seq][1]
+            history['exitcode'] = exitcode
+        try:
+            self.conns._job_finished(host, history)
+        finally:
+            with self.lock:
+                self.jobs.pop(seq, None)
+                self.changed.notify_all()
+
+
+    def _lost(self):
+        """
+        Give up on every job still running, once the workers can no longer be
+        heard from.
+        """
+        with self.lock:
+            for host, history in self.jobs.values():
+                self.conns._error("Lost contact with the job on %s" % host)
+            self.jobs.clear()
+            self.changed.notify_all()
+
+
+    def wait(self, hosts = None, timeout = None):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.lock:
+            while True:
+                running = dict.fromkeys(h for h, _ in self.jobs.values())
+                if hosts is None:
+                    pending = running.keys()
+                else:
+                    pending = [h for h in hosts if h in running]
+                if not pending:
+                    return []
+                if timeout is None:
+                    self.changed.wait(pool.POLL_INTERVAL)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return pending
+                    self.changed.wait(remaining)
+
+
+    def running(self):
+        with self.lock:
+            return dict.fromkeys(h for h, _ in self.jobs.values()).keys()
+
+
+    def kill(self, host):
+        if host not in self.running():
+            return False
+        self._orders(host).put(('kill', host))
+        return True
+
+
+    def close(self):
+        for p, orders in self.workers:
+            orders.put(('quit',))
+        for p, orders in self.workers:
+            p.join(1)
+        self.workers = []
+
+
+class DaemonBackend(ProcessBackend):
+    """
+    Run jobs on the control daemon, starting it first if it isn't running.
+    The daemon is treated as a single worker that owns every host.
+    """
+
+    def _results(self):
+        import daemon
+        daemon.start()
+        return daemon.connect()
+
+
+    def _spawn(self):
+        self.workers = [(None, self.results)]
+
+
+    def close(self):
+        # The daemon carries on, with the connections kept open for next time.
+        self.results.close()
+        self.workers = []
+
+
+class _ResultWriter(object):
+    """
+    File-like object used by worker processes as a job's output buffer, which
+    passes everything written to it straight back to the parent, as <kind>
+    ('output' or 'stderr') messages.
+    """
+
+    def __init__(self, results, host, seq, kind = 'output'):
+        self.results = results
+        self.host = host
+        self.seq = seq
+        self.kind = kind
+
+
+    def write(self, data):
+        if data:
+            self.results.put((self.kind, self.host, self.seq, data))
+
+
+    def iterchunks(self):
+        return iter(())
+
+
+    def close(self):
+        pass
+
+
+def _finished(host, history):
+    """
+    Finish listener that reports the exit code of a job run for another
+    process.
+    """
+    out = history['output']
+    if isinstance(out, _ResultWriter):
+        out.results.put(('done', host, out.seq, history['exitcode']))
+
+
+def _worker_main(orders, results):
+    """
+    Main loop of a worker process started by ProcessBackend.
+    """
+    import connections
+
+    # Ctrl-C at the prompt is for the parent; the workers shut down when the
+    # parent tells them to, or when it exits.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    conns = connections.Connections([],
+        info_output = lambda x: results.put(('info', x)),
+        error_output = lambda x: results.put(('error', x)),
+        backend = 'inline')
+    conns.finish_listeners.append(_finished)
+    conns.timings.listener = lambda *timing: results.put(('timing',) + timing)
+
+    while True:
+        order = orders.get()
+        kind = order[0]
+        if kind == 'quit':
+            break
+        elif kind == 'kill':
+            conns.kill(order[1])
+        elif kind == 'run':
+            host, seq, command, settings = order[1:]
+            try:
+                if host not in conns.hosts:
+                    conns.add(host)
+                history = conns.run_command(host, command,
+                    out = _ResultWriter(results, host, seq),
+                    err = _ResultWriter(results, host, seq, 'stderr'),
+                    settings = settings)
+            except Exception:
+                results.put(('error', "Unable to start job on %s: %s" % (host,
+                    traceback.format_exc().strip().split('\n')[-1])))
+                history = None
+            if history is None:
+                results.put(('failed', host, seq))
+
+    conns.disconnect_all()
@@ -21,13 +21,38 @@ config = {
     'prompt': '%(remote_wd)s $',
 
     'default_hosts': [],
+    'inventory': None, # file of host groups and tags; see the inventory module
+    'inventory_cache': '~/.dyssh-inventory-cache',
     'auto_add_hosts': False,
     'write_all_logs': False,
+    'stream': False, # print output from every host as it arrives
+    'aggregate': False, # in batch mode, print each distinct output once
+    'aggregate_diff_limit': 1024 * 1024, # largest output to diff, in bytes
+    # In batch mode, print the results as 'text' or as JSON lines ('jsonl').
+    # See output.JSONLinesWriter.
+    'format': 'text',
+    'jsonl_inline_limit': 65536, # largest output to put in a record, in bytes
+    'jsonl_output_dir': 'dyssh-output', # where bigger outputs are written
 
     'username': None,
     'password': None,
     'port': 22,
 
+    'connect_concurrency': 20, # simultaneous SSH handshakes in connect_all()
+    'connect_timeout': 10, # seconds allowed for each host's handshake
+    'lazy_connect': False, # connect to each host when it is first used
+    'max_open_connections': 0, # close the least recently used beyond this
+    'dns_ttl': 300, # seconds to keep resolved addresses for
+    'dns_negative_ttl': 30, # seconds to remember names that don't exist
+
+    # Background health checks; see the health module. An interval of 0 turns
+    # them off.
+    'keepalive_interval': 30,
+    'keepalive_timeout': 10,
+    'keepalive_count_max': 3,
+    'reconnect_backoff': 1,
+    'reconnect_backoff_max': 300,
+
 #    'send_interrupts': False,
 
 #    'copy_prefix': '%(hostname)s-',
@@ -35,21 +60,71 @@ config = {
 #    'log_file': '%(hostname)s/dyssh-%(hostname)s-%(timestamp)s.log',
 #    'log_path': './',
 
+    # Run the commands on each host in one long-lived shell; see the shell
+    # module.
+    'persistent_shell': False,
+
+    # Run commands on a pseudo-terminal. Without one, standard error is kept
+    # apart from the output, and both are kept byte for byte.
+    'pty': True,
+
+    # Where jobs are started from: 'inline', 'thread', 'process' or 'daemon'.
+    # See the backends module.
+    'execution_backend': 'thread',
+    'backend_workers': 0, # pool size; 0 picks a default for the backend
+
+    # Run commands through a control daemon that keeps the connections open
+    # between runs of dyssh, closing those idle for 'control_persist' seconds.
+    # See the daemon module.
+    'control': False,
+    'control_path': '~/.dyssh-control',
+    'control_persist': 600,
+
+    # Bytes of command output to keep in memory for each command, and for all
+    # of them together. Output beyond either limit is moved to a temporary file
+    # in 'output_spill_dir' (default: the system temporary directory).
+    'output_buffer_limit': 1024 * 1024,
+    'output_memory_limit': 64 * 1024 * 1024,
+    'output_spill_dir': None,
+
+    # Commands to keep in the history of each host (0 for no limit), and a
+    # SQLite database to keep the history of every command in, with the first
+    # 'history_db_output_limit' bytes of output. See the records module.
+    'history_limit': 100,
+    'history_db': None,
+    'history_db_output_limit': 65536,
+    # Index the words in command output as it arrives, for :grep.
+    'grep_index': True,
+
     'pager': 'less -r',
     'job_timeout': .1, # seconds to wait for jobs to complete in interactive mode
 
     # Runtime options
     'interactive': False,
     'hosts': [],
+    'stats': None, # file to write the phase timings to as JSON at the end
 
     'working_directory': '~',
 
     'envvars': {},
     'envvar_format': """_dyssh='%(key)s'\ndeclare "$_dyssh=%(value)s"\n""",
     'get_path_format': '%(path)s/%(host)s.%(filename)s',
+    'transfer_concurrency': 10, # hosts to copy files to/from at once
+    'transfer_retries': 3, # reconnect and resume this often per transfer
+    'sync_delta_threshold': 128 * 1024, # smaller files are synced whole
+    # Relay :put through the hosts themselves once there are more hosts than
+    # this; 0 to always upload from here.
+    'relay_fanout': 0,
+    'relay_command': 'scp -q -o BatchMode=yes -P %(port)s %(source)s '
+        '%(user)s@%(hostname)s:%(target)s',
+    'relay_forward_agent': False,
 }
 
 
+# Options that are switched on or off.
+BOOLEANS = [k for k, v in config.items() if isinstance(v, bool)]
+
+
 def update(args):
     """
     Update the program configuration. *args should be a list of command-line
@@ -72,9 +147,9 @@ def update(args):
 
         elif arg in config.keys():
 
-            overrides[arg] = v
             if arg == 'hosts' and v:
-                config[arg] = [i.strip() for i in v.split(',')]
+                v = [i.strip() for i in v.split(',')]
+                config[arg] = v
             elif arg in ['config', 'histfile'] and v:
                 # Expand '~' as necessary:
                 val = val.strip()
@@ -82,6 +157,10 @@ def update(args):
                 config[argkey] = val
             elif arg in ['envvars'] and v:
                 config[arg] = val
+            # Options left off the command line are None (the flags default
+            # to None too), and leave the configuration file's value alone.
+            if v is not None:
+                overrides[arg] = v
                 
         elif v:
             
@@ -94,14 +173,22 @@ def update(args):
         loaded_confs = ConfigParser.ConfigParser()
         loaded_confs.readfp(conffile)
         for section in loaded_confs.sections():
-            config.update(loaded_confs.items(section))
-
-        config.update(overrides)
+            # Raw, because the format options use the same %(name)s syntax as
+            # ConfigParser's interpolation.
+            config.update(loaded_confs.items(section, raw = True))
 
     except (TypeError, IOError, OSError):
         warn('Unable to open configuration file: %s' % config.get('config'))
 
+    # Command-line arguments win over the configuration file, whether or not
+    # there was one.
+    config.update(overrides)
+
     for k, v in config.items():
+        # Configuration file values are strings; turn them back into booleans
+        # where the default is one.
+        if k in BOOLEANS and isinstance(v, basestring):
+            config[k] = v.strip().lower() in ('1', 'yes', 'true', 'on')
         # Parse the envvars conf into a dict
         if k == 'envvars' and isinstance(v, basestring):
             envvars = {}
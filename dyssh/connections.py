@@ -7,44 +7,204 @@ other modules can reference that instance.
 
 # TODO: detect wait for data from stdin and create interface for that.
 
-import datetime
+import collections
+import contextlib
 import os
 import paramiko
+import paramiko.agent
+import pipes
 import select
 import socket
-import StringIO
 import sys
 import termios
+import threading
 import time
 import tty
 
-try:
-    import multiprocessing
-    Process = multiprocessing.Process
-except:
-    import threading
-    Process = threading.Thread
-
+import backends
 import config
+import health
+import jobs
+import output
+import records
+import registry
+import relay
+import resolver
+import shell
+import sync
+import timings
+import transfer
+
+from utils import pool
 
 class Connections(object):
     """
     Class for managing the connections to all hosts through a single interface.
+    Unless <connect> is False, connects to every host in <host_list> straight
+    away.
+
+    With the 'lazy_connect' or 'max_open_connections' config options set,
+    hosts are only connected to when they are first used instead. At most
+    'max_open_connections' connections are then kept open at once: when
+    another is needed, the least recently used idle connection is closed, and
+    it is opened again the next time that host is used.
+
+    Hosts are connected to lazily, too, when the execution backend runs jobs
+    on connections of its own (in worker processes, or in the daemon).
     """
 
     def __init__(self,
         host_list,
         info_output = lambda x: x,
         error_output = lambda x: x,
-        debug_level = 0
+        debug_level = 0,
+        backend = None,
+        connect = True
     ):
-        self.hosts = host_list
+        self.hosts = registry.HostRegistry(host_list)
         self.hconn = {}
         self.info_output = info_output
         self.error_output = error_output
         self.debug = debug_level
-        self.connect_all()
-        self.killorders = {}
+        # The hosts holding an open connection, least recently used first, and
+        # the number of transfers using each host's connection.
+        self.max_open = int(config.get('max_open_connections') or 0)
+        self.open = collections.OrderedDict()
+        self.leases = {}
+        # Reentrant, so that a connection can be closed (which takes it) while
+        # making room for another.
+        self.open_lock = threading.RLock()
+        # Functions called as fnc(<host>, <history>, <data>) whenever a job
+        # produces output, and fnc(<host>, <history>) when it finishes.
+        self.output_listeners = []
+        self.finish_listeners = []
+        self.engine = jobs.JobEngine(on_output = self._job_output,
+            on_finish = self._job_finished,
+            on_error = lambda msg: self._error(msg))
+        self.output_store = output.OutputStore(
+            int(config.get('output_buffer_limit') or 0) or None,
+            int(config.get('output_memory_limit') or 0) or None,
+            config.get('output_spill_dir') or None)
+        # Created before connecting, so that a process backend forks its
+        # workers while there are no transports to inherit.
+        self.backend = backends.create(
+            backend or config.get('execution_backend'), self)
+        self.timings = timings.Timings()
+        self.resolver = resolver.Resolver(
+            float(config.get('dns_ttl') or 0),
+            float(config.get('dns_negative_ttl') or 0),
+            config.get('connect_concurrency'))
+        self.monitor = None
+        if float(config.get('keepalive_interval') or 0):
+            self.monitor = health.HealthMonitor(self)
+        if connect and not self._lazy():
+            self.connect_all()
+
+
+    def _lazy(self):
+        """
+        Whether hosts are only connected to when first used, rather than as
+        soon as they are added.
+        """
+        return bool(config.get('lazy_connect') or self.max_open or
+            self.backend.own_connections)
+
+
+    def _touch(self, host):
+        """
+        Mark the connection to <host> as the most recently used.
+        """
+        with self.open_lock:
+            if host in self.open:
+                del self.open[host]
+                self.open[host] = None
+
+
+    def _make_room(self, host):
+        """
+        Reserve one of the 'max_open_connections' slots for a new connection
+        to <host>, closing the least recently used idle connection if they are
+        all taken. If every open connection is busy, waits for one to become
+        idle.
+        """
+        while True:
+            with self.open_lock:
+                if host in self.open or not self.max_open or \
+                        len(self.open) < self.max_open:
+                    self.open[host] = None
+                    return
+                busy = dict.fromkeys(self.engine.running())
+                busy.update(self.leases)
+                victim = None
+                for h in self.open:
+                    if h not in busy:
+                        victim = h
+                        break
+                if victim:
+                    # Closed before letting go of the lock, so that no one
+                    # can start using it again halfway through.
+                    self._close(victim)
+                    health.mark(self.hconn[victim], None)
+            if victim:
+                self._info('Closed idle connection to %s' % victim)
+            else:
+                time.sleep(pool.POLL_INTERVAL)
+
+
+    @contextlib.contextmanager
+    def _leased(self, host):
+        """
+        Keep the connection to <host> from being closed to make room for
+        another while it is in use.
+        """
+        with self.open_lock:
+            self.leases[host] = self.leases.get(host, 0) + 1
+        try:
+            yield
+        finally:
+            with self.open_lock:
+                self.leases[host] -= 1
+                if not self.leases[host]:
+                    del self.leases[host]
+
+
+    def _close(self, host):
+        """
+        Close the connection to <host>, if it has one, without a word.
+        """
+        with self.open_lock:
+            self.open.pop(host, None)
+            hostinfo = self.hconn.get(host, {})
+            sh = hostinfo.pop('shell', None)
+            if sh:
+                sh.close()
+            sftp = hostinfo.pop('sftp', None)
+            if sftp:
+                sftp.close()
+            client = hostinfo.get('client')
+            if client:
+                client.close()
+            hostinfo['connected'] = False
+
+
+    def _address(self, host):
+        """
+        Return the (<username>, <password>, <hostname>, <port>) to connect to
+        <host> with.
+        """
+        username = config.get('username')
+        password = config.get('password')
+        # If the hostname has been specified with non-default connection
+        # details, use those.
+        if '@' in host:
+            user_spec, _, host_spec = host.partition('@')
+        else:
+            user_spec = ''
+            host_spec = host
+        if user_spec:
+            username, _, password = user_spec.partition(':')
+        hostname, _, port = host_spec.partition(':')
+        return username, password, hostname, int(port or config.get('port'))
 
 
     def _error(self, msg, lvl = -10):
@@ -71,10 +231,7 @@ class Connections(object):
             if host_name_or_number in self.hosts:
                 return host_name_or_number
             else:
-                possibles = []
-                for h in self.hosts:
-                    if host_name_or_number in h:
-                        possibles.append(h)
+                possibles = self.hosts.search(host_name_or_number)
                 if len(possibles) > 1:
                     self._info("Host name is ambiguous")
                 elif len(possibles) == 1:
@@ -89,6 +246,37 @@ class Connections(object):
             self.info_output(msg)
 
 
+    def _job_output(self, host, history, data):
+        """
+        Pass output from a running job on to the output listeners.
+        """
+        times = history.get('timings')
+        if times is not None and 'first_byte' not in times:
+            times['first_byte'] = time.time() - history['started']
+            self.timings.record(host, 'first_byte', times['first_byte'])
+        for fnc in self.output_listeners:
+            try:
+                fnc(host, history, data)
+            except Exception, e:
+                self._error("Output listener failed on %s: %s" % (host, e))
+
+
+    def _job_finished(self, host, history):
+        """
+        Tell the finish listeners that a job has completed.
+        """
+        history.release()
+        times = history.get('timings')
+        if times is not None:
+            times['command'] = time.time() - history['started']
+            self.timings.record(host, 'command', times['command'])
+        for fnc in self.finish_listeners:
+            try:
+                fnc(host, history)
+            except Exception, e:
+                self._error("Finish listener failed on %s: %s" % (host, e))
+
+
     def add(self, host):
         """
         Add <host> to the list of managed hosts. <host> may be either the host
@@ -96,17 +284,35 @@ class Connections(object):
         """
         if not host in self.hosts:
             self.hosts.append(host)
-            self.connect(host)
+            if not self._lazy():
+                self.connect(host)
         else:
             self._info('%s already in host list' % host)
 
 
+    def add_all(self, hosts):
+        """
+        Add each of <hosts> that isn't already managed, and connect to them
+        all at once (unless connections are made lazily).
+        """
+        added = 0
+        for host in hosts:
+            if host not in self.hosts:
+                self.hosts.append(host)
+                added += 1
+        self._info('Added %s host(s)' % added)
+        if added and not self._lazy():
+            self.connect_all()
+
+
     def clear_history(self, h):
         """
         Clear the command history of <host>.
         """
         host = self._gethost(h)
         if host:
+            for history in self.hconn[host].get('history', []):
+                history.close()
             self.hconn[host]['history'] = []
         else:
             self._info("No such host in list: %s" % h)
@@ -142,6 +348,7 @@ class Connections(object):
             else:
                 host_policy = paramiko.RejectPolicy
 
+            self._make_room(host)
             client = paramiko.SSHClient()
             client.set_missing_host_key_policy(host_policy())
 
@@ -151,26 +358,32 @@ class Connections(object):
 
                 client.load_system_host_keys()
 
-                username = config.get('username')
-                password = config.get('password')
-                # If the hostname has been specified with non-default
-                # connection details, use those.
-                if '@' in host:
-                    user_spec, _, host_spec = host.partition('@')
-                else:
-                    user_spec = ''
-                    host_spec = host
-                if user_spec:
-                    username, _, password = user_spec.partition(':')
-                hostname, _, port = host_spec.partition(':')
+                username, password, hostname, port = self._address(host)
+                timeout = float(config.get('connect_timeout') or 0) or None
+                addresses = self.resolver.resolve(hostname, port)
+                self.timings.record(host, 'dns',
+                    self.resolver.durations.get((hostname, port), 0))
+                started = time.time()
+                sock = resolver.open_socket(addresses, timeout)
+                self.timings.record(host, 'tcp', time.time() - started)
+                started = time.time()
                 client.connect(
                     hostname,
-                    port or config.get('port'),
+                    port,
                     username,
                     password,
+                    timeout = timeout,
+                    sock = sock,
                 )
+                self.timings.record(host, 'handshake', time.time() - started)
                 connected = True
                 e = None
+                health.mark(self.hconn[host], health.HEALTHY)
+                self.hconn[host].update({
+                    'failures': 0,
+                    'last_checked': time.time(),
+                    'last_seen': time.time(),
+                })
 
             # Covers SSH connection issues, failed loading of host keys, or bad
             # hostnames
@@ -179,20 +392,71 @@ class Connections(object):
                 # connect to the rest of the hosts.
                 self._error("Connecting to host %s failed: %s" % (host, e))
                 connected = False
+                health.mark(self.hconn[host], health.DEAD)
+                with self.open_lock:
+                    self.open.pop(host, None)
 
             self.hconn[host].update({
                 'client': client,
                 'connected': connected,
-                'error': e
+                'error': e,
+                'sftp': None,
             })
 
 
     def connect_all(self):
         """
-        Connect to any hosts that are disconnected.
+        Connect to any hosts that are disconnected. Handshakes run in parallel,
+        at most 'connect_concurrency' at a time, and progress is reported as
+        each one finishes.
         """
-        for host in self.hosts:
-            self.connect(host)
+        hosts = [h for h in self.hosts
+            if not self.hconn.get(h, {}).get('connected')]
+        if not hosts:
+            return
+
+        # Look up all the names first, so that a slow resolver doesn't hold
+        # up each handshake in turn, and so that bad names show up at once.
+        unresolved = self.resolver.resolve_all(
+            self._address(h)[2:] for h in hosts)
+        resolved = []
+        for host in hosts:
+            e = unresolved.get(self._address(host)[2:])
+            if e:
+                self._error("Unable to resolve %s: %s" % (host, e))
+                hostinfo = self.hconn.setdefault(host, {})
+                hostinfo.update({'connected': False, 'error': e})
+                health.mark(hostinfo, health.DEAD)
+            else:
+                resolved.append(host)
+        progress = {'done': 0, 'failed': len(hosts) - len(resolved)}
+
+        def finished(host, result, exc_info):
+            progress['done'] += 1
+            if exc_info:
+                # connect() handles the expected failures itself; this is
+                # anything else that escaped from paramiko.
+                e = exc_info[1]
+                self._error("Connecting to host %s failed: %s" % (host, e))
+                self.hconn.setdefault(host, {}).update({
+                    'connected': False,
+                    'error': e,
+                })
+            if not self.hconn.get(host, {}).get('connected'):
+                progress['failed'] += 1
+                state = 'failed'
+            else:
+                state = 'connected'
+            self._info('[%s/%s] %s %s' % (progress['done'], len(resolved),
+                host, state))
+
+        pool.map_concurrent(self.connect, resolved,
+            concurrency = config.get('connect_concurrency'),
+            callback = finished)
+
+        if progress['failed']:
+            self._error('%s of %s connections failed' % (progress['failed'],
+                len(hosts)))
 
 
     def disconnect(self, host):
@@ -205,30 +469,173 @@ class Connections(object):
         hostinfo = self.hconn.get(host, {})
 
         if hostinfo.get('connected'):
-
-            client = hostinfo.get('client')
-            client.close()
+            self._close(host)
+            health.mark(hostinfo, None)
             self._info('Connection to host %s closed.' % host)
+        else:
+            with self.open_lock:
+                self.open.pop(host, None)
 
 
     def disconnect_all(self):
         """
-        Disconnect from any hosts that are connected.
+        Disconnect from any hosts that are connected, including any connections
+        held by the execution backend.
         """
+        if self.monitor:
+            self.monitor.stop()
         for host in self.hosts:
             self.disconnect(host)
+        self.backend.close()
 
 
-    def get_file(self, source, target, h):
+    def _alive(self, host):
+        """
+        Whether the connection to <host> is open, as far as can be told without
+        going over the network. The health monitor keeps track of whether the
+        other end is still there.
+        """
+        hostinfo = self.hconn.get(host, {})
+        if not hostinfo.get('connected'):
+            return False
+        transport = hostinfo['client'].get_transport()
+        if transport is None or not transport.is_active():
+            hostinfo['connected'] = False
+            return False
+        return True
+
+
+    def _client(self, host):
+        """
+        Return the paramiko SSHClient for <host>, connecting first if need be.
+        """
+        if not self._alive(host):
+            self.connect(host)
+            if not self.hconn[host].get('connected'):
+                raise IOError('Unable to connect to %s' % host)
+        self._touch(host)
+        return self.hconn[host]['client']
+
+
+    def _sftp(self, host):
+        """
+        Return an SFTP session to <host>. Sessions are opened on first use and
+        kept for as long as the connection lasts, so that repeated transfers
+        don't each pay for setting one up.
+        """
+        client = self._client(host)
+        hostinfo = self.hconn[host]
+        sftp = hostinfo.get('sftp')
+        if sftp is None or sftp.sock.closed:
+            started = time.time()
+            sftp = hostinfo['sftp'] = client.open_sftp()
+            self.timings.record(host, 'sftp', time.time() - started)
+        return sftp
+
+
+    def _exec(self, host, command, forward_agent = False):
+        """
+        Run <command> on <host> outside of the job engine, and return its exit
+        status and output (stdout and stderr together). If <forward_agent> is
+        True, the command may use the local SSH agent to log in elsewhere.
+        """
+        chan = self._client(host).get_transport().open_session()
+        try:
+            if forward_agent:
+                paramiko.agent.AgentRequestHandler(chan)
+            chan.set_combine_stderr(True)
+            chan.exec_command(command)
+            out = chan.makefile('rb').read()
+            return chan.recv_exit_status(), out
+        finally:
+            chan.close()
+
+
+    def _remote_sha1(self, host, path):
+        """
+        Return the SHA-1 hex digest of the file at <path> on <host>, or None if
+        the host has no way of working it out.
+        """
+        path = pipes.quote(path)
+        status, out = self._exec(host,
+            'sha1sum %s 2>/dev/null || shasum -a 1 %s 2>/dev/null' % (path,
+            path))
+        if status != 0 or not out.strip():
+            return None
+        return out.split()[0].lower()
+
+
+    def _with_retries(self, host, phase, fnc):
+        """
+        Call fnc(), reconnecting to <host> and calling it again if the
+        connection drops, up to 'transfer_retries' times. Transfers pick up
+        where they left off, so a retry only moves what is still missing. If
+        it succeeds, the whole time taken is recorded as <phase>.
+        """
+        retries = int(config.get('transfer_retries') or 0)
+        started = time.time()
+        with self._leased(host):
+            while True:
+                try:
+                    r = fnc()
+                    self.timings.record(host, phase, time.time() - started)
+                    return r
+                except (paramiko.SSHException, socket.error, EOFError), e:
+                    if retries <= 0:
+                        raise
+                    retries -= 1
+                    self._error("Transfer on %s interrupted (%s); "
+                        "reconnecting" % (host, e))
+                    # Let go of the old client, its transport (and the
+                    # thread reading it) and its SFTP session first.
+                    self._close(host)
+                    self.connect(host)
+                    if not self.hconn[host].get('connected'):
+                        raise
+
+
+    def _transfer_all(self, fnc, verb, summary = None):
+        """
+        Run fnc(<host>, <progress_callback>) for every host, at most
+        'transfer_concurrency' at a time, and report on progress. Returns the
+        results of the calls that succeeded. summary(<progress>, <results>),
+        if given, replaces the standard report at the end.
+        """
+        progress = transfer.Progress(self._info)
+
+        def finished(host, result, exc_info):
+            if exc_info:
+                self._error("%s failed on %s: %s" % (verb, host, exc_info[1]))
+
+        results = pool.map_concurrent(
+            lambda host: fnc(host, progress.callback(host, verb)),
+            self.hosts,
+            concurrency = config.get('transfer_concurrency'),
+            callback = finished)
+        failed = len([r for r in results if r[2]])
+        ok = [r[1] for r in results if not r[2]]
+        if summary:
+            self._info(summary(progress, ok))
+        else:
+            self._info('%s %s' % (verb, progress.summary(len(ok))))
+        if failed:
+            self._error('%s failed on %s of %s hosts' % (verb, failed,
+                len(results)))
+        return ok
+
+
+    def get_file(self, source, target, h, callback = None):
         """
         Copy the file at the path <remote> on the remote host <h> to the target
         at <target> on the local system. The file will be renamed according to
-        the values in config.config['get_path_format'].
+        the values in config.config['get_path_format']. <callback>, if given,
+        is called with the bytes transferred so far and the total.
+
+        Interrupted downloads are resumed, and the result is checked against a
+        checksum of the original; see the transfer module.
         """
         host = self._gethost(h)
         if host:
-            client = self.hconn[host]['client']
-            sftp = client.open_sftp()
             path, filename = os.path.split(target)
             fmt = config.get('get_path_format', '%(path)s/%(host)s.%(filename)s')
             target = fmt % {
@@ -240,8 +647,10 @@ class Connections(object):
                 os.makedirs(os.path.dirname(target))
             except os.error:
                 pass
-            sftp.get(source, target)
-            sftp.close()
+            self._with_retries(host, 'get', lambda: transfer.get(
+                self._sftp(host), source, target, callback,
+                remote_digest = lambda path: self._remote_sha1(host, path),
+                report = self._error))
         else:
             self._info("No such host in list: %s" % h)
 
@@ -252,8 +661,10 @@ class Connections(object):
         at <target> on the local system. The files will be renamed according to
         the values in config.config['get_path_format'].
         """
-        for host in self.hosts:
-            self.get_file(source, target, host)
+        self._transfer_all(
+            lambda host, callback: self.get_file(source, target, host,
+                callback),
+            'Download')
 
 
     def get_history(self, host):
@@ -286,70 +697,56 @@ class Connections(object):
         https://github.com/paramiko/paramiko/blob/60c6e94e7dd6d7ac65c88ce1231f55d311777a34/demos/interactive.py
         """
         host = self._gethost(h)
-        if host:
-            history = self.get_history(host)[-1]
-            if history.get('exitcode') not in [None, -1]:
+        if host and not self.backend.joinable:
+            self._info("Jobs run by the '%s' execution backend can't be joined"
+                % config.get('execution_backend'))
+        elif host:
+            # Take the job away from the engine so that we are the only
+            # reader of its channel, and hand it back when we're done.
+            job = self.engine.detach(host)
+            if not job:
                 self._info("No pending job on %s" % host)
                 return
-            chan = history.get('chan')
+            chan = job.chan
+            out = job.history['output']
             oldtty = termios.tcgetattr(sys.stdin)
             try:
                 tty.setraw(sys.stdin.fileno())
                 tty.setcbreak(sys.stdin.fileno())
-                chan.settimeout(0.0)
-                output = history.get('output')
                 # output from before we `:join`ed the process
-                if output:
-                    oldoutput = ''
-                    try:
-                        while True:
-                            o = output.read(1)
-                            sys.stdout.write(o)
-                            oldoutput += o
-                    except socket.timeout:
-                        pass
+                for chunk in out.iterchunks():
+                    sys.stdout.write(chunk)
+                sys.stdout.flush()
                 while True:
                     r = select.select([chan, sys.stdin], [], [])[0]
                     if chan in r:
-                        try:
-                            x = chan.recv(1024)
-                            if len(x) == 0:
-                                oldoutput += '\n'
-                                print ''
-                                break
-                            sys.stdout.write(x)
-                            sys.stdout.flush()
-                            oldoutput += x
-                        except socket.timeout:
-                            pass
+                        # The job reads the channel, so that it can tell where
+                        # the output ends, as it would in the engine.
+                        x = job.read()
+                        sys.stdout.write(x)
+                        sys.stdout.flush()
+                        if job.eof:
+                            print ''
+                            break
                     if sys.stdin in r:
                         x = sys.stdin.read(1)
                         if len(x) == 0:
                             break
                         chan.send(x)
-                        oldoutput += x
-                if output:
-                    # Set the output buffer back up so that we have it in the
-                    # history
-                    output = StringIO.StringIO()
-                    output.write(oldoutput)
-                    output.seek(0)
-                    self.hconn[host]['history'][-1]['output'] = output
             finally:
                 termios.tcsetattr(sys.stdin, termios.TCSADRAIN, oldtty)
+                self.engine.submit(job)
         else:
             self._info("No such host in list: %s" % h)
 
 
     def kill(self, h):
         """
-        Stop the background thread for host <h> if it is running.
+        Stop the job running on host <h>, if there is one.
         """
         host = self._gethost(h)
-        status = dict(self.status())
         if host:
-            if status.get(host) is None:
-                self.killorders[host] = True
+            if self.backend.kill(host):
                 self._info('Requested stop for job on %s' % host)
             else:
                 self._info('%s has no pending jobs.' % host)
@@ -359,23 +756,27 @@ class Connections(object):
 
     def kill_all(self):
         """
-        Stop any still-processing background threads.
+        Stop any still-running jobs.
         """
-        for host in self.hosts:
+        for host in self.backend.running():
             self.kill(host)
 
 
-    def put_file(self, source, target, h):
+    def put_file(self, source, target, h, callback = None):
         """
         Copy the file at the path <source> on the local machine to the target
-        at <target> on host <h>.
+        at <target> on host <h>. <callback>, if given, is called with the bytes
+        transferred so far and the total.
+
+        Interrupted uploads are resumed, and the result is checked against a
+        checksum of the original; see the transfer module.
         """
         host = self._gethost(h)
         if host:
-            client = self.hconn[host]['client']
-            sftp = client.open_sftp()
-            sftp.put(source, target)
-            sftp.close()
+            self._with_retries(host, 'put', lambda: transfer.put(
+                self._sftp(host), source, target, callback,
+                remote_digest = lambda path: self._remote_sha1(host, path),
+                report = self._error))
         else:
             self._info("No such host in list: %s" % h)
 
@@ -383,10 +784,69 @@ class Connections(object):
     def put_file_all(self, source, target):
         """
         Copy the file at the path <source> on the local machine to the target
-        at <target> on each remote host.
+        at <target> on each remote host. If the 'relay_fanout' config option is
+        set and there are more hosts than that, the file is relayed from host
+        to host instead; see put_file_relay().
         """
-        for host in self.hosts:
-            self.put_file(source, target, host)
+        fanout = int(config.get('relay_fanout') or 0)
+        if fanout and len(self.hosts) > fanout:
+            return self.put_file_relay(source, target, fanout)
+        self._transfer_all(
+            lambda host, callback: self.put_file(source, target, host,
+                callback),
+            'Upload')
+
+
+    def put_file_relay(self, source, target, fanout):
+        """
+        Copy the file at the path <source> on the local machine to <target> on
+        each remote host through a tree of the hosts themselves: the file is
+        uploaded to <fanout> hosts, each of which passes it on to <fanout>
+        more with the 'relay_command' config option, and so on. Every copy is
+        checked against the digest of the original, and a host that can't be
+        reached by relay is sent the file directly.
+        """
+        digest = transfer.sha1_file(source)
+        progress = transfer.Progress(self._info)
+
+        def upload(host):
+            self.put_file(source, target, host,
+                progress.callback(host, 'Upload'))
+
+        def forward(parent, child):
+            username, password, hostname, port = self._address(child)
+            values = {
+                'source': target,
+                'target': target,
+                'host': child,
+                'hostname': hostname,
+                'port': port,
+                'user': username,
+            }
+            for k, v in values.items():
+                values[k] = pipes.quote(str(v))
+            status, out = self._exec(parent,
+                config.get('relay_command') % values,
+                forward_agent = config.get('relay_forward_agent'))
+            if status != 0:
+                raise IOError(' '.join(['relay_command exited with status %s'
+                    % status, out.strip()[-200:]]).strip())
+            if self._remote_sha1(child, target) != digest:
+                raise transfer.ChecksumError('Checksum mismatch for %s' %
+                    target)
+            self._info('Relayed %s from %s to %s' % (target, parent, child))
+
+        routes = relay.distribute(self.hosts, fanout, upload, forward,
+            report = self._error,
+            concurrency = config.get('transfer_concurrency'))
+        relayed = len([r for r in routes.values() if r == 'relay'])
+        direct = len([r for r in routes.values() if r == 'direct'])
+        failed = len(routes) - relayed - direct
+        self._info('Upload %s; relayed to %s more' % (progress.summary(direct),
+            relayed))
+        if failed:
+            self._error('Upload failed on %s of %s hosts' % (failed,
+                len(routes)))
 
 
     def remove(self, h):
@@ -397,103 +857,165 @@ class Connections(object):
         host = self._gethost(h)
         if host:
             self.disconnect(host)
-            self.hosts = filter(lambda x: x != host, self.hosts)
+            self.hosts.remove(host)
+            self.timings.forget(host)
             if host in self.hconn.keys():
+                for history in self.hconn[host].get('history', []):
+                    history.close()
                 del self.hconn[host]
         else:
             self._info("No such host in list: %s" % h)
 
 
-    def run_command(self, host, command):
+    def run_command(self, host, command, out = None, settings = None,
+        err = None):
         """
-        Run <command> on a single host.
+        Start <command> on a single host and hand it to the job engine. Returns
+        the new history entry, or None if the host couldn't be reached.
+
+        The command's output is written to <out>, a file-like object, which
+        defaults to a new buffer from the output store. The working directory
+        and environment are taken from <settings>, a dict of config options,
+        which defaults to the current configuration.
+
+        If the 'pty' setting is off, the command runs without a
+        pseudo-terminal: its output is kept byte for byte, and its standard
+        error goes separately to <err> (or a buffer of its own), as
+        history['stderr'].
         """
+        if settings is None:
+            settings = config.config
+
+        hostinfo = self.hconn.setdefault(host, {})
+
+        # The connection mustn't be closed to make room for another until the
+        # job engine has it.
+        with self._leased(host):
+            # Require a connection to continue. We will allow the user to
+            # interrupt this and drop the host if they don't want to wait
+            # forever.
+            if not self._alive(host):
+                if hostinfo.get('health') == health.DEAD and self.monitor \
+                        and self.monitor.reconnecting():
+                    self._error("Skipping %s: the connection is dead, and is "
+                        "being reconnected in the background" % host)
+                    return
+                if 'client' in hostinfo:
+                    self._info('Host %s disconnected. Attempting automatic '
+                        'reconnection' % host)
+                self.connect(host)
+                if not hostinfo.get('connected'):
+                    self._error("Connection attempt to %s failed" % host)
+                    return
+
+            self._touch(host)
+            client = self.hconn[host]['client']
+            started = time.time()
+            pty = settings.get('pty', True)
+            sh = None
+            if pty and settings.get('persistent_shell') and \
+                    shell.suitable(command):
+                sh = self._shell(host)
+            if sh:
+                chan = sh.chan
+                stdin = sh.stdin
+            else:
+                chan = client.get_transport().open_session()
+                if pty:
+                    chan.get_pty()
+                bufsize = -1
+                stdin = chan.makefile('wb', bufsize)
+
+            history = records.Record(command,
+                out or self.output_store.buffer(), chan, stdin)
+            if not pty:
+                history['stderr'] = err or self.output_store.buffer()
+
+            if sh:
+                try:
+                    job = sh.run(host, command, settings, history)
+                except Exception:
+                    sh.close()
+                    sh.release()
+                    raise
+            else:
+                tmp_command = ''
+                working_dir = settings.get('working_directory')
+                if working_dir:
+                    tmp_command += 'cd %s\n' % working_dir
+                for k, v in (settings.get('envvars') or {}).items():
+                    tmp_command += settings.get('envvar_format', '') % {
+                        'key': k,
+                        'value': v,
+                    }
+                tmp_command = '\n'.join([tmp_command, command])
+                chan.exec_command(tmp_command)
+                job = jobs.Job(host, chan, history)
+
+            elapsed = time.time() - started
+            self.timings.record(host, 'channel', elapsed)
+            history['started'] = time.time()
+            history['timings'] = {'channel': elapsed}
+            self._remember(host, history)
+            self.engine.submit(job)
+        return history
+
+
+    def _remember(self, host, history):
+        """
+        Add <history> to the command history of <host>, dropping the oldest
+        commands beyond 'history_limit'.
+        """
+        kept = self.hconn.setdefault(host, {}).setdefault('history', [])
+        kept.append(history)
+        records.trim(kept, int(config.get('history_limit') or 0))
 
-        self.test(host)
-        hostinfo = self.hconn.get(host, {})
-
-        if not 'history' in hostinfo.keys():
-            hostinfo['history'] = []
-
-        # Require a connection to continue. We will allow the user to interrupt
-        # this and drop the host if they don't want to wait forever.
-        if not hostinfo.get('connected'):
-            self._info(
-                'Host %s disconnected. Attempting automatic reconnection' % host
-            )
-            self.connect(host)
-            if not hostinfo.get('connected'):
-                self._error("Reconnection attempt to %s failed" % host)
-                return
-
-        client = self.hconn[host]['client']
-        chan = client.get_transport().open_session()
-        chan.get_pty()
-        bufsize = -1
-
-        stdin = chan.makefile('wb', bufsize)
-        output = chan.makefile('rb', bufsize)
-        tmp_command = ''
-        working_dir = config.get('working_directory')
-        if working_dir:
-            tmp_command += 'cd %s\n' % working_dir
-        for k, v in config.get('envvars', {}).items():
-            tmp_command += config.get('envvar_format', '') % {
-                'key': k,
-                'value': v,
-            }
-        tmp_command = '\n'.join([tmp_command, command])
-        chan.exec_command(tmp_command)
-        
-        history = {
-            'output': output,
-            'stdin': stdin,
-            'exitcode': None,
-            'timestamp': datetime.datetime.now(),
-            'command': command,
-            'chan': chan
-        }
-        self.hconn[host]['history'].append(history)
-
-        # wait for completion
-        while not chan.exit_status_ready():
-            # check to see if a stop has been ordered
-            if self.killorders.get(host):
-                self.killorders[host] = None
-                history['exitcode'] = -1
-                chan.close()
-                return
 
-        history['exitcode'] = chan.recv_exit_status()
+    def _shell(self, host):
+        """
+        Return the persistent shell on <host>, claimed for a command, starting
+        one if need be. Returns None if the shell is busy with another command.
+        """
+        hostinfo = self.hconn[host]
+        sh = hostinfo.get('shell')
+        if sh is None or not sh.alive():
+            sh = hostinfo['shell'] = shell.Shell(
+                hostinfo['client'].get_transport())
+        if sh.acquire():
+            return sh
 
 
-    def run_command_all(self, command):
+    def run_command_all(self, command, timeout = None):
         """
         Run <command> on each host. Adds the return values to the command
         history for that host.
+
+        Waits up to <timeout> seconds for the jobs to finish before returning;
+        with no timeout, waits until every job is done. Jobs that are still
+        running carry on in the background.
         """
 
-        self.jobs = []
-        for host in self.hosts:
-            self._info("Starting job on %s" % host)
-            p = Process(target = self.run_command, args = (host, command))
-            self.jobs.append((host, p))
-            p.start()
+        started = self.backend.start(self.hosts, command)
 
-        for host, p in self.jobs:
-            try:
-                time.sleep(config.get('job_timeout') or 0)
-            except KeyboardInterrupt:
-                self._error("Timeout interrupted!")
-                pass
-            isalive = p.isAlive() if hasattr(p, 'isAlive') else p.is_alive()
-            if not isalive:
-                self._info("Job on %s finished" % host)
-            else:
+        try:
+            pending = self.backend.wait(started, timeout)
+        except KeyboardInterrupt:
+            self._error("Timeout interrupted!")
+            pending = self.backend.running()
+        pending = dict.fromkeys(pending)
+
+        for host in self.hosts:
+            if host not in started:
+                continue
+            if host in pending:
                 self._info("Job on %s still pending" % host)
                 continue
-            history = self.get_history(host)[-1]
-            exitcode = history.get('exitcode')
+            history = self.get_history(host)
+            if not history:
+                # The job never got going; the backend has said why.
+                continue
+            self._info("Job on %s finished" % host)
+            exitcode = history[-1].get('exitcode')
             if exitcode is not 0:
                 self._error("Error running job on %s (exit code %s)" % \
                     (host, exitcode))
@@ -513,6 +1035,57 @@ class Connections(object):
         return r
 
 
+    def sync_file(self, source, target, h, callback = None, tree = None):
+        """
+        Bring the copy of the file or directory at <source> on the local
+        machine that is kept at <target> on host <h> up to date, sending only
+        what has changed; see the sync module. <callback>, if given, is called
+        with the bytes dealt with so far and the total. <tree>, a sync.Tree,
+        saves reading the local files again when syncing to many hosts.
+        Returns a sync.Result.
+        """
+        host = self._gethost(h)
+        if host:
+            if tree is None:
+                tree = sync.Tree(source, target)
+            threshold = int(config.get('sync_delta_threshold') or 0)
+            return self._with_retries(host, 'sync', lambda: sync.push(tree,
+                self._client(host),
+                self._sftp(host),
+                lambda path, remote: self.put_file(path, remote, host),
+                lambda path: self._remote_sha1(host, path),
+                callback,
+                threshold = threshold))
+        else:
+            self._info("No such host in list: %s" % h)
+
+
+    def sync_all(self, source, target):
+        """
+        Bring the copies of the file or directory at <source> on the local
+        machine that are kept at <target> on each remote host up to date.
+        """
+        tree = sync.Tree(source, target)
+
+        def summary(progress, results):
+            results = filter(None, results)
+            elapsed = max(time.time() - progress.started, 1e-6)
+            moved = sum(r.transferred for r in results)
+            return ('Synced %s file(s) to %s host(s) in %.1fs: %s unchanged, '
+                '%s patched, %s copied; %.1f of %.1f MB sent' % (
+                    len(tree.files), len(results), elapsed,
+                    sum(r.unchanged for r in results),
+                    sum(r.patched for r in results),
+                    sum(r.copied for r in results),
+                    moved / 1048576.0,
+                    tree.total * len(results) / 1048576.0))
+
+        self._transfer_all(
+            lambda host, callback: self.sync_file(source, target, host,
+                callback, tree),
+            'Sync', summary)
+
+
     def test(self, host):
         """
         Test whether the connection to <host> is still active and working.
@@ -530,6 +1103,8 @@ class Connections(object):
                 transport = client.get_transport()
                 if not transport.active:
                     self._info('Host %s is not connected' % host)
+                    hostinfo['connected'] = False
+                    return
 
                 self._info('Host %s is connected' % host)
 
@@ -0,0 +1,339 @@
+"""
+The control daemon: a background process that owns the SSH connections, so
+that one run of dyssh can reuse the connections made by the last, much like
+OpenSSH's ControlMaster.
+
+The daemon listens on a Unix socket at the 'control_path' config option. With
+the 'control' option set, dyssh starts it if it isn't already running, and
+hands every command to it with the daemon execution backend; the daemon
+connects to any host it hasn't seen before, runs the command, and sends the
+output back as it arrives. Connections that haven't been used for
+'control_persist' seconds are closed, and once it has no connections and no
+clients left, the daemon exits.
+
+The socket is only accessible to the user who started the daemon.
+"""
+
+import cPickle
+import errno
+import fcntl
+import os
+import socket
+import struct
+import threading
+import time
+import traceback
+
+import backends
+import config
+import connections
+
+from utils import pool
+
+
+# However short 'control_persist' is, a new daemon waits at least this long for
+# its first client.
+MIN_LINGER = 10
+
+
+def address():
+    return os.path.expanduser(config.get('control_path'))
+
+
+class Channel(object):
+    """
+    A stream socket carrying pickled messages, with the put() and get()
+    methods of a queue. Any number of threads may put() at once.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._lock = threading.Lock()
+
+
+    def put(self, msg):
+        data = cPickle.dumps(msg, cPickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            try:
+                self.sock.sendall(struct.pack('>I', len(data)) + data)
+            except socket.error:
+                # The other end has gone; get() will find out.
+                pass
+
+
+    def _read(self, n):
+        data = ''
+        while len(data) < n:
+            try:
+                chunk = self.sock.recv(n - len(data))
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise EOFError(e)
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+
+    def get(self):
+        n = struct.unpack('>I', self._read(4))[0]
+        return cPickle.loads(self._read(n))
+
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+def connect(path = None):
+    """
+    Return a Channel to the daemon listening at <path>. Raises socket.error if
+    there isn't one.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or address())
+    except socket.error:
+        sock.close()
+        raise
+    return Channel(sock)
+
+
+def running(path = None):
+    """
+    Whether a daemon is listening at <path>.
+    """
+    try:
+        connect(path).close()
+        return True
+    except socket.error:
+        return False
+
+
+def start(path = None, timeout = 10):
+    """
+    Make sure a daemon is listening at <path>, starting one in the background
+    if need be. Waits up to <timeout> seconds for a new daemon to be ready.
+    """
+    path = path or address()
+    if running(path):
+        return
+    pid = os.fork()
+    if pid == 0:
+        # Detach from the terminal and from this process, so that the daemon
+        # outlives it.
+        try:
+            os.setsid()
+            if os.fork() == 0:
+                devnull = os.open(os.devnull, os.O_RDWR)
+                for fd in range(3):
+                    os.dup2(devnull, fd)
+                Daemon(path).serve()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    deadline = time.time() + timeout
+    while not running(path):
+        if time.time() > deadline:
+            raise IOError('Unable to start the control daemon at %s' % path)
+        time.sleep(.05)
+
+
+class Daemon(object):
+    """
+    Accepts clients on the Unix socket at <path>, and runs the jobs they send
+    on connections that are shared between them. Messages are logged with
+    <log>.
+
+    Clients talk the same protocol as ProcessBackend uses with its workers:
+    ('run', <host>, <seq>, <command>, <settings>) and ('kill', <host>) orders
+    go one way, and 'info', 'error', 'timing', 'output', 'stderr', 'done' and
+    'failed' messages come back.
+    """
+
+    def __init__(self, path = None, log = lambda x: x):
+        self.path = path or address()
+        self.log = log
+        self.ttl = float(config.get('control_persist') or 0)
+        self.conns = connections.Connections([],
+            info_output = lambda x: self._message('info', x),
+            error_output = lambda x: self._message('error', x),
+            backend = 'inline',
+            connect = False)
+        self.conns.finish_listeners.append(self._finished)
+        self.conns.timings.listener = self._timing
+        self.pool = pool.ThreadPool(int(config.get('connect_concurrency')
+            or 1))
+        self.lock = threading.Lock()
+        # host -> when its connection was last used
+        self.used = {}
+        self.host_locks = {}
+        # host -> the client of the job last run there, which is sent the
+        # timings recorded by the job engine's thread.
+        self.routes = {}
+        self.clients = 0
+        self.last_active = time.time()
+        # The client whose job the current thread is working on.
+        self.current = threading.local()
+
+
+    def _message(self, kind, msg):
+        """
+        Pass a message to the client the current thread is working for, or to
+        the log if there isn't one.
+        """
+        results = getattr(self.current, 'results', None)
+        if results is not None:
+            results.put((kind, msg))
+        else:
+            self.log(msg)
+
+
+    def _timing(self, host, phase, seconds):
+        """
+        Pass a phase timing on to the client the current thread is working
+        for.
+        """
+        results = getattr(self.current, 'results', None) or \
+            self.routes.get(host)
+        if results is not None:
+            results.put(('timing', host, phase, seconds))
+
+
+    def _finished(self, host, history):
+        backends._finished(host, history)
+        with self.lock:
+            self.used[host] = time.time()
+            # Nothing is kept here; the client has the history.
+            hist = self.conns.hconn.get(host, {}).get('history', [])
+            if history in hist:
+                hist.remove(history)
+
+
+    def serve(self):
+        """
+        Listen for clients until there has been nothing to do for
+        'control_persist' seconds.
+        """
+        lock = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.log('A control daemon is already running at %s' % self.path)
+            return
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old = os.umask(077)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(old)
+        listener.listen(64)
+        listener.settimeout(1)
+        self.log('Control daemon listening at %s' % self.path)
+        try:
+            while not self._expired():
+                try:
+                    sock, _ = listener.accept()
+                    sock.settimeout(None)
+                    with self.lock:
+                        self.clients += 1
+                    t = threading.Thread(target = self._client,
+                        args = (Channel(sock),))
+                    t.daemon = True
+                    t.start()
+                except socket.timeout:
+                    pass
+                self._reap()
+        finally:
+            listener.close()
+            os.remove(self.path)
+            self.conns.disconnect_all()
+            lock.close()
+
+
+    def _client(self, results):
+        try:
+            while True:
+                try:
+                    order = results.get()
+                except EOFError:
+                    break
+                kind = order[0]
+                if kind == 'quit':
+                    break
+                elif kind == 'kill':
+                    self.conns.kill(order[1])
+                elif kind == 'run':
+                    self.pool.submit(self._run, (results,) + order[1:],
+                        lambda *r: None)
+        finally:
+            results.close()
+            with self.lock:
+                self.clients -= 1
+                self.last_active = time.time()
+
+
+    def _run(self, order):
+        results, host, seq, command, settings = order
+        self.current.results = results
+        with self.lock:
+            self.used[host] = time.time()
+            if host not in self.conns.hosts:
+                self.conns.hosts.append(host)
+            host_lock = self.host_locks.setdefault(host, threading.Lock())
+        try:
+            with host_lock:
+                self.routes[host] = results
+                history = self.conns.run_command(host, command,
+                    out = backends._ResultWriter(results, host, seq),
+                    err = backends._ResultWriter(results, host, seq,
+                        'stderr'),
+                    settings = settings)
+        except Exception:
+            results.put(('error', "Unable to start job on %s: %s" % (host,
+                traceback.format_exc().strip().split('\n')[-1])))
+            history = None
+        finally:
+            self.current.results = None
+        if history is None:
+            results.put(('failed', host, seq))
+
+
+    def _reap(self):
+        """
+        Close the connections that have been idle for too long.
+        """
+        now = time.time()
+        busy = dict.fromkeys(self.conns.engine.running())
+        with self.lock:
+            for host, used in self.used.items():
+                if host in busy or now - used < self.ttl:
+                    continue
+                del self.used[host]
+                self.log('Closing idle connection to %s' % host)
+                self.conns.remove(host)
+                self.host_locks.pop(host, None)
+                self.routes.pop(host, None)
+            if self.used or self.clients:
+                self.last_active = now
+
+
+    def _expired(self):
+        with self.lock:
+            return not self.used and not self.clients and \
+                time.time() - self.last_active > max(self.ttl, MIN_LINGER)
+
+
+def main():
+    """
+    Run a control daemon in the foreground, logging to stderr.
+    """
+    from utils.terminal import error
+    Daemon(log = lambda x: error(text = x)).serve()
+    return os.EX_OK
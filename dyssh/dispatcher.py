@@ -3,24 +3,44 @@ Sorts out whether command-line input should be going to the local program or the
 remote hosts and acts accordingly.
 """
 
-# TODO: output modes (first-host-and-diffs; etc.)
-
 
 import sys
 import os
-import pydoc
-import StringIO
+import re
 import textwrap
+import time
 import traceback
 
 import connections
 import config
+import inventory
+import output
+import records
+import search
 
 from utils import terminal
 
 # Debugging!
 last_traceback = None
 
+# The output.StreamWriter in use while streaming mode is on.
+streamer = None
+
+# The records.Store the history is kept in, with 'history_db' set.
+history_store = None
+
+# The search.OutputIndex used by :grep, with 'grep_index' set.
+output_index = None
+
+# Abbreviations that meant one command before others starting the same way
+# were added, and still do.
+ALIASES = {
+    'g': 'get',
+    'st': 'status',
+    'sta': 'status',
+    'stat': 'status',
+}
+
 
 def run_interactive(command = ''):
     """
@@ -42,6 +62,7 @@ def run_interactive(command = ''):
             command = raw_input(prompt)
             if command.startswith(':'):
                 c, _, args = command[1:].partition(' ')
+                c = ALIASES.get(c, c)
                 possibles = []
                 for fnc in globals().keys():
                     if fnc.startswith('cmd_'+c):
@@ -78,18 +99,55 @@ def run_interactive(command = ''):
     return os.EX_OK
 
 
-def run(command = ''):
+def run(command = '', wait = False):
     """
     Run individual commands by passing them to the Connections object. Failures
     should be collected and dealt with here by checking the return codes of
     completed commands.
+
+    Unless <wait> is set, only waits 'job_timeout' seconds for the jobs to
+    finish; the rest carry on in the background.
     """
 
     if not len(connections.conns.hosts):
         terminal.error(text = 'No hosts specified.')
 
-    connections.conns.run_command_all(command)
+    if wait and config.get('format') == 'jsonl':
+        return _run_jsonl(command)
+
+    if wait:
+        timeout = None
+    else:
+        timeout = float(config.get('job_timeout') or 0)
+    connections.conns.run_command_all(command, timeout)
+    if streamer:
+        streamer.flush()
+    if wait and config.get('aggregate'):
+        for piece in _aggregate_lines():
+            sys.stdout.write(piece)
+
+    return os.EX_OK
+
 
+def _run_jsonl(command):
+    """
+    Run <command> on every host, printing a JSON record for each as it
+    finishes, and one for each host it couldn't be started on.
+    """
+    conns = connections.conns
+    writer = output.JSONLinesWriter(
+        inline_limit = int(config.get('jsonl_inline_limit') or 0),
+        directory = os.path.expanduser(config.get('jsonl_output_dir')),
+        timings = conns.timings)
+    conns.finish_listeners.append(writer.finish)
+    try:
+        conns.run_command_all(command)
+        for host in conns.hosts:
+            if host not in writer.seen:
+                writer.failed(host, conns.hconn.get(host, {}).get('error'))
+    finally:
+        conns.finish_listeners.remove(writer.finish)
+        writer.close()
     return os.EX_OK
 
 
@@ -100,12 +158,21 @@ def run(command = ''):
 def cmd_add(*args):
     """
     :add <host>           Add a host to the active host list. Optionally specify
-                          more than one host.
+                          more than one host. Host names may contain ranges,
+                          like web[01-20], and @<group> and tag:<tag> add the
+                          hosts in that group or with that tag in the
+                          inventory.
     """
     if not args:
         return os.EX_USAGE
     for i in args:
-        connections.conns.add(i)
+        if inventory.is_selector(i) or inventory.RANGE.search(i):
+            try:
+                connections.conns.add_all(inventory.expand([i]))
+            except (inventory.InventoryError, IOError, OSError), e:
+                terminal.error(text = str(e), lvl = 2)
+        else:
+            connections.conns.add(i)
     return os.EX_OK
 
 
@@ -137,6 +204,75 @@ def cmd_get(*args):
     return os.EX_OK
 
 
+def cmd_grep(*args):
+    """
+    :grep <regex> [--host <host>] [--history <n>]
+                          Show the lines of output matching <regex> from the
+                          last command (or the last <n>) on <host>, or on every
+                          host, with the number of matches on each. Like all
+                          arguments, <regex> is split on spaces, and its words
+                          are joined again with one space each: use \s{2} or
+                          \s+ to match more than one.
+    """
+    conns = connections.conns
+    args = list(args)
+    commands = 1
+    hosts = conns.hosts
+    # The options come after the pattern, in either order.
+    while len(args) > 2 and args[-2] in ('--history', '--host'):
+        value = args.pop()
+        option = args.pop()
+        if option == '--history':
+            if not value.isdigit() or int(value) < 1:
+                return os.EX_USAGE
+            commands = int(value)
+        else:
+            host = conns._gethost(value)
+            if not host:
+                terminal.error(text = "No such host in list: %s" % value)
+                return os.EX_OK
+            hosts = [host]
+    if not args:
+        return os.EX_USAGE
+    # The arguments have been split on spaces; put them back together.
+    pattern = ' '.join(args)
+    try:
+        regex = re.compile(pattern)
+    except re.error, e:
+        terminal.error(text = 'Invalid regular expression: %s' % e, lvl = 1)
+        return os.EX_OK
+
+    items = []
+    for host in hosts:
+        history = conns.get_history(host) or []
+        items.extend((host, h) for h in history[-commands:])
+    results = search.search(items, regex, output_index)
+    terminal.page(_grep_lines(results, len(hosts)), config.get('pager'))
+    return os.EX_OK
+
+
+def _grep_lines(results, searched):
+    """
+    Generate the text shown by :grep for <results> from search.search(), out
+    of <searched> hosts.
+    """
+    dyssh_prefix = terminal.tocolor('(dyssh) ', 'bold')
+    hosts = []
+    for host, history, matches in results:
+        if host not in hosts:
+            hosts.append(host)
+    yield dyssh_prefix + '%s matching line(s) from %s of %s host(s)\n' % (
+        sum(len(matches) for _, _, matches in results), len(hosts), searched)
+    for host, history, matches in results:
+        yield '\n' + terminal.tocolor('=== %s: %s line(s) from %s' % (host,
+            len(matches), history.get('command')), 'bold yellow') + '\n'
+        host_prefix = terminal.tocolor('[%s] ' % host, 'bold yellow')
+        stderr_prefix = terminal.tocolor('[%s:stderr] ' % host, 'bold red')
+        for stream, lineno, line in matches:
+            prefix = stderr_prefix if stream == 'stderr' else host_prefix
+            yield '%s%s: %s\n' % (prefix, lineno, line)
+
+
 def cmd_help(*args):
     """
     :help [cmd]           Show interactive command help.
@@ -158,24 +294,71 @@ def cmd_help(*args):
 
 def cmd_history(*args):
     """
-    :history <host>       Show the command history for <host>.
+    :history <host> [<n>] [failed]
+                          Show the last <n> commands run on <host> (or on
+                          every host, for 'all'), or only those that failed.
+                          With 'history_db' set, this includes earlier
+                          sessions.
     """
-    if len(args) == 1:
-        history = connections.conns.get_history(args[0])
-        if not history:
-            terminal.error(text = "No history available for %s" % args[0])
+    if not args:
+        return os.EX_USAGE
+    limit = int(config.get('history_limit') or 0) or 100
+    failed = False
+    for arg in args[1:]:
+        if arg == 'failed':
+            failed = True
+        elif arg.isdigit():
+            limit = int(arg)
         else:
-            headers = ('\n#', 'Command', 'Exit code')
-            output = []
-            for i, h in enumerate(history):
-                output.append((
-                    '%s' % i,
-                    h.get('command'),
-                    h.get('exitcode'),
-                ))
-            print terminal.format_columns(headers, output), '\n'
+            return os.EX_USAGE
+
+    conns = connections.conns
+    host = None
+    if args[0] != 'all':
+        # Hosts from earlier sessions may not be in the list any more.
+        host = conns._gethost(args[0]) or (history_store and args[0])
+        if not host:
+            terminal.error(text = "No such host in list: %s" % args[0])
+            return os.EX_OK
+
+    if host is None:
+        names = conns.hosts
+    elif host in conns.hosts:
+        names = [host]
     else:
-        return os.EX_USAGE
+        names = []
+    history = []
+    for name in names:
+        history.extend((name, h) for h in conns.get_history(name) or [])
+    if failed:
+        history = [(name, h) for name, h in history
+            if h['exitcode'] not in (0, None)]
+    if history_store:
+        # The commands of this session that are still running, or that
+        # haven't been written yet, are only in memory; the rest are in both.
+        rows = history_store.query(host, failed, limit)
+        stored = set((h['host'], h['command'], h['started']) for h in rows)
+        history = [(records.name(name), h) for name, h in history
+            if (records.name(name), h['command'],
+                records.seconds(h['timestamp'])) not in stored]
+        history.extend((h['host'], h) for h in rows)
+    history.sort(key = lambda item: item[1]['timestamp'])
+    history = history[-limit:]
+    if not history:
+        terminal.error(text = "No history available for %s" % args[0])
+        return os.EX_OK
+
+    headers = ('\n#', 'Started', 'Host', 'Command', 'Exit code')
+    output = []
+    for i, (name, h) in enumerate(history):
+        output.append((
+            '%s' % i,
+            h['timestamp'].strftime('%Y-%m-%d %H:%M:%S'),
+            name,
+            h.get('command'),
+            h.get('exitcode'),
+        ))
+    print terminal.format_columns(headers, output), '\n'
     return os.EX_OK
 
 
@@ -198,10 +381,10 @@ def cmd_kill(*args):
     """
     :kill <host>          Tells the running process for <host> to stop. When it
                           is successfully terminated, the exit status will be
-                          set to -1. Note that stopping the local thread that
-                          runs the job is not actually guaranteed to stop the
-                          process on the remote host (although it should receive
-                          a SIGHUP when the SSH session quits).
+                          set to -1. Note that closing the job's channel is not
+                          actually guaranteed to stop the process on the remote
+                          host (although it should receive a SIGHUP when the SSH
+                          session quits).
     """
     if len(args) == 1:
         connections.conns.kill(args[0])
@@ -213,25 +396,49 @@ def cmd_kill(*args):
 
 def cmd_list(*args):
     """
-    :list                 List all hosts in the current hosts list.
+    :list                 List all hosts in the current hosts list, with the
+                          health of each connection as last checked in the
+                          background.
     """
     output = []
+    now = time.time()
     for idx, item in enumerate(connections.conns.items()):
         host, hostinfo = item
+        hostinfo = hostinfo or {}
+        state = hostinfo.get('health') or '-'
+        if hostinfo.get('health_since'):
+            state += ' (%s)' % _age(now - hostinfo['health_since'])
+        last_seen = '-'
+        if hostinfo.get('last_seen'):
+            last_seen = '%s ago' % _age(now - hostinfo['last_seen'])
+            if hostinfo.get('latency') is not None:
+                last_seen += ', %dms' % (hostinfo['latency'] * 1000)
         output.append((
             '[%s]' % idx,
             host,
             hostinfo.get('connected'),
+            state,
+            last_seen,
             hostinfo.get('exitcode')
         ))
     if not len(output):
         terminal.error(text = 'No hosts.')
         return os.EX_OK
-    headers = ('', 'Hostname', 'Connected', 'Last exit')
+    headers = ('', 'Hostname', 'Connected', 'Health', 'Last seen', 'Last exit')
     print '\n', terminal.format_columns(headers, output), '\n'
     return os.EX_OK
 
 
+def _age(seconds):
+    """
+    Format a number of seconds briefly, e.g. '45s', '12m' or '3h'.
+    """
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size:
+            return '%d%s' % (seconds // size, unit)
+    return '%ds' % seconds
+
+
 def cmd_put(*args):
     """
     :put <local> <remote> Copy the file at <local> path for each remote host to
@@ -247,12 +454,38 @@ def cmd_put(*args):
 def cmd_remove(*args):
     """
     :remove <host>        Remove one or more hosts from the active host list.
-                          Optionally specify more than one host.
+                          Optionally specify more than one host. Ranges,
+                          @<group> and tag:<tag> work as they do for :add.
     """
     if not args:
         return os.EX_USAGE
     for i in args:
-        connections.conns.remove(i)
+        if inventory.is_selector(i) or inventory.RANGE.search(i):
+            try:
+                hosts = [h for h in inventory.expand([i])
+                    if h in connections.conns.hosts]
+            except (inventory.InventoryError, IOError, OSError), e:
+                terminal.error(text = str(e), lvl = 2)
+                continue
+            for host in hosts:
+                connections.conns.remove(host)
+            terminal.error(text = 'Removed %s host(s)' % len(hosts))
+        else:
+            connections.conns.remove(i)
+    return os.EX_OK
+
+
+def cmd_sync(*args):
+    """
+    :sync <local> <remote>
+                          Like :put, but <local> may be a directory, and only
+                          the files (and the parts of files) that differ on
+                          each host are sent.
+    """
+    if len(args) == 2:
+        connections.conns.sync_all(args[0], args[1])
+    else:
+        return os.EX_USAGE
     return os.EX_OK
 
 
@@ -321,9 +554,14 @@ def cmd_env(*args):
 def cmd_show(*args):
     """
     :show <host>          Show the output of the last command for <host>.
+    :show all             Show each distinct output of the last command once,
+                          with the hosts that produced it. Outputs close to the
+                          most common one are shown as a diff against it.
     :<host>               A shortcut for `:show <host>`
     """
-    if len(args) == 1:
+    if args == ('all',):
+        terminal.page(_aggregate_lines(), config.get('pager'))
+    elif len(args) == 1:
         host = args[0]
         host = connections.conns._gethost(host)
         if not host:
@@ -332,50 +570,180 @@ def cmd_show(*args):
         history = connections.conns.get_history(host)
         if not history:
             terminal.error(text = "No output available for %s" % host)
+        elif history[-1].get('exitcode') is None:
+            terminal.error(text = "Command still pending")
         else:
-            last_history = history[-1]
-            command = last_history.get('command')
-            output = last_history.get('output')
-            exitcode = last_history.get('exitcode')
+            terminal.page(_show_lines(host, history[-1]), config.get('pager'))
+    else:
+        return os.EX_USAGE
+    return os.EX_OK
 
-            if exitcode is None:
-                terminal.error(text = "Command still pending")
-                return os.EX_OK
-            else:
-                # This will block if the process isn't complete
-                outlines = output.readlines()
-                # Reset the output for later re-reading. If we've already
-                # replaced the buffer with a StringIO we can just seek.
-                try:
-                    output.seek(0)
-                except:
-                    output = StringIO.StringIO()
-                    output.writelines(outlines)
-                    output.seek(0)
-                last_history['output'] = output
-            outstr = ''
-            outstr += terminal.error(
-                text = terminal.tocolor(command + '\n', 'bold'),
-                silent = True
-            )
-            for line in outlines:
-                outstr += terminal.error(
-                    '[%s] ' % host,
-                    line.strip('\n'),
-                    1,
-                    silent = True
-                )
-            outstr += terminal.error(
-                text = 'Exit code: %s' % exitcode,
-                silent = True
-            )
-            outstr = outstr.replace('\r', '\n')
-            pydoc.pipepager(outstr, config.get('pager'))
+
+def _show_lines(host, history):
+    """
+    Generate the text shown by :show for the command in <history>: the
+    command, each line of output prefixed with the host name, any standard
+    error kept apart from it, and the exit code. The output is read lazily, so
+    this can be handed straight to a pager.
+    """
+    dyssh_prefix = terminal.tocolor('(dyssh) ', 'bold')
+    host_prefix = terminal.tocolor('[%s] ' % host, 'bold yellow')
+    yield dyssh_prefix + terminal.tocolor(history.get('command'), 'bold')
+    yield '\n\n'
+    stderr = history.get('stderr')
+    if stderr is None:
+        # Output from a pseudo-terminal, with its line endings to undo.
+        for line in history.get('output').iterlines():
+            line = line.rstrip('\r\n')
+            if '\r' in line:
+                line = line.replace('\r', '\n')
+            yield host_prefix + line + '\n'
+    else:
+        for line in _lines(host_prefix, history.get('output')):
+            yield line
+        for line in _lines(terminal.tocolor('[%s:stderr] ' % host,
+                'bold red'), stderr):
+            yield line
+    yield dyssh_prefix + 'Exit code: %s\n' % history.get('exitcode')
+
+
+def _lines(prefix, buf):
+    """
+    Generate the lines of the OutputBuffer <buf>, each prefixed with <prefix>.
+    """
+    for line in buf.iterlines():
+        yield prefix + line.rstrip('\n') + '\n'
+
+
+def _aggregate_lines():
+    """
+    Generate the text shown by `:show all`.
+    """
+    dyssh_prefix = terminal.tocolor('(dyssh) ', 'bold')
+    finished = []
+    pending = []
+    commands = []
+    for host, hostinfo in connections.conns.items():
+        history = (hostinfo or {}).get('history')
+        if not history:
+            continue
+        history = history[-1]
+        if history.get('command') not in commands:
+            commands.append(history.get('command'))
+        if history.get('exitcode') is None:
+            pending.append(host)
+        else:
+            finished.append((host, history))
+    if not finished and not pending:
+        yield dyssh_prefix + 'No output available\n'
+        return
+    outputs = dict((host, h['output']) for host, h in finished)
+    errors = dict((host, h.get('stderr')) for host, h in finished)
+    groups = output.group(finished)
+
+    for command in commands:
+        yield dyssh_prefix + terminal.tocolor(command, 'bold') + '\n'
+    yield dyssh_prefix + '%s distinct output(s) from %s host(s)\n' % (
+        len(groups), len(finished))
+    if pending:
+        yield dyssh_prefix + 'Still pending on %s\n' % _host_summary(pending)
+
+    limit = int(config.get('aggregate_diff_limit') or 0)
+    majority = None
+    for exitcode, digest, hosts in groups:
+        yield '\n' + terminal.tocolor('=== %s (exit code %s)' % (
+            _host_summary(hosts), exitcode), 'bold yellow') + '\n'
+        buf = outputs[hosts[0]]
+        for line in _group_lines(majority, buf, digest, limit):
+            yield line
+        if majority is None:
+            majority = buf
+        stderr = errors[hosts[0]]
+        if stderr is not None and stderr.size:
+            yield terminal.tocolor('Standard error:', 'bold red') + '\n'
+            for line in stderr.iterlines():
+                yield line.rstrip('\n') + '\n'
+
+
+def _group_lines(majority, buf, digest, limit):
+    """
+    Generate the output of a group for `:show all`: the OutputBuffer <buf>,
+    with the SHA-1 <digest>, or how it differs from the first group's output,
+    <majority>.
+    """
+    if majority is not None:
+        if majority.digest() == digest:
+            yield 'Same output as the first group.\n'
+            return
+        lines = output.diff(majority, buf, limit)
+        if lines is not None:
+            yield 'Differs from the first group by:\n'
+            for line in lines:
+                yield line.rstrip('\r\n') + '\n'
+            return
+    for line in buf.iterlines():
+        yield line.rstrip('\r\n') + '\n'
+
+
+def _host_summary(hosts, show = 10):
+    """
+    A short description of a list of hosts.
+    """
+    summary = '%s host(s): %s' % (len(hosts), ', '.join(hosts[:show]))
+    if len(hosts) > show:
+        summary += ' (+%s more)' % (len(hosts) - show)
+    return summary
+
+
+def cmd_stats(*args):
+    """
+    :stats                Show how long each phase of connecting, running
+                          commands and copying files took across the hosts,
+                          with percentiles and the slowest hosts.
+    :stats <phase>        List the slowest hosts in <phase> (dns, tcp,
+                          handshake, sftp, channel, first_byte, command, put,
+                          get or sync).
+    """
+    conns = connections.conns
+    if not args:
+        output = []
+        for stats in conns.timings.summary():
+            output.append((
+                stats['phase'],
+                stats['count'],
+                _ms(stats['mean']),
+                _ms(stats['p50']),
+                _ms(stats['p90']),
+                _ms(stats['p99']),
+                _ms(stats['max']),
+                ', '.join('%s (%s)' % (host, _ms(t))
+                    for host, t in stats['slowest']),
+            ))
+        if not output:
+            terminal.error(text = 'Nothing has been timed yet')
+            return os.EX_OK
+        headers = ('Phase', 'Hosts', 'Mean', 'p50', 'p90', 'p99', 'Max',
+            'Slowest')
+    elif len(args) == 1:
+        output = [('[%s]' % idx, host, _ms(t)) for idx, (host, t) in
+            enumerate(conns.timings.slowest(args[0], 10))]
+        if not output:
+            terminal.error(text = 'No times recorded for %s' % args[0])
+            return os.EX_OK
+        headers = ('', 'Host', args[0])
     else:
         return os.EX_USAGE
+    print '\n', terminal.format_columns(headers, output), '\n'
     return os.EX_OK
 
 
+def _ms(seconds):
+    """
+    Format a duration in milliseconds.
+    """
+    return '%.1fms' % (seconds * 1000)
+
+
 def cmd_status(*args):
     """
     :status               Show the status of all jobs from the last command.
@@ -401,6 +769,34 @@ def cmd_status(*args):
     return os.EX_OK
 
 
+def cmd_stream(*args):
+    """
+    :stream [on|off]      Show, or switch on or off, streaming mode. While it
+                          is on, the output of every host is printed as it
+                          arrives, each line prefixed with the host name.
+    """
+    global streamer
+    conns = connections.conns
+    if not args:
+        print 'on' if streamer else 'off'
+    elif len(args) == 1 and args[0] == 'on':
+        if not streamer:
+            streamer = output.StreamWriter()
+            conns.output_listeners.append(streamer.feed)
+            conns.finish_listeners.append(streamer.end)
+        config.config['stream'] = True
+    elif len(args) == 1 and args[0] == 'off':
+        if streamer:
+            conns.output_listeners.remove(streamer.feed)
+            conns.finish_listeners.remove(streamer.end)
+            streamer.close()
+            streamer = None
+        config.config['stream'] = False
+    else:
+        return os.EX_USAGE
+    return os.EX_OK
+
+
 def cmd_traceback(*args):
     global last_traceback
     print last_traceback
@@ -0,0 +1,191 @@
+"""
+Background health checks for the connections to the hosts.
+
+The HealthMonitor sends an SSH keepalive to every connected host each
+'keepalive_interval' seconds, from a thread of its own, and records the
+outcome in the host's entry in Connections.hconn:
+
+    health          'healthy' if the last keepalive was answered in time,
+                    'degraded' while one has gone unanswered for longer than
+                    'keepalive_timeout' seconds, and 'dead' once the
+                    connection has failed or 'keepalive_count_max' timeouts
+                    have passed without an answer.
+    health_since    When the host entered that state.
+    last_seen       When the host last answered.
+    latency         How long the last answer took, in seconds.
+
+Dead connections are closed, so that nothing waits on them forever, and are
+reconnected in the background after a delay that doubles with each failed
+attempt, up to 'reconnect_backoff_max' seconds, with some jitter so that a
+fleet that drops at once doesn't come back all at once. In lazy mode (see
+Connections), dead hosts are left alone until they are next used instead.
+
+None of this happens on the command path: running a command only looks at
+what the monitor has already found out.
+"""
+
+import random
+import threading
+import time
+
+import config
+
+from utils import pool
+
+
+HEALTHY = 'healthy'
+DEGRADED = 'degraded'
+DEAD = 'dead'
+
+# How often the monitor looks over the hosts, in seconds.
+TICK = 1.0
+
+
+def mark(hostinfo, state):
+    """
+    Record that the host described by <hostinfo> is in <state>.
+    """
+    if hostinfo.get('health') != state:
+        hostinfo['health'] = state
+        hostinfo['health_since'] = time.time()
+
+
+def backoff(failures, base, limit):
+    """
+    The number of seconds to wait before reconnecting after <failures> failed
+    attempts in a row: <base> doubled for each failure, up to <limit>, of
+    which a random half is taken off.
+    """
+    delay = min(limit, base * 2 ** max(failures - 1, 0))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class HealthMonitor(object):
+    """
+    Watches over the connections of the Connections object <conns>.
+    """
+
+    def __init__(self, conns):
+        self.conns = conns
+        self.interval = float(config.get('keepalive_interval') or 0)
+        self.timeout = float(config.get('keepalive_timeout') or 0) or \
+            self.interval
+        self.count_max = int(config.get('keepalive_count_max') or 1)
+        self.backoff_base = float(config.get('reconnect_backoff') or 1)
+        self.backoff_max = float(config.get('reconnect_backoff_max') or 0) \
+            or self.backoff_base
+        self.pool = pool.ThreadPool(int(config.get('connect_concurrency') or 1))
+        # host -> when the keepalive or reconnection in flight was started
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self.check()
+            except Exception, e:
+                self.conns._error('Health check failed: %s' % e)
+            self.stopped.wait(TICK)
+
+
+    def check(self):
+        """
+        Start keepalives and reconnections that are due, and deal with
+        keepalives that are taking too long.
+        """
+        now = time.time()
+        reconnect = self.reconnecting()
+        for host in list(self.conns.hosts):
+            hostinfo = self.conns.hconn.get(host)
+            if not hostinfo:
+                continue
+            with self.lock:
+                started = self.pending.get(host)
+            if started is not None:
+                waited = now - started
+                if not hostinfo.get('connected'):
+                    continue
+                elif waited > self.timeout * self.count_max:
+                    self._dead(host, 'no answer to keepalives for %.0fs' %
+                        waited)
+                elif waited > self.timeout:
+                    mark(hostinfo, DEGRADED)
+            elif hostinfo.get('connected'):
+                if now - hostinfo.get('last_checked', 0) >= self.interval:
+                    self._start(host, self._keepalive)
+            elif hostinfo.get('health') == DEAD and reconnect and \
+                    now >= hostinfo.get('retry_at', 0):
+                self._start(host, self._reconnect)
+
+
+    def reconnecting(self):
+        """
+        Whether dead hosts are reconnected in the background, rather than the
+        next time they are used.
+        """
+        return not (config.get('lazy_connect') or self.conns.max_open)
+
+
+    def _start(self, host, fnc):
+        with self.lock:
+            self.pending[host] = time.time()
+
+        def done(host, result, exc_info):
+            with self.lock:
+                self.pending.pop(host, None)
+
+        self.pool.submit(fnc, host, done)
+
+
+    def _keepalive(self, host):
+        hostinfo = self.conns.hconn[host]
+        transport = hostinfo['client'].get_transport()
+        started = hostinfo['last_checked'] = time.time()
+        if transport is None or not transport.is_active():
+            self._dead(host, 'connection closed')
+            return
+        # The reply doesn't matter; any reply at all shows the host is there.
+        transport.global_request('keepalive@openssh.com', wait = True)
+        if not hostinfo.get('connected'):
+            # Closed on purpose in the meantime.
+            return
+        if not transport.is_active():
+            self._dead(host, 'connection closed')
+            return
+        hostinfo['last_seen'] = time.time()
+        hostinfo['latency'] = hostinfo['last_seen'] - started
+        mark(hostinfo, HEALTHY)
+
+
+    def _dead(self, host, reason):
+        hostinfo = self.conns.hconn.get(host, {})
+        with self.lock:
+            if hostinfo.get('health') == DEAD:
+                return
+            mark(hostinfo, DEAD)
+        self.conns._error('Connection to %s is dead (%s)' % (host, reason))
+        hostinfo['failures'] = 0
+        hostinfo['retry_at'] = time.time() + backoff(0, self.backoff_base,
+            self.backoff_max)
+        self.conns._close(host)
+
+
+    def _reconnect(self, host):
+        self.conns.connect(host)
+        hostinfo = self.conns.hconn.get(host, {})
+        if hostinfo.get('connected'):
+            self.conns._info('Reconnected to %s' % host)
+            return
+        hostinfo['failures'] = hostinfo.get('failures', 0) + 1
+        hostinfo['retry_at'] = time.time() + backoff(hostinfo['failures'],
+            self.backoff_base, self.backoff_max)
+
+
+    def stop(self):
+        self.stopped.set()
+        self.pool.close()
@@ -0,0 +1,330 @@
+"""
+Inventory files: lists of hosts, arranged into groups and tagged, that can be
+picked out at the prompt or on the command line with selectors.
+
+The file named by the 'inventory' config option looks like this:
+
+    # Hosts before the first section belong to no group.
+    bastion.example.com user=admin
+
+    [web]
+    web[001-500].dc1 user=deploy port=2222 tags=frontend
+    web-canary.dc1 tags=frontend,canary
+
+    [db]
+    db[a-c].dc1
+
+    # A group made of other groups.
+    [dc1:children]
+    web
+    db
+
+Each host line is a host name, optionally followed by 'user', 'port' and
+'tags' (comma-separated) settings, and stands for the host
+'<user>@<name>:<port>' in the host list. A name may contain ranges like
+'[001-500]' (zero-padded to the width of the first number) or '[a-c]', which
+are only expanded as the hosts are needed, so that a large inventory costs
+little to load.
+
+These selectors stand for the hosts they pick out of the inventory:
+
+    @<group>    The hosts in <group> and its children; '@all' for every host.
+    tag:<tag>   The hosts tagged with <tag>.
+
+Host names containing ranges are expanded wherever a host name is accepted,
+with or without an inventory.
+
+The parsed inventory is kept in the file at 'inventory_cache', and is only
+parsed again once the inventory file has changed.
+"""
+
+import cPickle
+import itertools
+import os
+import re
+
+import config
+
+
+# Matches a range in a host name: '[001-500]' or '[a-f]'.
+RANGE = re.compile(r'\[([0-9]+|[a-zA-Z])-([0-9]+|[a-zA-Z])\]')
+
+SETTINGS = ('user', 'port', 'tags')
+
+
+class InventoryError(ValueError):
+    """
+    The inventory file or a selector is not valid.
+    """
+
+
+def _range(start, end, line):
+    """
+    Return a (<first>, <last>, <format>) triple for the range <start>-<end>,
+    where <format> % <n> gives each value in it.
+    """
+    if start.isdigit() and end.isdigit():
+        if len(start) > 1 and start.startswith('0'):
+            fmt = '%%0%dd' % len(start)
+        else:
+            fmt = '%d'
+        first, last = int(start), int(end)
+    elif start.isalpha() and end.isalpha():
+        fmt = '%c'
+        first, last = ord(start), ord(end)
+    else:
+        raise InventoryError('Invalid range [%s-%s] on line %s' % (start, end,
+            line))
+    if first > last:
+        raise InventoryError('Empty range [%s-%s] on line %s' % (start, end,
+            line))
+    return first, last, fmt
+
+
+def compile_pattern(name, line = None):
+    """
+    Split the host name <name> into a tuple of its literal parts and the
+    ranges between them, or return <name> itself if it has no ranges.
+    """
+    parts = []
+    pos = 0
+    for m in RANGE.finditer(name):
+        parts.append(name[pos:m.start()])
+        parts.append(_range(m.group(1), m.group(2), line))
+        pos = m.end()
+    if not parts:
+        return name
+    parts.append(name[pos:])
+    return tuple(parts)
+
+
+def expand_pattern(pattern):
+    """
+    Generate the host names matched by a compiled <pattern>, in order.
+    """
+    if isinstance(pattern, basestring):
+        yield pattern
+        return
+    literals = pattern[0::2]
+    ranges = [xrange(first, last + 1) for first, last, _ in pattern[1::2]]
+    formats = [fmt for _, _, fmt in pattern[1::2]]
+    for values in itertools.product(*ranges):
+        name = [literals[0]]
+        for fmt, value, literal in zip(formats, values, literals[1:]):
+            name.append(fmt % value)
+            name.append(literal)
+        yield ''.join(name)
+
+
+def pattern_size(pattern):
+    """
+    The number of host names matched by a compiled <pattern>.
+    """
+    if isinstance(pattern, basestring):
+        return 1
+    n = 1
+    for first, last, _ in pattern[1::2]:
+        n *= last - first + 1
+    return n
+
+
+class Inventory(object):
+    """
+    A parsed inventory file. Hosts are only expanded from their patterns by
+    select().
+    """
+
+    def __init__(self):
+        # (<pattern>, <user>, <port>) for each host line, in file order
+        self.entries = []
+        # group -> indices of its entries, and the names of its child groups
+        self.groups = {}
+        self.children = {}
+        # tag -> indices of its entries
+        self.tags = {}
+
+
+    def add(self, pattern, group = None, user = None, port = None,
+        tags = ()):
+        """
+        Add the hosts matching the compiled <pattern> to <group>, with the
+        given connection details and <tags>.
+        """
+        idx = len(self.entries)
+        self.entries.append((pattern, user, port))
+        if group:
+            self.groups.setdefault(group, []).append(idx)
+        for tag in tags:
+            self.tags.setdefault(tag, []).append(idx)
+
+
+    def __len__(self):
+        return sum(pattern_size(p) for p, _, _ in self.entries)
+
+
+    def _group_entries(self, group, seen):
+        if group in seen:
+            return []
+        seen.add(group)
+        if group not in self.groups and group not in self.children:
+            raise InventoryError('No such group: %s' % group)
+        idxs = list(self.groups.get(group, []))
+        for child in self.children.get(group, []):
+            idxs.extend(self._group_entries(child, seen))
+        return idxs
+
+
+    def _entries(self, selector):
+        if selector.startswith('@'):
+            group = selector[1:]
+            if group == 'all':
+                return xrange(len(self.entries))
+            return sorted(set(self._group_entries(group, set())))
+        elif selector.startswith('tag:'):
+            tag = selector[4:]
+            if tag not in self.tags:
+                raise InventoryError('No hosts tagged %s' % tag)
+            return self.tags[tag]
+        raise InventoryError('Invalid selector: %s' % selector)
+
+
+    def select(self, selector):
+        """
+        Generate the hosts picked out by <selector>, each once, in file order.
+        Raises InventoryError if the group or tag doesn't exist.
+        """
+        idxs = self._entries(selector)
+
+        def hosts():
+            seen = set()
+            for idx in idxs:
+                pattern, user, port = self.entries[idx]
+                for name in expand_pattern(pattern):
+                    host = name
+                    if user and '@' not in host:
+                        host = '%s@%s' % (user, host)
+                    if port and ':' not in host.partition('@')[2]:
+                        host = '%s:%s' % (host, port)
+                    if host not in seen:
+                        seen.add(host)
+                        yield host
+        return hosts()
+
+
+def parse(f):
+    """
+    Parse the inventory in the open file <f>.
+    """
+    inv = Inventory()
+    group = None
+    children = False
+    for lineno, line in enumerate(f, 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        if line.startswith('[') and line.endswith(']'):
+            group, _, kind = line[1:-1].strip().partition(':')
+            if kind not in ('', 'children'):
+                raise InventoryError('Unknown section type %s on line %s' % (
+                    kind, lineno))
+            children = kind == 'children'
+            if children:
+                inv.children.setdefault(group, [])
+            else:
+                inv.groups.setdefault(group, [])
+            continue
+        fields = line.split()
+        if children:
+            inv.children[group].extend(fields)
+            continue
+        settings = {}
+        for field in fields[1:]:
+            k, sep, v = field.partition('=')
+            if not sep or k not in SETTINGS:
+                raise InventoryError('Invalid setting %s on line %s' % (field,
+                    lineno))
+            settings[k] = v
+        inv.add(compile_pattern(fields[0], lineno), group,
+            user = settings.get('user'),
+            port = settings.get('port'),
+            tags = filter(None, settings.get('tags', '').split(',')))
+    return inv
+
+
+def _load_cache(path, stamp):
+    try:
+        with open(path, 'rb') as f:
+            cached_stamp, inv = cPickle.load(f)
+    except Exception:
+        return None
+    if cached_stamp == stamp:
+        return inv
+
+
+def _save_cache(path, stamp, inv):
+    tmp = '%s.%s' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            cPickle.dump((stamp, inv), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        # The cache only saves time; carry on without it.
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+# (path, stamp, Inventory) of the last inventory loaded.
+_loaded = None
+
+
+def load(path = None, cache = None):
+    """
+    Return the Inventory in the file at <path> (the 'inventory' config option
+    by default), from the cache at <cache> ('inventory_cache') if the file
+    hasn't changed since it was cached. Returns None if no inventory is set.
+    """
+    global _loaded
+    path = path or config.get('inventory')
+    if not path:
+        return None
+    path = os.path.abspath(os.path.expanduser(path))
+    st = os.stat(path)
+    stamp = (path, st.st_mtime, st.st_size)
+    if _loaded and _loaded[1] == stamp:
+        return _loaded[2]
+    cache = cache or config.get('inventory_cache')
+    cache = cache and os.path.expanduser(cache)
+    inv = cache and _load_cache(cache, stamp)
+    if not inv:
+        with open(path) as f:
+            inv = parse(f)
+        if cache:
+            _save_cache(cache, stamp, inv)
+    _loaded = (path, stamp, inv)
+    return inv
+
+
+def is_selector(name):
+    """
+    Whether <name> is an inventory selector rather than a host name.
+    """
+    return name.startswith('@') or name.startswith('tag:')
+
+
+def expand(names):
+    """
+    Generate the hosts named by <names>, which may be host names, host names
+    with ranges, or selectors.
+    """
+    for name in names:
+        if is_selector(name):
+            inv = load()
+            if inv is None:
+                raise InventoryError('No inventory file is set for %s' % name)
+            for host in inv.select(name):
+                yield host
+        else:
+            for host in expand_pattern(compile_pattern(name)):
+                yield host
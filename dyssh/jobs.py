@@ -0,0 +1,363 @@
+"""
+The job engine. Every command running on a remote host is a Job, and a single
+background thread owned by the JobEngine multiplexes all of their channels. It
+sleeps until a channel has data, a kill order arrives or a new job is
+submitted, so idle jobs cost next to nothing no matter how many there are.
+"""
+
+import os
+import select
+import socket
+import threading
+import time
+
+
+# Maximum number of bytes to take from a channel in one go. Reading in bounded
+# slices means every ready channel gets a turn on each pass through the loop.
+READ_SIZE = 32768
+
+# Seconds to sleep between checks on channels that have reached EOF but have
+# not yet reported an exit status.
+EXIT_POLL = .05
+
+# Upper bound on how long the engine thread sleeps when there are live jobs.
+# This only matters if a server closes a channel without ever sending EOF.
+IDLE_POLL = 1.0
+
+
+class Job(object):
+    """
+    A single command running on the channel <chan> to <host>. Output is
+    appended to history['output'] as it arrives (standard error too, unless
+    the history has a buffer of its own for it under 'stderr'), and
+    history['exitcode'] is set once the command completes.
+    """
+
+    def __init__(self, host, chan, history):
+        self.host = host
+        self.chan = chan
+        self.history = history
+        self.eof = False
+        chan.settimeout(0.0)
+        # Asking paramiko for the descriptor creates it, so hold on to it
+        # rather than asking again once the channel has been closed.
+        self.fd = chan.fileno()
+
+
+    def fileno(self):
+        return self.fd
+
+
+    def read(self):
+        """
+        Take whatever output is waiting on the channel, and return it. Sets
+        self.eof when the remote side has finished sending.
+        """
+        chan = self.chan
+        output = self.history['output']
+        errors = self.history.get('stderr', output)
+        data = ''
+        for ready, recv, out in ((chan.recv_ready, chan.recv, output),
+                (chan.recv_stderr_ready, chan.recv_stderr, errors)):
+            if ready():
+                try:
+                    x = recv(READ_SIZE)
+                except socket.timeout:
+                    continue
+                out.write(x)
+                data += x
+        if not (chan.recv_ready() or chan.recv_stderr_ready()) and \
+                (chan.eof_received or chan.closed):
+            self.eof = True
+        return data
+
+
+    def done(self):
+        return self.eof and self.chan.exit_status_ready()
+
+
+    def finish(self, exitcode = None):
+        """
+        Record the exit code and release the channel.
+        """
+        if exitcode is None:
+            exitcode = self.chan.recv_exit_status()
+        self.history['exitcode'] = exitcode
+        self.chan.close()
+
+
+class _Poller(object):
+    """
+    Wait for readability on a changing set of file descriptors, using epoll or
+    poll where available so that the number of jobs isn't capped by select()'s
+    FD_SETSIZE.
+    """
+
+    def __init__(self):
+        self._epoll = hasattr(select, 'epoll')
+        if self._epoll:
+            self._p = select.epoll()
+            self._flags = select.EPOLLIN
+        elif hasattr(select, 'poll'):
+            self._p = select.poll()
+            self._flags = select.POLLIN
+        else:
+            self._p = None
+            self._fds = set()
+
+
+    def register(self, fd):
+        if self._p is None:
+            self._fds.add(fd)
+        else:
+            self._p.register(fd, self._flags)
+
+
+    def unregister(self, fd):
+        if self._p is None:
+            self._fds.discard(fd)
+        else:
+            self._p.unregister(fd)
+
+
+    def poll(self, timeout = None):
+        """
+        Return the registered descriptors that are ready to read. <timeout> is
+        in seconds; None blocks indefinitely.
+        """
+        if self._p is None:
+            return select.select(list(self._fds), [], [], timeout)[0]
+        if self._epoll:
+            if timeout is None:
+                timeout = -1
+            events = self._p.poll(timeout)
+        else:
+            if timeout is not None:
+                timeout = int(timeout * 1000)
+            events = self._p.poll(timeout)
+        return [fd for fd, _ in events]
+
+
+class JobEngine(object):
+    """
+    Runs every submitted Job to completion on a single background thread. If
+    given, on_output(<host>, <history>, <data>) is called from that thread as
+    output arrives, on_finish(<host>, <history>) as each job completes, and
+    on_error(<message>) when a job can't be completed cleanly.
+    """
+
+    def __init__(self, on_output = None, on_finish = None, on_error = None):
+        self.on_output = on_output
+        self.on_finish = on_finish
+        self.on_error = on_error
+        # The most recent job on each host, and every job still being serviced
+        # (which includes any that a newer job on the same host superseded).
+        self.jobs = {}
+        self._live = set()
+        self.killorders = set()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.thread = None
+        self._incoming = []
+        self._fdmap = {}
+        self._wakeup_r, self._wakeup_w = os.pipe()
+
+
+    def _wakeup(self):
+        os.write(self._wakeup_w, '.')
+
+
+    def submit(self, job):
+        """
+        Hand <job> over to the engine. A job already running on the same host
+        carries on in the background, but from then on kill(), detach() and
+        wait() refer to the new one.
+        """
+        with self.lock:
+            self.jobs[job.host] = job
+            self._live.add(job)
+            self._incoming.append(job)
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target = self._run)
+                self.thread.daemon = True
+                self.thread.start()
+        self._wakeup()
+
+
+    def detach(self, host):
+        """
+        Stop servicing the job on <host> and return it, so that the caller can
+        use its channel directly (see Connections.join). Returns None if there
+        is no such job. The job can be handed back with submit().
+        """
+        with self.lock:
+            job = self.jobs.pop(host, None)
+            if job:
+                self._live.discard(job)
+                self._incoming.append(None)
+        if job:
+            self._wakeup()
+            # Wait for the engine thread to let go of the channel.
+            with self.lock:
+                while job.fileno() in self._fdmap:
+                    self.changed.wait(IDLE_POLL)
+        return job
+
+
+    def kill(self, host):
+        """
+        Order the job on <host> to stop. Returns False if there is no such
+        job.
+        """
+        with self.lock:
+            if host not in self.jobs:
+                return False
+            self.killorders.add(self.jobs[host])
+        self._wakeup()
+        return True
+
+
+    def running(self):
+        """
+        Return the hosts with jobs still in progress.
+        """
+        with self.lock:
+            return self.jobs.keys()
+
+
+    def wait(self, hosts = None, timeout = None):
+        """
+        Block until the jobs on <hosts> (default: all of them) have finished,
+        or until <timeout> seconds have passed. Returns the hosts whose jobs
+        are still running.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.lock:
+            while True:
+                if hosts is None:
+                    pending = self.jobs.keys()
+                else:
+                    pending = [h for h in hosts if h in self.jobs]
+                if not pending:
+                    return []
+                if timeout is None:
+                    # Waiting in slices keeps KeyboardInterrupt deliverable.
+                    self.changed.wait(IDLE_POLL)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return pending
+                    self.changed.wait(remaining)
+
+
+    def _run(self):
+        """
+        The engine loop.
+        """
+        poller = _Poller()
+        poller.register(self._wakeup_r)
+        fdmap = self._fdmap
+        draining = set()
+
+        while True:
+            with self.lock:
+                incoming, self._incoming = self._incoming, []
+                killorders, self.killorders = self.killorders, set()
+                live = set(self._live)
+
+            # Forget about jobs that have been detached.
+            for fd, job in fdmap.items():
+                if job not in live:
+                    poller.unregister(fd)
+                    del fdmap[fd]
+            draining &= live
+            if incoming:
+                with self.lock:
+                    self.changed.notify_all()
+
+            for job in incoming:
+                if job not in live:
+                    continue
+                if job.eof:
+                    # Handed back (by Connections.join) with all of its
+                    # output read; only the exit status is left to wait for.
+                    draining.add(job)
+                else:
+                    fd = job.fileno()
+                    if fd not in fdmap:
+                        fdmap[fd] = job
+                        poller.register(fd)
+
+            for job in killorders:
+                if job in live:
+                    self._finish(job, poller, -1)
+                    live.discard(job)
+                    draining.discard(job)
+
+            if draining:
+                timeout = EXIT_POLL
+            elif fdmap:
+                timeout = IDLE_POLL
+            else:
+                timeout = None
+
+            for fd in poller.poll(timeout):
+                if fd == self._wakeup_r:
+                    os.read(self._wakeup_r, 4096)
+                    continue
+                job = fdmap.get(fd)
+                if not job:
+                    continue
+                try:
+                    data = job.read()
+                except Exception:
+                    # The transport has most likely gone away underneath us;
+                    # treat it as the end of the output.
+                    job.eof = True
+                    data = ''
+                if data and self.on_output:
+                    self.on_output(job.host, job.history, data)
+                if job.eof:
+                    poller.unregister(fd)
+                    del fdmap[fd]
+                    draining.add(job)
+
+            for job in list(draining):
+                if job.done():
+                    draining.discard(job)
+                    self._finish(job, poller)
+
+
+    def _finish(self, job, poller, exitcode = None):
+        """
+        Complete <job> and remove it from the engine.
+        """
+        fd = job.fileno()
+        if self._fdmap.get(fd) is job:
+            poller.unregister(fd)
+            del self._fdmap[fd]
+        try:
+            job.finish(exitcode)
+        except Exception, e:
+            # The transport has most likely gone away underneath us; the job
+            # counts as stopped, and the engine carries on with the rest.
+            job.history['exitcode'] = -1
+            try:
+                job.chan.close()
+            except Exception:
+                pass
+            if self.on_error:
+                self.on_error('Unable to finish the job on %s: %s' % (
+                    job.host, e))
+        # The listeners hear about the job before anyone waiting for it does,
+        # so that whatever they do is done by the time wait() returns.
+        try:
+            if self.on_finish:
+                self.on_finish(job.host, job.history)
+        finally:
+            with self.lock:
+                self._live.discard(job)
+                if self.jobs.get(job.host) is job:
+                    del self.jobs[job.host]
+                self.changed.notify_all()
@@ -0,0 +1,537 @@
+"""
+Storage for command output. Every job writes into an OutputBuffer, which keeps
+its contents in memory until it grows past a per-buffer limit, or until the
+OutputStore it belongs to runs out of its overall memory budget. After that,
+the buffer moves everything into a temporary file and carries on there, so the
+memory used for output stays bounded however much of it the hosts produce.
+
+The StreamWriter prints output live as it arrives, for the streaming mode, and
+the JSONLinesWriter writes a JSON record for each command as it finishes, for
+the jsonl batch format.
+"""
+
+import base64
+import difflib
+import hashlib
+import json
+import mmap
+import os
+import Queue
+import re
+import sys
+import tempfile
+import threading
+import time
+
+import records
+
+from utils import terminal
+
+
+# Size of the pieces handed out by OutputBuffer.iterchunks().
+CHUNK_SIZE = 65536
+
+
+class OutputStore(object):
+    """
+    Creates OutputBuffers and keeps track of how much memory they use between
+    them. Each buffer may hold <buffer_limit> bytes in memory, and all of them
+    together <total_limit> bytes; either may be None for no limit. Spill files
+    are created in <spill_dir>, or the system's temporary directory.
+    """
+
+    def __init__(self, buffer_limit = None, total_limit = None,
+        spill_dir = None):
+        self.buffer_limit = buffer_limit
+        self.total_limit = total_limit
+        self.spill_dir = spill_dir
+        self.in_memory = 0
+        self._lock = threading.Lock()
+
+
+    def buffer(self):
+        """
+        Return a new, empty OutputBuffer.
+        """
+        return OutputBuffer(self, self.buffer_limit)
+
+
+    def _reserve(self, n):
+        with self._lock:
+            if self.total_limit is not None and \
+                    self.in_memory + n > self.total_limit:
+                return False
+            self.in_memory += n
+            return True
+
+
+    def _release(self, n):
+        with self._lock:
+            self.in_memory -= n
+
+
+class OutputBuffer(object):
+    """
+    An append-only store for the output of one command. Writes always go to
+    the end, and reads take an explicit offset, so the job engine can keep
+    writing while the output is being read elsewhere.
+    """
+
+    def __init__(self, store = None, limit = None):
+        self.store = store
+        self.limit = limit
+        self.size = 0
+        self.closed = False
+        self._chunks = []
+        self._file = None
+        self._lock = threading.Lock()
+        # Kept up to date as output arrives, so that identical outputs can be
+        # grouped without reading them again.
+        self._hash = hashlib.sha1()
+
+
+    @property
+    def spilled(self):
+        """
+        True once the buffer has moved to disk.
+        """
+        return self._file is not None
+
+
+    def _reserve(self, n):
+        if self.limit is not None and self.size + n > self.limit:
+            return False
+        if self.store is not None:
+            return self.store._reserve(n)
+        return True
+
+
+    def _spill(self):
+        spill_dir = self.store.spill_dir if self.store else None
+        self._file = tempfile.TemporaryFile(prefix = 'dyssh-',
+            dir = spill_dir)
+        for chunk in self._chunks:
+            self._file.write(chunk)
+        if self.store is not None:
+            self.store._release(self.size)
+        self._chunks = []
+
+
+    def write(self, data):
+        if not data or self.closed:
+            return
+        with self._lock:
+            if self._file is None and not self._reserve(len(data)):
+                self._spill()
+            if self._file is not None:
+                self._file.seek(0, 2)
+                self._file.write(data)
+            else:
+                self._chunks.append(data)
+            self.size += len(data)
+            self._hash.update(data)
+
+
+    def read(self, offset = 0, size = -1):
+        """
+        Return up to <size> bytes starting at <offset>; all of the rest if
+        <size> is negative.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.seek(offset)
+                return self._file.read(size)
+            if len(self._chunks) > 1:
+                self._chunks = [''.join(self._chunks)]
+            data = self._chunks[0] if self._chunks else ''
+            if size < 0:
+                return data[offset:]
+            return data[offset:offset + size]
+
+
+    def digest(self):
+        """
+        Return the SHA-1 hex digest of the output so far.
+        """
+        with self._lock:
+            return self._hash.copy().hexdigest()
+
+
+    def getvalue(self):
+        """
+        Return the whole of the output as a single string. Prefer iterchunks()
+        or iterlines() for output that may be large.
+        """
+        return self.read()
+
+
+    def _map(self):
+        """
+        Return a read-only memory map of the spill file as it stands, or None
+        if the buffer is still in memory (or empty).
+        """
+        with self._lock:
+            if self._file is None or not self.size:
+                return None
+            self._file.flush()
+            return mmap.mmap(self._file.fileno(), self.size,
+                access = mmap.ACCESS_READ)
+
+
+    def iterchunks(self, size = CHUNK_SIZE):
+        """
+        Iterate over the output in pieces of at most <size> bytes. Output that
+        has been spilled to disk is read through a memory map, so only the
+        pages actually being looked at are loaded.
+        """
+        offset = 0
+        mapped = self._map()
+        if mapped is not None:
+            try:
+                for offset in xrange(0, len(mapped), size):
+                    yield mapped[offset:offset + size]
+                # Carry on from here with anything written since the map was
+                # made.
+                offset = len(mapped)
+            finally:
+                mapped.close()
+        while True:
+            chunk = self.read(offset, size)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield chunk
+
+
+    def iterlines(self):
+        """
+        Iterate over the lines of the output, line endings included. Very long
+        lines are handed out in pieces.
+        """
+        partial = ''
+        for chunk in self.iterchunks():
+            lines = (partial + chunk).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line + '\n'
+            # Don't let output with no line breaks in it pile up in memory.
+            if len(partial) >= CHUNK_SIZE:
+                yield partial
+                partial = ''
+        if partial:
+            yield partial
+
+
+    def close(self):
+        """
+        Throw the output away and give back the memory or disk it used.
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            elif self.store is not None:
+                self.store._release(self.size)
+            self._chunks = []
+            self.size = 0
+
+
+def group(items):
+    """
+    Group the (<host>, <history>) pairs in <items> by the exit code and the
+    output (and standard error, if kept apart) of each command, using the
+    digests the buffers keep as output arrives. This costs O(hosts), not
+    O(hosts ** 2) comparisons. Returns a list of (<exitcode>, <digest>,
+    <hosts>) tuples, largest group first, with the hosts in their original
+    order. <digest> is that of the output alone.
+    """
+    groups = {}
+    order = []
+    for host, history in items:
+        stderr = history.get('stderr')
+        key = (history.get('exitcode'), history['output'].digest(),
+            stderr and stderr.digest())
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(host)
+    order.sort(key = lambda k: -len(groups[k]))
+    return [(k[0], k[1], groups[k]) for k in order]
+
+
+def diff(a, b, limit, context = 1):
+    """
+    Return the lines of a compact unified diff from the OutputBuffer <a> to
+    <b>, or None if the two aren't close. Outputs over <limit> bytes are never
+    compared, and neither are outputs where more than half of the lines
+    differ.
+    """
+    if a.size > limit or b.size > limit:
+        return None
+    a_lines = list(a.iterlines())
+    b_lines = list(b.iterlines())
+    lines = list(difflib.unified_diff(a_lines, b_lines, n = context))[2:]
+    changed = len([l for l in lines if l[:1] in '+-'])
+    if changed * 2 > len(a_lines) + len(b_lines):
+        return None
+    return lines
+
+
+class StreamWriter(object):
+    """
+    Prints the output of every running job as it arrives, one whole line at a
+    time, each prefixed with the name of the host it came from. Lines are
+    collected and written to <out> in batches: whenever <batch_size> bytes
+    are waiting, and otherwise at least every <interval> seconds, so a chatty
+    host costs a few large writes rather than a flood of small ones.
+
+    Register feed() as an output listener and end() as a finish listener on a
+    Connections object to use it.
+    """
+
+    def __init__(self, out = sys.stdout, interval = .05, batch_size = 65536):
+        self.out = out
+        self.interval = interval
+        self.batch_size = batch_size
+        self._partial = {}
+        self._prefixes = {}
+        self._batch = []
+        self._batched = 0
+        self._lock = threading.Lock()
+        self._pending = threading.Condition(self._lock)
+        self._closed = False
+        self._flusher = threading.Thread(target = self._run)
+        self._flusher.daemon = True
+        self._flusher.start()
+
+
+    def _prefix(self, host):
+        prefix = self._prefixes.get(host)
+        if prefix is None:
+            prefix = self._prefixes[host] = terminal.tocolor('[%s] ' % host,
+                'bold yellow')
+        return prefix
+
+
+    def _add(self, host, lines):
+        prefix = self._prefix(host)
+        for line in lines:
+            line = prefix + line.rstrip('\r') + '\n'
+            self._batch.append(line)
+            self._batched += len(line)
+        if self._batched >= self.batch_size:
+            self._flush()
+        else:
+            self._pending.notify()
+
+
+    def feed(self, host, history, data):
+        """
+        Take a piece of output from <host>.
+        """
+        with self._lock:
+            lines = (self._partial.pop(host, '') + data).split('\n')
+            partial = lines.pop()
+            # Long runs of output without a line break are printed anyway.
+            if len(partial) >= CHUNK_SIZE:
+                lines.append(partial)
+                partial = ''
+            if partial:
+                self._partial[host] = partial
+            if lines:
+                self._add(host, lines)
+
+
+    def end(self, host, history = None):
+        """
+        Print whatever is left of the last line of output from <host>.
+        """
+        with self._lock:
+            partial = self._partial.pop(host, '')
+            if partial:
+                self._add(host, [partial])
+
+
+    def _flush(self):
+        if self._batch:
+            data = ''.join(self._batch)
+            self._batch = []
+            self._batched = 0
+            try:
+                self.out.write(data)
+                self.out.flush()
+            except IOError:
+                pass
+
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+
+    def _run(self):
+        with self._lock:
+            while not self._closed:
+                if not self._batch:
+                    self._pending.wait()
+                    continue
+                # Give the batch a moment to fill up before writing it.
+                self._lock.release()
+                try:
+                    time.sleep(self.interval)
+                finally:
+                    self._lock.acquire()
+                self._flush()
+
+
+    def close(self):
+        """
+        Print everything still waiting, and stop the writer.
+        """
+        with self._lock:
+            for host in self._partial.keys():
+                self._add(host, [self._partial.pop(host)])
+            self._flush()
+            self._closed = True
+            self._pending.notify()
+
+
+class JSONLinesWriter(object):
+    """
+    Writes a JSON record to <out> for each command as it finishes, one per
+    line, flushing after each one so that whatever reads them can start on the
+    first hosts before the last ones are done.
+
+    Each record has the host (without any password), the command, its exit
+    code, when it started and how long each phase took (see the timings
+    module; connection phases are taken from <timings>, a Timings object, if
+    given). Output and standard
+    error (when kept apart) up to <inline_limit> bytes go in the record, as
+    'stdout' and 'stderr', or as 'stdout_base64' and 'stderr_base64' if they
+    aren't UTF-8 text. Anything bigger is copied to a file in <directory>, and
+    the record gives its path as 'stdout_file' or 'stderr_file' instead. The
+    size is always given, as 'stdout_bytes' and 'stderr_bytes'.
+
+    Register finish() as a finish listener on a Connections object to use it,
+    and call failed() for hosts where the command never started.
+    """
+
+    def __init__(self, out = sys.stdout, inline_limit = 65536,
+        directory = 'dyssh-output', timings = None):
+        self.out = out
+        self.inline_limit = inline_limit
+        self.directory = directory
+        self.timings = timings
+        # Hosts with a record on the way.
+        self.seen = set()
+        # Records are written by a thread of their own, so that copying a big
+        # output to a file doesn't hold up the job engine.
+        self._queue = Queue.Queue()
+        self._writer = threading.Thread(target = self._run)
+        self._writer.daemon = True
+        self._writer.start()
+
+
+    def finish(self, host, history):
+        """
+        Write the record of the command in <history> on <host>.
+        """
+        self.seen.add(host)
+        self._queue.put((self._record, host, history))
+
+
+    def failed(self, host, error = None):
+        """
+        Write a record for <host> saying the command couldn't be run there,
+        because of <error>.
+        """
+        self.seen.add(host)
+        self._queue.put((self._failure, host, error))
+
+
+    def _failure(self, host, error):
+        return {
+            'host': records.name(host),
+            'exitcode': None,
+            'error': str(error or 'The command was not started'),
+        }
+
+
+    def _record(self, host, history):
+        timestamp = history.get('timestamp')
+        timings = {}
+        if self.timings:
+            timings.update(self.timings.host(host))
+        timings.update(history.get('timings') or {})
+        record = {
+            'host': records.name(host),
+            'command': history.get('command'),
+            'exitcode': history.get('exitcode'),
+            'started': timestamp and timestamp.isoformat(),
+            'timings': timings,
+        }
+        self._stream(record, host, 'stdout', history['output'])
+        if history.get('stderr') is not None:
+            self._stream(record, host, 'stderr', history['stderr'])
+        return record
+
+
+    def _stream(self, record, host, name, buf):
+        """
+        Add the contents of the OutputBuffer <buf> to <record> as <name>.
+        """
+        record[name + '_bytes'] = buf.size
+        if buf.size > self.inline_limit:
+            record[name + '_file'] = self._copy(host, name, buf)
+            return
+        data = buf.getvalue()
+        try:
+            record[name] = data.decode('utf-8')
+        except UnicodeDecodeError:
+            record[name + '_base64'] = base64.b64encode(data)
+
+
+    def _copy(self, host, name, buf):
+        """
+        Copy the OutputBuffer <buf> to a new file, and return its path. Files
+        from earlier runs are left alone.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Leave any password out of the name.
+        hostname = re.sub(r'[^\w.-]', '_', host.rpartition('@')[2])
+        fd, path = tempfile.mkstemp(prefix = hostname + '-',
+            suffix = '.' + name, dir = self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in buf.iterchunks():
+                f.write(chunk)
+        return path
+
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fnc, host, arg = item
+            try:
+                record = fnc(host, arg)
+            except Exception, e:
+                record = {'host': records.name(host),
+                    'error': 'Unable to record the result: %s' % e}
+            try:
+                self.out.write(json.dumps(record, sort_keys = True) + '\n')
+                self.out.flush()
+            except IOError:
+                pass
+
+
+    def close(self):
+        """
+        Write every record still waiting, and stop the writer.
+        """
+        self._queue.put(None)
+        self._writer.join()
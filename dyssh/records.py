@@ -0,0 +1,307 @@
+"""
+The command history. Every command run on a host leaves a Record in the
+host's history list, hconn[<host>]['history'], oldest first.
+
+Records are kept small: a Record has a fixed set of slots rather than a dict,
+and once its command has finished it lets go of the channel and stdin it was
+run with, keeping only what was captured (in buffers from the output store).
+Each host keeps at most 'history_limit' records; older ones are dropped, and
+their output freed, as new commands start.
+
+With 'history_db' set, every finished command is also written to a SQLite
+database, so that :history can look back over earlier sessions. The database
+keeps each command's host, start time, duration and exit code, indexed for
+lookups by host, by time and by exit code, along with the first
+'history_db_output_limit' bytes of its output and standard error.
+"""
+
+import datetime
+import Queue
+import sqlite3
+import threading
+import time
+
+
+# The fields of a Record.
+FIELDS = frozenset(('command', 'output', 'stderr', 'chan', 'stdin', 'exitcode',
+    'timestamp', 'started', 'timings'))
+
+
+class Record(object):
+    """
+    The history of one command: the <command> itself, the OutputBuffer its
+    <output> goes to (and <stderr>, if kept apart), and while it runs, the
+    <chan> and <stdin> it was started with.
+
+    Records can also be used like the dicts they replace: record['output'],
+    record.get('stderr'), and so on. Slots that haven't been set count as
+    missing.
+    """
+
+    __slots__ = ('command', 'output', 'stderr', 'chan', 'stdin', 'exitcode',
+        'timestamp', 'started', 'timings', '__weakref__')
+
+    def __init__(self, command, output, chan = None, stdin = None,
+        stderr = None):
+        self.command = command
+        self.output = output
+        self.stderr = stderr
+        self.chan = chan
+        self.stdin = stdin
+        self.exitcode = None
+        self.timestamp = datetime.datetime.now()
+        self.started = None
+        self.timings = None
+
+
+    def __getitem__(self, key):
+        if key not in FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+
+    def __setitem__(self, key, value):
+        if key not in FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+
+    def __contains__(self, key):
+        return key in FIELDS and getattr(self, key) is not None
+
+
+    def get(self, key, default = None):
+        if key in self:
+            return getattr(self, key)
+        return default
+
+
+    def release(self):
+        """
+        Let go of the channel, once the command has finished.
+        """
+        self.chan = None
+        self.stdin = None
+
+
+    def close(self):
+        """
+        Throw the record's output away.
+        """
+        self.release()
+        self.output.close()
+        if self.stderr is not None:
+            self.stderr.close()
+
+
+def trim(records, limit):
+    """
+    Drop the oldest finished records from the list <records> until there are
+    no more than <limit> of them (if <limit> is set), closing each one.
+    Commands that are still running are kept.
+    """
+    if not limit or len(records) <= limit:
+        return
+    excess = len(records) - limit
+    for record in list(records):
+        if not excess:
+            break
+        if record['exitcode'] is not None:
+            records.remove(record)
+            record.close()
+            excess -= 1
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS commands (
+    id INTEGER PRIMARY KEY,
+    host TEXT NOT NULL,
+    command TEXT,
+    started REAL NOT NULL,
+    duration REAL,
+    exitcode INTEGER,
+    output BLOB,
+    output_bytes INTEGER,
+    stderr BLOB,
+    stderr_bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS commands_host ON commands (host, started);
+CREATE INDEX IF NOT EXISTS commands_started ON commands (started);
+CREATE INDEX IF NOT EXISTS commands_exitcode ON commands (exitcode, started);
+"""
+
+
+class StoreError(Exception):
+    pass
+
+
+def seconds(timestamp):
+    """
+    The datetime <timestamp> as seconds since the epoch, as stored.
+    """
+    return time.mktime(timestamp.timetuple()) + timestamp.microsecond / 1e6
+
+
+def name(host):
+    """
+    <host> as it is stored: with any password left out.
+    """
+    if '@' not in host:
+        return host
+    user_spec, _, host_spec = host.rpartition('@')
+    return '%s@%s' % (user_spec.partition(':')[0], host_spec)
+
+
+class Store(object):
+    """
+    Keeps the history of every finished command in the SQLite database at
+    <path>, with the first <output_limit> bytes of its output.
+
+    Register add() as a finish listener on a Connections object to use it.
+    Rows are written by a thread of their own, a batch to a transaction, so
+    that the job engine never waits on the disk: add() only queues the record,
+    and its output is read from the buffers on the writer thread. Output whose
+    record has been dropped from the history (and its buffers closed) before
+    then is stored as NULL, along with its size. Batches that can't be
+    written (with the database locked for too long, or the disk full) are
+    reported through <error_output> and dropped, and the writer carries on.
+    """
+
+    def __init__(self, path, output_limit = 65536,
+        error_output = lambda x: x):
+        self.path = path
+        self.output_limit = output_limit
+        self.error_output = error_output
+        try:
+            db = self._connect()
+            try:
+                db.executescript(SCHEMA)
+            finally:
+                db.close()
+        except sqlite3.Error, e:
+            raise StoreError('Unable to open %s: %s' % (path, e))
+        self._queue = Queue.Queue()
+        self._writer = threading.Thread(target = self._run)
+        self._writer.daemon = True
+        self._writer.start()
+
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout = 10)
+        # Readers (another dyssh, say) don't block the writer, or vice versa.
+        db.execute('PRAGMA journal_mode = WAL')
+        db.text_factory = str
+        return db
+
+
+    def _captured(self, buf, size):
+        """
+        The first <output_limit> bytes of the OutputBuffer <buf>, which held
+        <size> bytes when its command finished.
+        """
+        if buf is None or buf.closed:
+            return None
+        data = buf.read(0, self.output_limit)
+        if buf.closed and len(data) < min(size, self.output_limit):
+            # Closed while being read.
+            return None
+        return sqlite3.Binary(data)
+
+
+    def add(self, host, history):
+        """
+        Store the command in <history>, which has finished on <host>.
+        """
+        output = history['output']
+        stderr = history.get('stderr')
+        self._queue.put((
+            name(host),
+            history['command'],
+            seconds(history['timestamp']),
+            (history.get('timings') or {}).get('command'),
+            history['exitcode'],
+            output,
+            output.size,
+            stderr,
+            stderr.size if stderr is not None else None,
+        ))
+
+
+    def _run(self):
+        db = None
+        try:
+            while True:
+                rows = [self._queue.get()]
+                while rows[-1] is not None:
+                    try:
+                        rows.append(self._queue.get_nowait())
+                    except Queue.Empty:
+                        break
+                done = rows[-1] is None
+                if done:
+                    rows.pop()
+                if rows:
+                    try:
+                        if db is None:
+                            db = self._connect()
+                        self._write(db, rows)
+                    except (sqlite3.Error, IOError, OSError), e:
+                        self.error_output('Unable to write %s command(s) to '
+                            'the history in %s: %s' % (len(rows), self.path,
+                            e))
+                if done:
+                    return
+        finally:
+            if db is not None:
+                db.close()
+
+
+    def _write(self, db, rows):
+        rows = [row[:5] + (self._captured(row[5], row[6]), row[6],
+            self._captured(row[7], row[8]), row[8]) for row in rows]
+        with db:
+            db.executemany('INSERT INTO commands (host, command, started, '
+                'duration, exitcode, output, output_bytes, stderr, '
+                'stderr_bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+    def query(self, host = None, failed = False, limit = 20):
+        """
+        Return the last <limit> commands stored, oldest first, as dicts: for
+        <host> only, if given, and only those that failed, if <failed> is set.
+        Each has the host, command, 'started' (as seconds since the epoch),
+        'timestamp' (the same, as a datetime), duration, exitcode,
+        output_bytes and stderr_bytes.
+        """
+        where = []
+        args = []
+        if host is not None:
+            where.append('host = ?')
+            args.append(name(host))
+        if failed:
+            where.append('exitcode != 0')
+        sql = 'SELECT host, command, started, duration, exitcode, ' \
+            'output_bytes, stderr_bytes FROM commands'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY started DESC LIMIT ?'
+        args.append(limit)
+        db = self._connect()
+        try:
+            db.row_factory = sqlite3.Row
+            rows = [dict(row) for row in db.execute(sql, args)]
+        finally:
+            db.close()
+        for row in rows:
+            row['timestamp'] = datetime.datetime.fromtimestamp(row['started'])
+        rows.reverse()
+        return rows
+
+
+    def close(self):
+        """
+        Write every row still waiting, and stop the writer.
+        """
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
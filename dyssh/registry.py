@@ -0,0 +1,118 @@
+"""
+The list of hosts managed by a Connections object.
+
+The HostRegistry acts like the plain list it replaces, keeping the hosts in the
+order they were added, so that a host's number is its position in the list.
+It also keeps an index of each host's position, so that checking for a host
+doesn't mean scanning the list, and an index of the trigrams (runs of three
+characters) in the host names, so that finding the hosts whose names contain
+a fragment only has to look at the hosts sharing its rarest trigram.
+"""
+
+# Length of the n-grams indexed. Fragments shorter than this are looked up by
+# scanning every host.
+GRAM = 3
+
+
+def _grams(name):
+    """
+    The set of GRAM-character runs in <name>.
+    """
+    return set(name[i:i + GRAM] for i in xrange(len(name) - GRAM + 1))
+
+
+class HostRegistry(object):
+    """
+    An ordered collection of distinct host names, initially <hosts>.
+    """
+
+    def __init__(self, hosts = ()):
+        self._hosts = []
+        # host -> position in _hosts
+        self._positions = {}
+        # trigram -> set of hosts containing it
+        self._grams = {}
+        for host in hosts or ():
+            self.append(host)
+
+
+    def __contains__(self, host):
+        return host in self._positions
+
+
+    def __getitem__(self, idx):
+        return self._hosts[idx]
+
+
+    def __iter__(self):
+        return iter(self._hosts)
+
+
+    def __len__(self):
+        return len(self._hosts)
+
+
+    def __repr__(self):
+        return 'HostRegistry(%r)' % self._hosts
+
+
+    def append(self, host):
+        """
+        Add <host> to the end of the list, unless it is already there.
+        """
+        if host in self._positions:
+            return
+        self._positions[host] = len(self._hosts)
+        self._hosts.append(host)
+        for gram in _grams(host):
+            self._grams.setdefault(gram, set()).add(host)
+
+
+    def remove(self, host):
+        """
+        Take <host> out of the list. The hosts after it move up one place.
+        Raises ValueError if it isn't there.
+        """
+        try:
+            idx = self._positions.pop(host)
+        except KeyError:
+            raise ValueError('%s is not in the host list' % host)
+        del self._hosts[idx]
+        for i in xrange(idx, len(self._hosts)):
+            self._positions[self._hosts[i]] = i
+        for gram in _grams(host):
+            hosts = self._grams[gram]
+            hosts.discard(host)
+            if not hosts:
+                del self._grams[gram]
+
+
+    def index(self, host):
+        """
+        Return the position of <host> in the list. Raises ValueError if it
+        isn't there.
+        """
+        try:
+            return self._positions[host]
+        except KeyError:
+            raise ValueError('%s is not in the host list' % host)
+
+
+    def search(self, fragment):
+        """
+        Return the hosts whose names contain <fragment>, in list order.
+        """
+        if len(fragment) < GRAM:
+            return [h for h in self._hosts if fragment in h]
+        candidates = None
+        for gram in _grams(fragment):
+            hosts = self._grams.get(gram)
+            if not hosts:
+                return []
+            if candidates is None or len(hosts) < len(candidates):
+                candidates = hosts
+        # The rarest trigram narrows things down; the rest of the fragment
+        # still has to be checked.
+        matches = [h for h in candidates if fragment in h]
+        matches.sort(key = self._positions.__getitem__)
+        return matches
@@ -0,0 +1,84 @@
+"""
+Tree distribution of files to large numbers of hosts.
+
+Rather than sending one copy of a file to every host from the local machine,
+the file is uploaded to a few seed hosts, which pass it on to the next tier of
+hosts, which pass it on again, and so on. The local machine's uplink only ever
+carries <fanout> copies, and the number of tiers grows with the logarithm of
+the number of hosts.
+
+The hosts are laid out in the order they were given, breadth first: the first
+<fanout> hosts are the seeds, the next <fanout> are fed by the first seed, and
+so on. If a host can't be reached by relay it is sent the file directly, and
+if it can't be reached at all, its own share of hosts is fed by its parent
+instead.
+"""
+
+import threading
+
+from utils import pool
+
+
+# Most hops to have under way at once. Each one only holds a thread waiting on
+# a remote command, so this can be much larger than 'transfer_concurrency'.
+# Direct uploads (to the seeds, and to hosts that can't be reached by relay)
+# use the local uplink, and are limited separately.
+MAX_HOPS = 64
+
+
+def tree(hosts, fanout):
+    """
+    Return a dict mapping each of <hosts> to the list of hosts it feeds.
+    """
+    children = {}
+    for i, host in enumerate(hosts):
+        first = (i + 1) * fanout
+        children[host] = hosts[first:first + fanout]
+    return children
+
+
+def distribute(hosts, fanout, upload, forward, report = lambda x: x,
+    concurrency = 1):
+    """
+    Send a file to each of <hosts>. upload(<host>) sends it from the local
+    machine, and forward(<parent>, <child>) has <parent> send its copy on to
+    <child>; either should raise an exception if the host doesn't end up with
+    a good copy. Failures are passed to <report>. At most <concurrency>
+    uploads run at once.
+
+    Returns a dict mapping each host to 'direct' or 'relay', depending on how
+    it got the file, or to the exception that stopped it from getting it.
+    """
+    children = tree(hosts, fanout)
+    routes = {}
+    uploads = threading.BoundedSemaphore(max(int(concurrency or 1), 1))
+
+    def send((parent, child)):
+        if parent is not None:
+            try:
+                forward(parent, child)
+                return 'relay'
+            except Exception, e:
+                report('Relay from %s to %s failed (%s); sending directly' % (
+                    parent, child, e))
+        with uploads:
+            upload(child)
+        return 'direct'
+
+    tier = [(None, host) for host in hosts[:fanout]]
+    while tier:
+        results = pool.map_concurrent(send, tier,
+            concurrency = min(len(tier), MAX_HOPS))
+        tier = []
+        for (parent, child), route, exc_info in results:
+            if exc_info:
+                report('Unable to send the file to %s: %s' % (child,
+                    exc_info[1]))
+                routes[child] = exc_info[1]
+                # The host's parent takes over its share.
+                source = parent
+            else:
+                routes[child] = route
+                source = child
+            tier.extend((source, host) for host in children[child])
+    return routes
@@ -0,0 +1,105 @@
+"""
+Name resolution for the hosts, done ahead of connecting.
+
+Left to itself, paramiko looks up each host name inside the handshake, one
+lookup per connection attempt. The Resolver looks up the names of all the
+hosts about to be connected to at once, in parallel, so that a slow resolver
+only costs the time of the slowest lookup, and names that don't resolve are
+reported before any connecting starts. Addresses are kept for 'dns_ttl'
+seconds, so that reconnecting doesn't look them up again, and names that don't
+exist are remembered as such for 'dns_negative_ttl' seconds.
+
+Lookups go through the system's resolver (getaddrinfo), so /etc/hosts and the
+rest of the system's name service configuration apply as usual. That resolver
+doesn't say how long an answer may be kept, so the TTLs are fixed.
+"""
+
+import socket
+import threading
+import time
+
+from utils import pool
+
+
+# getaddrinfo() errors that mean the name doesn't exist, as opposed to the
+# lookup having failed for now.
+NEGATIVE = set(getattr(socket, name) for name in ('EAI_NONAME', 'EAI_NODATA')
+    if hasattr(socket, name))
+
+
+class Resolver(object):
+    """
+    Looks up host names, keeping the answers for <ttl> seconds and the names
+    that don't exist for <negative_ttl> seconds. resolve_all() runs up to
+    <concurrency> lookups at once.
+    """
+
+    def __init__(self, ttl = 300, negative_ttl = 30, concurrency = 20):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.concurrency = concurrency
+        # (<hostname>, <port>) -> (<expiry time>, <addresses> or <error>)
+        self.cache = {}
+        # (<hostname>, <port>) -> how long the last lookup took, in seconds
+        self.durations = {}
+        self._lock = threading.Lock()
+
+
+    def resolve(self, hostname, port):
+        """
+        Return the list of getaddrinfo() tuples to connect to <port> on
+        <hostname> with. Raises socket.gaierror if the name can't be resolved.
+        """
+        key = (hostname, port)
+        with self._lock:
+            expires, answer = self.cache.get(key, (0, None))
+        if time.time() >= expires:
+            started = time.time()
+            try:
+                answer = socket.getaddrinfo(hostname, port, 0,
+                    socket.SOCK_STREAM)
+                ttl = self.ttl
+            except socket.gaierror, e:
+                answer = e
+                ttl = self.negative_ttl if e.args[0] in NEGATIVE else 0
+            self.durations[key] = time.time() - started
+            if ttl:
+                with self._lock:
+                    self.cache[key] = (time.time() + ttl, answer)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+    def resolve_all(self, addresses):
+        """
+        Look up each of the (<hostname>, <port>) pairs in <addresses> in
+        parallel. Returns a dict mapping the pairs that failed to resolve to
+        their errors.
+        """
+        failed = {}
+        results = pool.map_concurrent(lambda a: self.resolve(*a),
+            set(addresses), self.concurrency)
+        for address, _, exc_info in results:
+            if exc_info:
+                failed[address] = exc_info[1]
+        return failed
+
+
+def open_socket(addresses, timeout = None):
+    """
+    Return a socket connected to the first of <addresses> (as returned by
+    Resolver.resolve()) that accepts a connection within <timeout> seconds.
+    Raises socket.error with the last failure if none of them does.
+    """
+    error = socket.error('No addresses to connect to')
+    for family, socktype, proto, _, sockaddr in addresses:
+        sock = socket.socket(family, socktype, proto)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(sockaddr)
+            return sock
+        except socket.error, e:
+            sock.close()
+            error = e
+    raise error
@@ -0,0 +1,283 @@
+"""
+Searching the captured output of every host, for :grep.
+
+The OutputIndex keeps, for each command in the history, the set of words
+(runs of letters and underscores, lower-cased) in its output, and for each
+word the commands it appears in. Digits count as breaks between words: numbers
+make up most of the distinct words in most output, and leaving them out keeps
+the index small and quick to build. Output is indexed as it arrives, so the
+work is spread over the run rather than done at search time. A search takes
+the words that any match of the regular expression has to contain, and only
+reads the output of the commands that have all of them; the rest are ruled
+out without being read again. Expressions with no such words (`\d+`, say)
+read everything, as does any command still running.
+
+Output that was never indexed (from before the index was set up, or with
+standard error kept apart, whose pieces can't be told apart as they arrive)
+is indexed the first time it's searched, as is output that only partly went
+through the index (some of it read during a :join, say).
+"""
+
+import sre_constants
+import sre_parse
+import string
+import threading
+import weakref
+
+
+LETTERS = string.ascii_lowercase + '_'
+
+# Turns everything but (lower-case) letters into spaces, so that the words can
+# be picked out with split(), which is much quicker than a regular expression.
+BREAKS = ''.join(c for c in map(chr, range(256)) if c not in LETTERS)
+WORDS = string.maketrans(BREAKS, ' ' * len(BREAKS))
+
+# Output with words longer than this (encoded or binary data, usually) isn't
+# worth indexing, and is always searched instead.
+MAX_WORD = 64
+
+
+def required_pieces(pattern):
+    """
+    Return the words (lower-cased) that any match of the regular expression
+    <pattern> must contain, as (<word>, <whole>) pairs. <whole> is True if
+    the match must contain it as a word of its own, rather than as part of a
+    longer one.
+    """
+    runs = []
+    _literal_runs(sre_parse.parse(pattern), runs)
+    pieces = []
+    for run in runs:
+        words = run.lower().translate(WORDS).split(' ')
+        for i, word in enumerate(words):
+            if word:
+                # Only the words with a break on either side within the run
+                # are known to be whole.
+                pieces.append((word, 0 < i < len(words) - 1))
+    return pieces
+
+
+def _literal_runs(parsed, runs):
+    """
+    Add the runs of literal text that must appear in any match of the parsed
+    pattern <parsed> to the list <runs>.
+    """
+    run = []
+    for op, av in parsed:
+        if op == sre_constants.LITERAL and av < 256:
+            run.append(chr(av))
+            continue
+        if run:
+            runs.append(''.join(run))
+            run = []
+        if op == sre_constants.SUBPATTERN:
+            _literal_runs(av[-1], runs)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and \
+                av[0] >= 1:
+            _literal_runs(av[2], runs)
+        elif op == sre_constants.BRANCH:
+            # Only what every alternative has in common would be required;
+            # leave it at that.
+            pass
+    if run:
+        runs.append(''.join(run))
+
+
+class _Entry(object):
+    """
+    What the index knows about one command's output.
+    """
+
+    __slots__ = ('ref', 'words', 'partial', 'complete', 'unindexable', 'size')
+
+    def __init__(self, ref):
+        self.ref = ref
+        self.words = set()
+        # The number of bytes of output indexed.
+        self.size = 0
+        # The end of the output so far, if it stopped partway through a word.
+        self.partial = ''
+        self.complete = False
+        self.unindexable = False
+
+
+class OutputIndex(object):
+    """
+    An index of the words in the output of each command in the history.
+
+    Register feed() as an output listener and end() as a finish listener on a
+    Connections object to use it.
+    """
+
+    def __init__(self):
+        # id(<record>) -> _Entry
+        self.entries = {}
+        # word -> set of id(<record>)
+        self.words = {}
+        # Reentrant, as a record can be dropped (and so forgotten) by the
+        # thread holding it.
+        self._lock = threading.RLock()
+
+
+    def _entry(self, history):
+        key = id(history)
+        entry = self.entries.get(key)
+        if entry is None:
+            # The entry goes when the record does.
+            ref = weakref.ref(history, lambda ref: self._forget(key))
+            entry = self.entries[key] = _Entry(ref)
+        return entry
+
+
+    def _forget(self, key):
+        """
+        Drop the record with id <key>, once it has left the history.
+        """
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return
+            for word in entry.words:
+                keys = self.words.get(word)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.words[word]
+
+
+    def _add(self, key, entry, data, final = False):
+        if entry.unindexable:
+            return
+        text = entry.partial + data.lower().translate(WORDS)
+        entry.partial = ''
+        if not final and text[-1:] not in ('', ' '):
+            # Hold back a word that may carry on in the next piece.
+            i = text.rfind(' ') + 1
+            entry.partial = text[i:]
+            text = text[:i]
+        found = set(text.split())
+        new = found - entry.words
+        if any(len(word) > MAX_WORD for word in new):
+            entry.unindexable = True
+            return
+        entry.words |= new
+        for word in new:
+            self.words.setdefault(word, set()).add(key)
+
+
+    def feed(self, host, history, data):
+        """
+        Index a piece of output from the command in <history>.
+        """
+        if history.get('stderr') is not None:
+            return
+        with self._lock:
+            entry = self._entry(history)
+            entry.size += len(data)
+            self._add(id(history), entry, data)
+
+
+    def end(self, host, history):
+        """
+        Index the end of the output of the command in <history>.
+        """
+        if history.get('stderr') is not None:
+            return
+        with self._lock:
+            entry = self._entry(history)
+            self._add(id(history), entry, '', final = True)
+            entry.complete = True
+
+
+    def _index(self, history):
+        """
+        Index the whole of the output of the finished command in <history>.
+        """
+        with self._lock:
+            key = id(history)
+            entry = self.entries.get(key)
+            if entry is not None:
+                # Start again: what came in before may be incomplete.
+                self._forget(key)
+            entry = self._entry(history)
+        for buf in (history['output'], history.get('stderr')):
+            if buf is None:
+                continue
+            for chunk in buf.iterchunks():
+                with self._lock:
+                    self._add(key, entry, chunk)
+            with self._lock:
+                self._add(key, entry, '', final = True)
+        entry.size = history['output'].size
+        entry.complete = True
+
+
+    def _matches(self, word, whole):
+        """
+        The ids of the records with <word> in their output.
+        """
+        if whole:
+            return self.words.get(word, set())
+        keys = set()
+        for w, k in self.words.iteritems():
+            if word in w:
+                keys |= k
+        return keys
+
+
+    def candidates(self, items, pattern):
+        """
+        Return the (<host>, <history>) pairs in <items> whose output could
+        match the regular expression <pattern>.
+        """
+        items = list(items)
+        for host, history in items:
+            if history['exitcode'] is not None:
+                entry = self.entries.get(id(history))
+                if entry is None or not entry.complete or \
+                        entry.size != history['output'].size:
+                    self._index(history)
+        pieces = required_pieces(pattern)
+        if not pieces:
+            return items
+        with self._lock:
+            keys = None
+            # The longest words first: they rule out the most.
+            for word, whole in sorted(pieces, key = lambda p: -len(p[0])):
+                found = self._matches(word, whole)
+                keys = found if keys is None else keys & found
+                if not keys:
+                    break
+            out = []
+            for host, history in items:
+                entry = self.entries.get(id(history))
+                if entry is None or not entry.complete or \
+                        entry.unindexable or id(history) in keys:
+                    out.append((host, history))
+        return out
+
+
+def search(items, regex, index = None):
+    """
+    Search the output of each of the (<host>, <history>) pairs in <items> for
+    lines matching the compiled regular expression <regex>, using <index> (an
+    OutputIndex) to skip those that can't match. Returns a list of (<host>,
+    <history>, <matches>) tuples, where <matches> is a list of (<stream>,
+    <line number>, <line>) tuples, for the commands with any matches.
+    """
+    if index is not None:
+        items = index.candidates(items, regex.pattern)
+    results = []
+    for host, history in items:
+        matches = []
+        for stream in ('output', 'stderr'):
+            buf = history.get(stream)
+            if buf is None:
+                continue
+            for lineno, line in enumerate(buf.iterlines()):
+                line = line.rstrip('\r\n')
+                if regex.search(line):
+                    matches.append((stream, lineno + 1, line))
+        if matches:
+            results.append((host, history, matches))
+    return results
@@ -0,0 +1,252 @@
+"""
+Persistent shells: one long-lived shell on a pseudo-terminal per host, which
+each command is written to in turn, instead of a new session channel for every
+command.
+
+With the 'persistent_shell' option set, the first command on a host starts a
+shell there and sets it up. Every command after that costs a single write to
+the channel. The working directory and environment variables are sent once,
+and again only when they change, so anything a command does to the shell's
+state (a `cd`, an `export`) carries over to the next command, as it would in
+an interactive session.
+
+Each command is followed by a line that prints a marker with a random token
+and the command's exit status, which is how the end of its output is found.
+The marker is printed with printf, so the token never appears next to the rest
+of the marker in the command text itself.
+
+Commands that won't survive a terminal's line discipline (very long lines, or
+control characters) are run on a channel of their own as usual. So are
+commands sent to a host whose shell is still busy with an earlier one.
+"""
+
+import re
+import socket
+import threading
+import uuid
+
+import jobs
+
+
+# Longest line that can be written to a terminal in canonical mode. The kernel
+# buffers 4096 bytes of an unfinished line and drops the rest.
+MAX_LINE = 4000
+
+# Control characters that may appear in a command; any other would be acted on
+# by the terminal rather than passed to the shell.
+ALLOWED_CONTROL = '\t\n'
+
+MARKER = "printf '__dyssh_%%s_%%d__\\n' %s \"$?\"\n"
+
+# Run once when a shell starts: no echo, no prompts, no line editing and no
+# history expansion, so that all that comes back is the commands' output.
+SETUP = 'stty -echo 2>/dev/null; set +o emacs 2>/dev/null; ' \
+    'set +o vi 2>/dev/null; set +H 2>/dev/null; PS1=; PS2=; PROMPT_COMMAND=\n'
+
+
+def suitable(command):
+    """
+    Whether <command> can be written to a shell's terminal as it is.
+    """
+    for line in command.split('\n'):
+        if len(line) > MAX_LINE:
+            return False
+    return not any(c < ' ' and c not in ALLOWED_CONTROL for c in command)
+
+
+class Shell(object):
+    """
+    A shell running on a pseudo-terminal over a session channel of the
+    paramiko Transport <transport>.
+    """
+
+    def __init__(self, transport):
+        self.chan = transport.open_session()
+        self.chan.get_pty()
+        self.chan.exec_command('exec "${SHELL:-/bin/sh}"')
+        self.stdin = self.chan.makefile('wb', -1)
+        self.started = False
+        self.busy = False
+        self._lock = threading.Lock()
+        # The working directory and environment last sent to the shell.
+        self.directory = None
+        self.envvars = {}
+
+
+    def alive(self):
+        return not (self.chan.closed or self.chan.eof_received)
+
+
+    def acquire(self):
+        """
+        Claim the shell for a command. Returns False if it is busy.
+        """
+        with self._lock:
+            if self.busy:
+                return False
+            self.busy = True
+            return True
+
+
+    def release(self):
+        with self._lock:
+            self.busy = False
+
+
+    def _settings(self, settings):
+        """
+        The lines that bring the shell's working directory and environment
+        into line with <settings>, a dict of config options.
+        """
+        script = ''
+        directory = settings.get('working_directory')
+        if directory and directory != self.directory:
+            script += 'cd %s\n' % directory
+            self.directory = directory
+        envvars = settings.get('envvars') or {}
+        for k in self.envvars:
+            if k not in envvars:
+                script += 'unset %s\n' % k
+        for k, v in envvars.items():
+            if self.envvars.get(k) != v:
+                script += settings.get('envvar_format', '') % {
+                    'key': k,
+                    'value': v,
+                }
+        self.envvars = dict(envvars)
+        return script
+
+
+    def run(self, host, command, settings, history):
+        """
+        Send <command> to the shell, which must have been acquire()d, and
+        return the ShellJob that collects its output into <history>.
+        """
+        script = ''
+        skip = None
+        if not self.started:
+            # Everything up to this marker (the echo of the setup line, a
+            # login banner) is thrown away.
+            skip = uuid.uuid4().hex
+            script += SETUP + MARKER % skip
+            self.started = True
+        token = uuid.uuid4().hex
+        script += self._settings(settings)
+        script += '{ %s\n}; %s' % (command, MARKER % token)
+        job = ShellJob(host, self, history, token, skip)
+        self.chan.sendall(script)
+        return job
+
+
+    def close(self):
+        self.chan.close()
+
+
+def _marker(token):
+    return re.compile(r'__dyssh_%s_(\d+)__\r?\n' % token)
+
+
+class ShellJob(jobs.Job):
+    """
+    A command running in the Shell <shell>, which ends at the marker carrying
+    <token>. Output before the marker carrying <skip>, if given, is thrown
+    away.
+    """
+
+    def __init__(self, host, shell, history, token, skip = None):
+        jobs.Job.__init__(self, host, shell.chan, history)
+        self.shell = shell
+        self.prefix = '__dyssh_%s_' % token
+        self.marker = _marker(token)
+        self.skip = skip and _marker(skip)
+        self.skip_prefix = skip and '__dyssh_%s_' % skip
+        self.pending = ''
+        self.exitcode = None
+
+
+    def _held(self, data, prefix):
+        """
+        The number of bytes at the end of <data> that could be the start of
+        <prefix>, and so have to wait for more data before being passed on.
+        """
+        i = data.find(prefix)
+        if i >= 0:
+            return len(data) - i
+        for n in range(min(len(data), len(prefix) - 1), 0, -1):
+            if data.endswith(prefix[:n]):
+                return n
+        return 0
+
+
+    def _parse(self, data):
+        """
+        Add <data> to the output, leaving out the markers, and return the part
+        of it that belongs to the command.
+        """
+        data = self.pending + data
+        self.pending = ''
+        if self.skip:
+            m = self.skip.search(data)
+            if not m:
+                held = self._held(data, self.skip_prefix)
+                self.pending = data[len(data) - held:]
+                return ''
+            data = data[m.end():]
+            self.skip = None
+        m = self.marker.search(data)
+        if m:
+            self.exitcode = int(m.group(1))
+            data = data[:m.start()]
+        else:
+            held = self._held(data, self.prefix)
+            self.pending = data[len(data) - held:]
+            data = data[:len(data) - held]
+        if data:
+            self.history['output'].write(data)
+        return data
+
+
+    def read(self):
+        chan = self.chan
+        data = ''
+        for ready, recv in ((chan.recv_ready, chan.recv),
+                (chan.recv_stderr_ready, chan.recv_stderr)):
+            if ready():
+                try:
+                    data += recv(jobs.READ_SIZE)
+                except socket.timeout:
+                    continue
+        data = self._parse(data)
+        if self.exitcode is not None:
+            self.eof = True
+        elif not (chan.recv_ready() or chan.recv_stderr_ready()) and \
+                (chan.eof_received or chan.closed):
+            # The shell itself has exited; whatever was held back is output
+            # after all.
+            if self.pending and not self.skip:
+                self.history['output'].write(self.pending)
+                data += self.pending
+            self.pending = ''
+            self.eof = True
+        return data
+
+
+    def done(self):
+        if self.exitcode is not None:
+            return True
+        return self.eof and self.chan.exit_status_ready()
+
+
+    def finish(self, exitcode = None):
+        """
+        Record the exit code and hand the shell back. If the command was
+        stopped, or took the shell down with it, the shell is closed.
+        """
+        if exitcode is None:
+            exitcode = self.exitcode
+            if exitcode is None:
+                exitcode = self.chan.recv_exit_status()
+        if self.exitcode is None:
+            self.shell.close()
+        self.history['exitcode'] = exitcode
+        self.shell.release()
@@ -0,0 +1,430 @@
+"""
+Delta synchronisation of files and directory trees to the remote hosts, in the
+manner of rsync.
+
+Before anything is sent, one call to each host reports the size of every
+target file, and the SHA-1 digest of those whose size already matches. Files
+that are identical are skipped. Small files that differ are copied whole with
+Connections.put_file. For larger ones, the host sends a signature of its copy
+(a weak rolling checksum and an MD5 digest for each block), the blocks it
+already has are found in the local file by rolling the weak checksum along it
+one byte at a time, and only the instructions to rebuild the file from those
+blocks plus the data in between are sent back. The host assembles the new file
+beside the old one and only moves it into place if its digest matches the
+local file.
+
+The remote half of the work is done by a short Python script, run with
+whichever of python3, python and python2 the host has. Hosts without any of
+them fall back to comparing sizes and sha1sum digests, and copying whole files.
+"""
+
+import hashlib
+import math
+import mmap
+import os
+import pipes
+import posixpath
+import struct
+import threading
+import zlib
+
+import transfer
+
+
+# Files smaller than this are always sent whole.
+DELTA_THRESHOLD = 128 * 1024
+
+MIN_BLOCK = 1024
+MAX_BLOCK = 65536
+
+# Largest piece of literal data sent in a single instruction.
+LITERAL_SIZE = 1024 * 1024
+
+# Modulus of the Adler-32 checksum.
+ADLER_BASE = 65521
+
+HELPER = r'''
+import hashlib, os, struct, sys, zlib
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+inp = getattr(sys.stdin, 'buffer', sys.stdin)
+def read(n):
+    data = b''
+    while len(data) < n:
+        d = inp.read(n - len(data))
+        if not d:
+            raise EOFError
+        data += d
+    return data
+def sha1(path):
+    h = hashlib.sha1()
+    f = open(path, 'rb')
+    for d in iter(lambda: f.read(1048576), b''):
+        h.update(d)
+    f.close()
+    return h.hexdigest()
+def sums():
+    args = inp.read().split(b'\0')
+    for size, path in zip(args[0::2], args[1::2]):
+        path = path.decode('utf-8')
+        try:
+            st = os.stat(path)
+        except OSError:
+            out.write(b'- -\n')
+            continue
+        digest = '-'
+        if st.st_size == int(size):
+            try:
+                digest = sha1(path)
+            except IOError:
+                pass
+        out.write(('%d %s\n' % (st.st_size, digest)).encode('ascii'))
+def sig(path, block):
+    f = open(path, 'rb')
+    for d in iter(lambda: f.read(block), b''):
+        out.write(struct.pack('>I', zlib.adler32(d) & 0xffffffff))
+        out.write(hashlib.md5(d).digest())
+def patch(path, block, digest, tmp):
+    src = open(path, 'rb')
+    dst = open(tmp, 'wb')
+    h = hashlib.sha1()
+    while True:
+        op = read(1)
+        if op == b'C':
+            first, count = struct.unpack('>II', read(8))
+            src.seek(first * block)
+            for i in range(count):
+                d = src.read(block)
+                dst.write(d)
+                h.update(d)
+        elif op == b'D':
+            d = read(struct.unpack('>I', read(4))[0])
+            dst.write(d)
+            h.update(d)
+        else:
+            break
+    dst.close()
+    if h.hexdigest() != digest:
+        os.remove(tmp)
+        sys.exit(3)
+    os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+    os.rename(tmp, path)
+mode = sys.argv[1]
+if mode == 'sums':
+    sums()
+elif mode == 'sig':
+    sig(sys.argv[2], int(sys.argv[3]))
+elif mode == 'patch':
+    patch(sys.argv[2], int(sys.argv[3]), sys.argv[4], sys.argv[5])
+'''
+
+
+class HelperUnavailable(Exception):
+    """
+    The remote host has no Python to run the sync helper with.
+    """
+
+
+def _command(*args):
+    """
+    The shell command that runs the helper on a remote host with <args>.
+    """
+    return ('for p in python3 python python2; do command -v $p >/dev/null '
+        '2>&1 && exec $p -c %s %s; done; exit 127' % (pipes.quote(HELPER),
+        ' '.join(pipes.quote(str(a)) for a in args)))
+
+
+def _helper(client, args, stdin = ()):
+    """
+    Run the helper over the paramiko SSHClient <client>, feeding it the
+    strings in <stdin>. Returns its exit status and output.
+    """
+    chan = client.get_transport().open_session()
+    try:
+        chan.exec_command(_command(*args))
+        for data in stdin:
+            chan.sendall(data)
+        chan.shutdown_write()
+        out = chan.makefile('rb').read()
+        status = chan.recv_exit_status()
+        if status == 127:
+            raise HelperUnavailable()
+        return status, out
+    finally:
+        chan.close()
+
+
+def block_size(size):
+    """
+    The block size to use for a file of <size> bytes: about the square root of
+    the size, which balances the length of the signature against the amount of
+    data resent around each change.
+    """
+    return max(MIN_BLOCK, min(MAX_BLOCK, int(math.sqrt(size)) // 1024 * 1024))
+
+
+def _weak(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+def delta(data, signature, block):
+    """
+    Work out how to rebuild the string (or memory map) <data> from a remote
+    file with the given <signature>, made with blocks of <block> bytes.
+    Returns a list of ('copy', <first_block>, <count>) and ('data', <offset>,
+    <length>) instructions.
+    """
+    blocks = {}
+    for i in xrange(0, len(signature), 20):
+        weak, strong = struct.unpack('>I', signature[i:i + 4])[0], \
+            signature[i + 4:i + 20]
+        blocks.setdefault(weak, {}).setdefault(strong, i // 20)
+    count = len(signature) // 20
+
+    ops = []
+
+    def literal(start, end):
+        if end > start:
+            ops.append(('data', start, end - start))
+
+    def copy(idx):
+        if ops and ops[-1][0] == 'copy' and \
+                ops[-1][1] + ops[-1][2] == idx:
+            ops[-1] = ('copy', ops[-1][1], ops[-1][2] + 1)
+        else:
+            ops.append(('copy', idx, 1))
+
+    size = len(data)
+    pos = start = 0
+    weak = None
+    while pos + block <= size:
+        if weak is None:
+            weak = _weak(data[pos:pos + block])
+            a, b = weak & 0xffff, weak >> 16
+        if weak in blocks:
+            idx = blocks[weak].get(hashlib.md5(data[pos:pos + block]).digest())
+            if idx is not None:
+                literal(start, pos)
+                copy(idx)
+                pos = start = pos + block
+                weak = None
+                continue
+        if pos + block == size:
+            break
+        # Roll the checksum on by one byte.
+        old, new = ord(data[pos]), ord(data[pos + block])
+        a = (a - old + new) % ADLER_BASE
+        b = (b + a - 1 - block * old) % ADLER_BASE
+        weak = (b << 16) | a
+        pos += 1
+
+    # The remote file's last block may be a short one.
+    tail = size - start
+    if count and 0 < tail < block:
+        idx = blocks.get(_weak(data[start:]), {}).get(
+            hashlib.md5(data[start:]).digest())
+        if idx == count - 1:
+            copy(idx)
+            start = size
+    literal(start, size)
+    return ops
+
+
+def encode(ops, data):
+    """
+    Iterate over the instructions in <ops> encoded for the remote helper,
+    taking literal data from <data>.
+    """
+    for op, first, n in ops:
+        if op == 'copy':
+            yield 'C' + struct.pack('>II', first, n)
+            continue
+        for offset in xrange(first, first + n, LITERAL_SIZE):
+            piece = data[offset:min(first + n, offset + LITERAL_SIZE)]
+            yield 'D' + struct.pack('>I', len(piece)) + piece
+    yield 'E'
+
+
+class Tree(object):
+    """
+    The local side of a sync of <source> (a file or a directory) to <target>:
+    the files to send, with their sizes and digests, and the deltas worked out
+    so far. The same Tree is shared by every host, so each file is only read
+    and hashed once, and hosts with identical copies of a file share a delta.
+    """
+
+    def __init__(self, source, target):
+        self.files = []
+        if os.path.isdir(source):
+            for root, dirs, names in os.walk(source):
+                dirs.sort()
+                rel = os.path.relpath(root, source)
+                for name in sorted(names):
+                    path = os.path.join(root, name)
+                    if rel == '.':
+                        remote = posixpath.join(target, name)
+                    else:
+                        remote = posixpath.join(target,
+                            *(rel.split(os.sep) + [name]))
+                    self._add(path, remote)
+        else:
+            self._add(source, target)
+        self.total = sum(f[2] for f in self.files)
+        self._deltas = {}
+        self._lock = threading.Lock()
+
+
+    def _add(self, path, remote):
+        self.files.append((path, remote, os.path.getsize(path),
+            transfer.sha1_file(path)))
+
+
+    def delta(self, path, signature, block):
+        """
+        Return the instructions for rebuilding <path> from a remote copy with
+        <signature>, along with the encoded size of the instructions.
+        """
+        key = (path, hashlib.sha1(signature).digest())
+        with self._lock:
+            if key not in self._deltas:
+                with open(path, 'rb') as f:
+                    data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+                    try:
+                        ops = delta(data, signature, block)
+                    finally:
+                        data.close()
+                size = 1
+                for op, first, n in ops:
+                    if op == 'copy':
+                        size += 9
+                    else:
+                        size += n + 5 * (n // LITERAL_SIZE + 1)
+                self._deltas[key] = (ops, size)
+            return self._deltas[key]
+
+
+class Result(object):
+    """
+    Counts of what a sync did on one host.
+    """
+
+    def __init__(self):
+        self.unchanged = 0
+        self.patched = 0
+        self.copied = 0
+        # Bytes that crossed the network, in either direction.
+        self.transferred = 0
+
+
+def _remote_sums(client, files):
+    """
+    Ask the host for the size of each of the remote <files>, and the SHA-1
+    digest of those of the same size as the local file. Returns a list of
+    (<size>, <digest>) pairs, with None for anything missing.
+    """
+    args = []
+    for path, remote, size, digest in files:
+        args.extend([str(size), remote])
+    status, out = _helper(client, ['sums'], ['\0'.join(args)])
+    sums = []
+    for line in out.splitlines():
+        size, digest = line.split()
+        sums.append((None if size == '-' else int(size),
+            None if digest == '-' else digest))
+    if status != 0 or len(sums) != len(files):
+        raise IOError('Unable to read the remote files')
+    return sums
+
+
+def _stat_sums(sftp, remote_sha1, files):
+    """
+    As _remote_sums(), for hosts without the helper.
+    """
+    sums = []
+    for path, remote, size, digest in files:
+        try:
+            remote_size = sftp.stat(remote).st_size
+        except IOError:
+            sums.append((None, None))
+            continue
+        sums.append((remote_size,
+            remote_sha1(remote) if remote_size == size else None))
+    return sums
+
+
+def _makedirs(sftp, path, made):
+    """
+    Create the remote directory <path> and any missing parents, remembering
+    the ones that exist in the set <made>.
+    """
+    if not path or path in made:
+        return
+    try:
+        sftp.stat(path)
+    except IOError:
+        _makedirs(sftp, posixpath.dirname(path), made)
+        sftp.mkdir(path)
+    made.add(path)
+
+
+def push(tree, client, sftp, put, remote_sha1, callback = None,
+    threshold = DELTA_THRESHOLD):
+    """
+    Bring the remote copies of the files in <tree> up to date on one host,
+    over the SSHClient <client> and SFTPClient <sftp>. Whole files are sent
+    with put(<local>, <remote>), and remote_sha1(<remote>) is used to check
+    files when the host can't run the helper. <callback> is called with the
+    bytes dealt with so far and the total. Returns a Result.
+    """
+    result = Result()
+    try:
+        sums = _remote_sums(client, tree.files)
+        helper = True
+    except HelperUnavailable:
+        sums = _stat_sums(sftp, remote_sha1, tree.files)
+        helper = False
+
+    made = set()
+    done = 0
+    for (path, remote, size, digest), (remote_size, remote_digest) in \
+            zip(tree.files, sums):
+        if remote_size == size and remote_digest == digest:
+            result.unchanged += 1
+        elif helper and remote_size >= threshold and size >= threshold and \
+                _patch(tree, client, path, remote, size, digest, result):
+            result.patched += 1
+        else:
+            if remote_size is None:
+                _makedirs(sftp, posixpath.dirname(remote), made)
+            put(path, remote)
+            result.copied += 1
+            result.transferred += size
+        done += size
+        if callback:
+            callback(done, tree.total)
+    return result
+
+
+def _patch(tree, client, path, remote, size, digest, result):
+    """
+    Send the changes to one file. Returns False if the host couldn't rebuild
+    the file, in which case it should be sent whole.
+    """
+    block = block_size(size)
+    status, signature = _helper(client, ['sig', remote, block])
+    if status != 0:
+        return False
+    ops, encoded = tree.delta(path, signature, block)
+    if encoded >= size:
+        return False
+    tmp = '%s.%s.dyssh-sync' % (remote, digest[:8])
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            status, out = _helper(client, ['patch', remote, block, digest,
+                tmp], encode(ops, data))
+        finally:
+            data.close()
+    if status != 0:
+        return False
+    result.transferred += len(signature) + encoded
+    return True
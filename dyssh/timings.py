@@ -0,0 +1,129 @@
+"""
+Per-host timings of each phase of connecting, running commands and moving
+files, so that a slow batch can be pinned on the part that was slow.
+
+The phases, in the order they happen:
+
+    dns         Looking up the host's name (the last real lookup; cached
+                answers cost nothing).
+    tcp         Opening the TCP connection.
+    handshake   The SSH handshake: key exchange and authentication.
+    sftp        Opening an SFTP session.
+    channel     Opening a session and starting the command on it.
+    first_byte  From starting the command to its first output.
+    command     From starting the command to its exit.
+    put, get,
+    sync        A whole upload, download or :sync to the host.
+
+Only the latest time of each phase is kept for each host.
+"""
+
+import threading
+
+
+PHASES = ('dns', 'tcp', 'handshake', 'sftp', 'channel', 'first_byte',
+    'command', 'put', 'get', 'sync')
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, p):
+    """
+    The nearest-rank <p>th percentile of the sorted list <values>.
+    """
+    rank = int(round(p / 100.0 * len(values)))
+    return values[min(len(values) - 1, max(0, rank - 1))]
+
+
+class Timings(object):
+    """
+    The latest duration of each phase for each host. If <listener> is set, it
+    is called as listener(<host>, <phase>, <seconds>) for each new time, so
+    that a worker process can pass them on.
+    """
+
+    def __init__(self, listener = None):
+        self.listener = listener
+        # phase -> host -> seconds
+        self.phases = {}
+        self._lock = threading.Lock()
+
+
+    def record(self, host, phase, seconds):
+        with self._lock:
+            self.phases.setdefault(phase, {})[host] = seconds
+        if self.listener:
+            self.listener(host, phase, seconds)
+
+
+    def forget(self, host):
+        """
+        Drop the times recorded for <host>.
+        """
+        with self._lock:
+            for hosts in self.phases.values():
+                hosts.pop(host, None)
+
+
+    def host(self, host):
+        """
+        Return a dict of the times recorded for <host>, by phase.
+        """
+        with self._lock:
+            return dict((phase, hosts[host])
+                for phase, hosts in self.phases.items() if host in hosts)
+
+
+    def _phases(self):
+        known = [p for p in PHASES if p in self.phases]
+        return known + sorted(p for p in self.phases if p not in PHASES)
+
+
+    def slowest(self, phase, n = 5):
+        """
+        Return up to <n> (<host>, <seconds>) pairs for the slowest hosts in
+        <phase>, slowest first.
+        """
+        with self._lock:
+            items = self.phases.get(phase, {}).items()
+        items.sort(key = lambda item: item[1], reverse = True)
+        return items[:n]
+
+
+    def summary(self, slowest = 3):
+        """
+        Return a list with a dict for each phase that has been timed, giving
+        the number of hosts timed, the mean, percentiles and maximum, and the
+        <slowest> slowest hosts.
+        """
+        r = []
+        for phase in self._phases():
+            with self._lock:
+                values = sorted(self.phases[phase].values())
+            if not values:
+                continue
+            stats = {
+                'phase': phase,
+                'count': len(values),
+                'mean': sum(values) / len(values),
+                'max': values[-1],
+                'slowest': self.slowest(phase, slowest),
+            }
+            for p in PERCENTILES:
+                stats['p%s' % p] = percentile(values, p)
+            r.append(stats)
+        return r
+
+
+    def as_dict(self):
+        """
+        Everything recorded, as a dict that can be dumped as JSON: the summary
+        of each phase, and the time of every host.
+        """
+        with self._lock:
+            hosts = dict((phase, dict(times))
+                for phase, times in self.phases.items())
+        return {
+            'summary': self.summary(),
+            'hosts': hosts,
+        }
@@ -0,0 +1,283 @@
+"""
+File transfers between the local machine and the remote hosts.
+
+Files are moved in chunks with many SFTP requests in flight at once, so that
+long round trips don't throttle the transfer. Data is written to a partial
+file named after the size and modification time of the source. If a transfer
+is interrupted, the partial file records how far it got, and the next attempt
+at the same file resumes from there. Every file is checked against a SHA-1
+digest of the source before it is moved into place.
+"""
+
+import collections
+import hashlib
+import os
+import threading
+import time
+
+from paramiko.sftp import CMD_DATA, CMD_READ, CMD_STATUS
+
+
+# paramiko's largest SFTP read or write request.
+CHUNK_SIZE = 32768
+
+# Number of read requests kept in flight during a download. Each one that is
+# answered is replaced straight away, so the window slides rather than being
+# sent and drained in turn.
+WINDOW = 64
+
+PARTIAL_SUFFIX = '.dyssh-part'
+
+
+class ChecksumError(IOError):
+    """
+    A transferred file doesn't match its source.
+    """
+
+
+def _megabytes(n):
+    return n / (1024.0 * 1024.0)
+
+
+class Progress(object):
+    """
+    Keeps count of the bytes moved by a fan-out transfer to or from many hosts
+    at once. Each host's progress is reported through <report> (a function
+    taking a message) every time it passes another <step> percent, and
+    summary() gives the throughput of the whole transfer.
+    """
+
+    def __init__(self, report = lambda x: x, step = 25):
+        self.report = report
+        self.step = step
+        self.started = time.time()
+        self.transferred = {}
+        self._reported = {}
+        self._lock = threading.Lock()
+
+
+    def callback(self, host, verb = 'Transferred'):
+        """
+        Return a function in the form paramiko's SFTP callbacks take,
+        fnc(<bytes_so_far>, <total_bytes>), that records progress for <host>.
+        """
+        def update(done, total):
+            with self._lock:
+                self.transferred[host] = done
+                if not total:
+                    return
+                milestone = done * 100 // total // self.step * self.step
+                if milestone <= self._reported.get(host, 0):
+                    return
+                self._reported[host] = milestone
+            self.report('%s %s%% (%.1f of %.1f MB) on %s' % (verb, milestone,
+                _megabytes(done), _megabytes(total), host))
+        return update
+
+
+    def summary(self, hosts):
+        """
+        Describe the total amount moved and the overall throughput.
+        """
+        elapsed = max(time.time() - self.started, 1e-6)
+        total = sum(self.transferred.values())
+        return '%.1f MB across %s host(s) in %.1fs (%.1f MB/s)' % (
+            _megabytes(total), hosts, elapsed, _megabytes(total) / elapsed)
+
+
+def _partial_name(path, size, mtime):
+    """
+    The name of the partial file used while transferring a source of <size>
+    bytes, last modified at <mtime>, to <path>. A changed source gets a new
+    partial file rather than resuming an old one.
+    """
+    return '%s.%x-%x%s' % (path, size, int(mtime), PARTIAL_SUFFIX)
+
+
+def _hash_file(f, digest, size):
+    """
+    Feed the first <size> bytes of the open file <f> to <digest>.
+    """
+    f.seek(0)
+    while size > 0:
+        data = f.read(min(size, 1024 * 1024))
+        if not data:
+            break
+        digest.update(data)
+        size -= len(data)
+
+
+def sha1_file(path):
+    """
+    Return the SHA-1 hex digest of the local file at <path>.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        _hash_file(f, digest, os.path.getsize(path))
+    return digest.hexdigest()
+
+
+def _verify(digest, path, remote_digest, report):
+    """
+    Compare <digest> with the SHA-1 of the remote file <path>, as given by
+    remote_digest(<path>). Raises ChecksumError if they differ.
+    """
+    theirs = remote_digest(path) if remote_digest else None
+    if theirs is None:
+        report('Unable to verify the checksum of %s' % path)
+    elif theirs != digest.hexdigest():
+        raise ChecksumError('Checksum mismatch for %s' % path)
+
+
+def put(sftp, source, target, callback = None, remote_digest = None,
+    report = lambda x: x):
+    """
+    Upload the local file <source> to <target> over the SFTPClient <sftp>,
+    resuming an earlier, interrupted upload if there is one. <callback> is
+    called with the bytes uploaded so far and the total.
+
+    remote_digest(<path>) should return the SHA-1 hex digest of a remote file,
+    or None if it can't be worked out (in which case <report> is told the
+    upload couldn't be verified).
+    """
+    st = os.stat(source)
+    partial = _partial_name(target, st.st_size, st.st_mtime)
+    try:
+        offset = sftp.stat(partial).st_size
+    except IOError:
+        offset = 0
+    if offset > st.st_size:
+        offset = 0
+
+    digest = hashlib.sha1()
+    with open(source, 'rb') as f:
+        _hash_file(f, digest, offset)
+        remote = sftp.open(partial, 'r+b' if offset else 'wb')
+        try:
+            remote.seek(offset)
+            remote.set_pipelined(True)
+            done = offset
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                remote.write(data)
+                digest.update(data)
+                done += len(data)
+                if callback:
+                    callback(done, st.st_size)
+        finally:
+            remote.close()
+
+    try:
+        _verify(digest, partial, remote_digest, report)
+    except ChecksumError:
+        sftp.remove(partial)
+        raise
+    try:
+        sftp.posix_rename(partial, target)
+    except IOError:
+        # The server doesn't support posix-rename@openssh.com, and plain
+        # SFTP renames won't replace an existing file.
+        try:
+            sftp.remove(target)
+        except IOError:
+            pass
+        sftp.rename(partial, target)
+
+
+class _Responses(object):
+    """
+    Collects the answers to a download's read requests, as paramiko hands
+    them over, until they are taken in order by _read_window().
+    """
+
+    def __init__(self):
+        self.answers = {}
+
+
+    def _async_response(self, t, msg, num):
+        self.answers[num] = (t, msg)
+
+
+def _read_window(sftp, remote, path, offset, size, window):
+    """
+    Read the SFTPFile <remote>, open on the remote file <path>, from <offset>
+    up to <size> over the SFTPClient <sftp>, with <window> read requests kept
+    in flight, and generate the data in order, a chunk at a time.
+
+    paramiko's own readv() only sends the requests it is given, so reading a
+    big file a window at a time would empty the pipe at the end of each one.
+    This sends a new request as each answer is taken instead, using the same
+    request machinery as readv().
+    """
+    responses = _Responses()
+    pending = collections.deque()
+    sent = offset
+    while offset < size:
+        while sent < size and len(pending) < window:
+            n = min(CHUNK_SIZE, size - sent)
+            num = sftp._async_request(responses, CMD_READ, remote.handle,
+                long(sent), int(n))
+            pending.append((num, n))
+            sent += n
+        num, n = pending.popleft()
+        while num not in responses.answers:
+            sftp._read_response()
+        t, msg = responses.answers.pop(num)
+        if t == CMD_STATUS:
+            try:
+                sftp._convert_status(msg)
+            except EOFError:
+                pass
+            data = ''
+        elif t == CMD_DATA:
+            data = msg.get_string()
+        else:
+            raise IOError('Unexpected answer to a read request')
+        if len(data) != n:
+            raise IOError('%s changed during the download' % path)
+        offset += n
+        yield data
+
+
+def get(sftp, source, target, callback = None, remote_digest = None,
+    report = lambda x: x, window = WINDOW):
+    """
+    Download the remote file <source> to the local path <target> over the
+    SFTPClient <sftp>, resuming an earlier, interrupted download if there is
+    one. Up to <window> read requests are kept in flight at once. The other
+    arguments are as for put().
+    """
+    st = sftp.stat(source)
+    partial = _partial_name(target, st.st_size, st.st_mtime)
+    try:
+        offset = os.path.getsize(partial)
+    except os.error:
+        offset = 0
+    if offset > st.st_size:
+        offset = 0
+
+    digest = hashlib.sha1()
+    with open(partial, 'r+b' if offset else 'wb') as f:
+        _hash_file(f, digest, offset)
+        f.seek(offset)
+        f.truncate()
+        remote = sftp.open(source, 'rb')
+        try:
+            for data in _read_window(sftp, remote, source, offset,
+                    st.st_size, window):
+                f.write(data)
+                digest.update(data)
+                offset += len(data)
+                if callback:
+                    callback(offset, st.st_size)
+        finally:
+            remote.close()
+
+    try:
+        _verify(digest, source, remote_digest, report)
+    except ChecksumError:
+        os.remove(partial)
+        raise
+    os.rename(partial, target)
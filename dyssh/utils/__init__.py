@@ -3,4 +3,5 @@ Utility sub-modules and monkey patches that don't directly relate to how the
 rest of the program operates.
 """
 
+import pool
 import terminal
@@ -0,0 +1,147 @@
+"""
+A small, bounded pool of worker threads for fanning blocking calls (SSH
+handshakes, SFTP transfers, name lookups) out across many hosts at once.
+"""
+
+import Queue
+import sys
+import threading
+
+
+# How long the calling thread blocks on the results queue at a time. Waiting in
+# short slices rather than indefinitely keeps KeyboardInterrupt deliverable.
+POLL_INTERVAL = .2
+
+
+def map_concurrent(fnc, items, concurrency = 1, callback = None):
+    """
+    Call fnc(<item>) for each of <items>, running at most <concurrency> calls
+    at once. Returns a list of (<item>, <result>, <exc_info>) tuples in the
+    order the calls finished; <exc_info> is None unless the call raised.
+
+    If <callback> is given, it is called with the same three arguments as each
+    call finishes. Callbacks always run in the calling thread, so they are free
+    to print progress or update shared state.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    try:
+        concurrency = max(1, min(int(concurrency), len(items)))
+    except (TypeError, ValueError):
+        concurrency = 1
+
+    pending = Queue.Queue()
+    finished = Queue.Queue()
+    for item in items:
+        pending.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                finished.put((item, fnc(item), None))
+            except Exception:
+                finished.put((item, None, sys.exc_info()))
+
+    for i in range(concurrency):
+        t = threading.Thread(target = worker)
+        t.daemon = True
+        t.start()
+
+    results = []
+    try:
+        while len(results) < len(items):
+            try:
+                r = finished.get(timeout = POLL_INTERVAL)
+            except Queue.Empty:
+                continue
+            results.append(r)
+            if callback:
+                callback(*r)
+    except KeyboardInterrupt:
+        # Don't start anything new; calls already in flight are left to finish
+        # on their own in the background.
+        while True:
+            try:
+                pending.get_nowait()
+            except Queue.Empty:
+                break
+        raise
+    return results
+
+
+class ThreadPool(object):
+    """
+    A fixed set of <size> worker threads that live for as long as the pool
+    does, so that repeated batches of work don't pay for starting threads.
+    """
+
+    def __init__(self, size):
+        self.size = max(1, int(size))
+        self.tasks = Queue.Queue()
+        self.threads = []
+
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            fnc, item, done = task
+            try:
+                r = (item, fnc(item), None)
+            except Exception:
+                r = (item, None, sys.exc_info())
+            done(*r)
+            # Don't keep the result alive while waiting for the next task.
+            task = item = r = None
+
+
+    def submit(self, fnc, item, done):
+        """
+        Queue a call to fnc(<item>) and return immediately. When the call
+        finishes, done(<item>, <result>, <exc_info>) is called from the worker
+        thread that ran it.
+        """
+        while len(self.threads) < self.size:
+            t = threading.Thread(target = self._work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        self.tasks.put((fnc, item, done))
+
+
+    def map(self, fnc, items, callback = None):
+        """
+        As map_concurrent(), but using the pool's threads.
+        """
+        items = list(items)
+        finished = Queue.Queue()
+        for item in items:
+            self.submit(fnc, item, lambda *r: finished.put(r))
+
+        results = []
+        while len(results) < len(items):
+            try:
+                r = finished.get(timeout = POLL_INTERVAL)
+            except Queue.Empty:
+                continue
+            results.append(r)
+            if callback:
+                callback(*r)
+        return results
+
+
+    def close(self):
+        """
+        Let the worker threads exit once they have finished their current
+        work.
+        """
+        for t in self.threads:
+            self.tasks.put(None)
+        self.threads = []
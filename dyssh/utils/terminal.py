@@ -2,6 +2,8 @@
 Terminal utilities and formatting goodness.
 """
 
+import errno
+import subprocess
 import sys
 import warnings
 
@@ -63,6 +65,42 @@ def warn(prefix = '(dyssh) ', text  = '', lvl = 0):
     warnings.warn(tocolor(prefix, color) + text)
 
 
+def page(pieces, pager, batch_size = 65536):
+    """
+    Feed the strings produced by the iterable <pieces> to the shell command
+    <pager> as they are generated, so that the pager can show its first screen
+    before all of the text exists. Writes are collected into batches of about
+    <batch_size> bytes. Stops early if the pager is closed.
+    """
+    proc = subprocess.Popen(pager, shell = True, stdin = subprocess.PIPE)
+    batch = []
+    batched = 0
+    try:
+        for piece in pieces:
+            batch.append(piece)
+            batched += len(piece)
+            if batched >= batch_size:
+                proc.stdin.write(''.join(batch))
+                batch = []
+                batched = 0
+        proc.stdin.write(''.join(batch))
+    except IOError, e:
+        # The user quit the pager before reaching the end.
+        if e.errno != errno.EPIPE:
+            raise
+    except KeyboardInterrupt:
+        pass
+    try:
+        proc.stdin.close()
+    except IOError:
+        pass
+    while True:
+        try:
+            return proc.wait()
+        except KeyboardInterrupt:
+            pass
+
+
 def format_columns(headers, output, padlength = 4):
     """
     Format <output> (a list of tuples) neatly underneath the titles provided by
@@ -0,0 +1,218 @@
+"""
+Tests for the job engine, run against stand-in channels.
+"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'dyssh'))
+
+import backends
+import jobs
+import output
+
+
+class FakeChannel(object):
+    """
+    Stands in for a paramiko channel that sends <data> and then exits with
+    <exitcode>. A pipe provides the descriptor the engine waits on. Unless
+    <finished>, the command carries on until it is killed.
+    """
+
+    def __init__(self, data = '', exitcode = 0, finished = True):
+        self.pending = data
+        self.exitcode = exitcode
+        self.finished = finished
+        self.eof_received = finished and not data
+        self.closed = False
+        self._r, self._w = os.pipe()
+        if data or finished:
+            os.write(self._w, '.')
+
+
+    def settimeout(self, timeout):
+        pass
+
+
+    def fileno(self):
+        return self._r
+
+
+    def recv_ready(self):
+        return bool(self.pending)
+
+
+    def recv(self, n):
+        data, self.pending = self.pending[:n], self.pending[n:]
+        if not self.pending and self.finished:
+            os.read(self._r, 1)
+            self.eof_received = True
+        return data
+
+
+    def recv_stderr_ready(self):
+        return False
+
+
+    def recv_stderr(self, n):
+        return ''
+
+
+    def exit_status_ready(self):
+        return self.finished
+
+
+    def recv_exit_status(self):
+        return self.exitcode
+
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            os.close(self._r)
+            os.close(self._w)
+
+
+class BrokenJob(jobs.Job):
+    """
+    A job whose transport goes away as it finishes.
+    """
+
+    def finish(self, exitcode = None):
+        raise EOFError('transport closed')
+
+
+def job(host, job_class = jobs.Job, **kwargs):
+    history = {'output': output.OutputBuffer()}
+    return job_class(host, FakeChannel(**kwargs), history)
+
+
+class JobEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.errors = []
+        self.output = []
+        self.engine = jobs.JobEngine(
+            on_output = lambda host, history, data:
+                self.output.append((host, data)),
+            on_error = self.errors.append)
+
+
+    def test_output_and_exit_codes(self):
+        a = job('a', data = 'hello', exitcode = 0)
+        b = job('b', data = 'x' * (jobs.READ_SIZE + 10), exitcode = 2)
+        self.engine.submit(a)
+        self.engine.submit(b)
+        self.assertEqual(self.engine.wait(timeout = 5), [])
+        self.assertEqual(a.history['exitcode'], 0)
+        self.assertEqual(a.history['output'].getvalue(), 'hello')
+        self.assertEqual(b.history['exitcode'], 2)
+        self.assertEqual(b.history['output'].size, jobs.READ_SIZE + 10)
+        self.assertEqual(''.join(d for h, d in self.output if h == 'b'),
+            'x' * (jobs.READ_SIZE + 10))
+        self.assertEqual(self.engine.running(), [])
+
+
+    def test_kill(self):
+        a = job('a', finished = False)
+        self.engine.submit(a)
+        self.assertEqual(self.engine.wait(timeout = .2), ['a'])
+        self.assertTrue(self.engine.kill('a'))
+        self.assertEqual(self.engine.wait(timeout = 5), [])
+        self.assertEqual(a.history['exitcode'], -1)
+        self.assertTrue(a.chan.closed)
+        self.assertFalse(self.engine.kill('a'))
+
+
+    def test_failed_finish(self):
+        # A job that can't be finished cleanly is counted as stopped, and the
+        # engine carries on with the others.
+        bad = job('bad', BrokenJob)
+        good = job('good', data = 'ok')
+        self.engine.submit(bad)
+        self.engine.submit(good)
+        self.assertEqual(self.engine.wait(timeout = 5), [])
+        self.assertEqual(bad.history['exitcode'], -1)
+        self.assertTrue(bad.chan.closed)
+        self.assertEqual(good.history['exitcode'], 0)
+        self.assertEqual(len(self.errors), 1)
+        self.assertTrue('bad' in self.errors[0])
+        self.assertTrue(self.engine.thread.is_alive())
+        later = job('later')
+        self.engine.submit(later)
+        self.assertEqual(self.engine.wait(timeout = 5), [])
+        self.assertEqual(later.history['exitcode'], 0)
+
+
+    def test_detach_and_resubmit(self):
+        a = job('a', data = 'hello', finished = False)
+        self.engine.submit(a)
+        self.assertEqual(self.engine.wait(timeout = .2), ['a'])
+        self.assertTrue(self.engine.detach('a') is a)
+        self.assertEqual(self.engine.running(), [])
+        self.assertTrue(self.engine.detach('a') is None)
+        # Handed back once its output has all been read, as join does.
+        a.chan.recv(100)
+        a.chan.finished = True
+        a.eof = True
+        self.engine.submit(a)
+        self.assertEqual(self.engine.wait(timeout = 5), [])
+        self.assertEqual(a.history['exitcode'], 0)
+
+
+    def test_listeners_run_before_wait_returns(self):
+        heard = []
+
+        def finished(host, history):
+            time.sleep(.2)
+            heard.append(host)
+
+        self.engine.on_finish = finished
+        self.engine.submit(job('a'))
+        self.assertEqual(self.engine.wait(timeout = 5), [])
+        self.assertEqual(heard, ['a'])
+
+
+class ProcessBackendTest(unittest.TestCase):
+    """
+    The parent's side of the process backend, without any workers.
+    """
+
+    def setUp(self):
+        self.heard = []
+        self.backend = backends.ProcessBackend.__new__(
+            backends.ProcessBackend)
+        self.backend.conns = self
+        self.backend.jobs = {}
+        self.backend.lock = threading.Lock()
+        self.backend.changed = threading.Condition(self.backend.lock)
+
+
+    def _job_finished(self, host, history):
+        time.sleep(.2)
+        self.heard.append((host, history['exitcode']))
+
+
+    def test_listeners_run_before_wait_returns(self):
+        history = {'output': output.OutputBuffer()}
+        self.backend.jobs[1] = ('a', history)
+        t = threading.Thread(target = self.backend._done, args = ('a', 1, 3))
+        t.start()
+        try:
+            self.assertEqual(self.backend.wait(timeout = 5), [])
+            self.assertEqual(self.heard, [('a', 3)])
+        finally:
+            t.join()
+
+
+    def test_unknown_jobs_are_ignored(self):
+        self.backend._done('a', 1, 0)
+        self.assertEqual(self.heard, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+"""
+Tests for JSONLinesWriter, on its own and as the finish listener of a job
+engine.
+"""
+
+import StringIO
+import base64
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'dyssh'))
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+import jobs
+import output
+import records
+
+from test_jobs import FakeChannel
+
+
+def history(command, data, stderr = None, exitcode = 0):
+    buf = output.OutputBuffer()
+    buf.write(data)
+    hist = records.Record(command, buf)
+    if stderr is not None:
+        hist['stderr'] = output.OutputBuffer()
+        hist['stderr'].write(stderr)
+    hist['exitcode'] = exitcode
+    return hist
+
+
+class JSONLinesWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = 'dyssh-test-')
+        self.out = StringIO.StringIO()
+        self.writer = output.JSONLinesWriter(self.out, inline_limit = 10,
+            directory = os.path.join(self.dir, 'output'))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def records(self):
+        self.writer.close()
+        return [json.loads(line) for line in
+            self.out.getvalue().splitlines()]
+
+
+    def test_inline_output(self):
+        hist = history('uptime', 'up 3 days', stderr = '', exitcode = 1)
+        self.writer.finish('web1', hist)
+        record, = self.records()
+        self.assertEqual(record['host'], 'web1')
+        self.assertEqual(record['command'], 'uptime')
+        self.assertEqual(record['exitcode'], 1)
+        self.assertEqual(record['stdout'], 'up 3 days')
+        self.assertEqual(record['stdout_bytes'], 9)
+        self.assertEqual(record['stderr'], '')
+        self.assertEqual(record['stderr_bytes'], 0)
+        self.assertEqual(record['started'], hist['timestamp'].isoformat())
+
+
+    def test_binary_output(self):
+        self.writer.finish('web1', history('cat', '\xff\xfe\x00'))
+        record, = self.records()
+        self.assertFalse('stdout' in record)
+        self.assertEqual(base64.b64decode(record['stdout_base64']),
+            '\xff\xfe\x00')
+        self.assertFalse('stderr_bytes' in record)
+
+
+    def test_large_output_goes_to_a_file(self):
+        data = 'x' * 11
+        self.writer.finish('root:secret@web1', history('cat', data))
+        self.writer.finish('root:secret@web1', history('cat', data))
+        first, second = self.records()
+        self.assertFalse('stdout' in first)
+        self.assertEqual(first['stdout_bytes'], 11)
+        self.assertNotEqual(first['stdout_file'], second['stdout_file'])
+        self.assertTrue(os.path.basename(first['stdout_file']).startswith(
+            'web1-'))
+        with open(first['stdout_file'], 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+
+    def test_failed(self):
+        self.writer.failed('web1', 'Connection refused')
+        self.writer.failed('web2')
+        first, second = self.records()
+        self.assertEqual(first, {'host': 'web1', 'exitcode': None,
+            'error': 'Connection refused'})
+        self.assertEqual(second['error'], 'The command was not started')
+        self.assertEqual(self.writer.seen, set(['web1', 'web2']))
+
+
+    def test_passwords_are_left_out(self):
+        self.writer.finish('root:secret@web1', history('ls', ''))
+        self.writer.failed('root:secret@web2', 'Connection refused')
+        # A record that can't be made still says which host it was for.
+        self.writer.finish('root:secret@web3', None)
+        self.assertFalse('secret' in self.out.getvalue())
+        hosts = [r['host'] for r in self.records()]
+        self.assertEqual(hosts, ['root@web1', 'root@web2', 'root@web3'])
+        self.assertFalse('secret' in self.out.getvalue())
+
+
+    def test_timings(self):
+        class Timings(object):
+            def host(self, host):
+                return {'connect': 0.5, 'command': 0.1}
+        self.writer.timings = Timings()
+        hist = history('ls', '')
+        hist['timings'] = {'command': 0.25}
+        self.writer.finish('web1', hist)
+        record, = self.records()
+        self.assertEqual(record['timings'], {'connect': 0.5, 'command': 0.25})
+
+
+    def test_every_job_is_recorded(self):
+        # The engine calls the writer before wait() returns, so closing the
+        # writer straight afterwards loses none of the records.
+        engine = jobs.JobEngine(on_finish = self.writer.finish)
+        hosts = ['web%d' % i for i in range(20)]
+        for host in hosts:
+            engine.submit(jobs.Job(host, FakeChannel('ok'),
+                records.Record('uptime', output.OutputBuffer())))
+        self.assertEqual(engine.wait(timeout = 5), [])
+        self.assertEqual(sorted(r['host'] for r in self.records()),
+            sorted(hosts))
+
+
+if __name__ == '__main__':
+    unittest.main()
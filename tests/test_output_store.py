@@ -0,0 +1,129 @@
+"""
+Tests for OutputStore and OutputBuffer: the per-buffer and overall memory
+limits, spilling to disk, and reading the output back.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'dyssh'))
+
+import output
+
+
+class OutputBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp(prefix = 'dyssh-test-')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+
+    def test_stays_in_memory_under_the_limit(self):
+        store = output.OutputStore(100, None, self.spill_dir)
+        buf = store.buffer()
+        buf.write('a' * 60)
+        buf.write('b' * 40)
+        self.assertFalse(buf.spilled)
+        self.assertEqual(store.in_memory, 100)
+        self.assertEqual(buf.getvalue(), 'a' * 60 + 'b' * 40)
+
+
+    def test_spills_past_the_buffer_limit(self):
+        store = output.OutputStore(100, None, self.spill_dir)
+        buf = store.buffer()
+        buf.write('a' * 60)
+        buf.write('b' * 60)
+        self.assertTrue(buf.spilled)
+        # The memory it held is given back once it is on disk.
+        self.assertEqual(store.in_memory, 0)
+        self.assertEqual(buf.size, 120)
+        self.assertEqual(buf.getvalue(), 'a' * 60 + 'b' * 60)
+
+
+    def test_spills_when_the_store_runs_out(self):
+        store = output.OutputStore(None, 150, self.spill_dir)
+        first, second = store.buffer(), store.buffer()
+        first.write('a' * 100)
+        second.write('b' * 100)
+        self.assertFalse(first.spilled)
+        self.assertTrue(second.spilled)
+        self.assertEqual(store.in_memory, 100)
+        first.close()
+        self.assertEqual(store.in_memory, 0)
+        # There is room again for new buffers.
+        third = store.buffer()
+        third.write('c' * 100)
+        self.assertFalse(third.spilled)
+
+
+    def test_reads_at_offsets(self):
+        for limit in (None, 10):
+            buf = output.OutputStore(limit, None, self.spill_dir).buffer()
+            buf.write('0123456789')
+            buf.write('abcdefghij')
+            self.assertEqual(buf.read(5, 10), '56789abcde')
+            self.assertEqual(buf.read(15), 'fghij')
+            self.assertEqual(buf.read(25), '')
+
+
+    def test_iterchunks_carries_on_after_the_map(self):
+        buf = output.OutputStore(10, None, self.spill_dir).buffer()
+        buf.write('x' * 25)
+        chunks = buf.iterchunks(10)
+        self.assertEqual(next(chunks), 'x' * 10)
+        # Written after the spill file was mapped.
+        buf.write('y' * 5)
+        self.assertEqual(''.join(chunks), 'x' * 15 + 'y' * 5)
+
+
+    def test_iterlines(self):
+        for limit in (None, 8):
+            buf = output.OutputStore(limit, None, self.spill_dir).buffer()
+            buf.write('one\ntw')
+            buf.write('o\nthree')
+            self.assertEqual(list(buf.iterlines()),
+                ['one\n', 'two\n', 'three'])
+
+
+    def test_long_lines_come_in_pieces(self):
+        buf = output.OutputBuffer()
+        buf.write('x' * (output.CHUNK_SIZE * 2 + 10))
+        pieces = list(buf.iterlines())
+        self.assertTrue(len(pieces) > 1)
+        self.assertTrue(all(len(p) <= output.CHUNK_SIZE * 2 for p in pieces))
+        self.assertEqual(''.join(pieces), 'x' * (output.CHUNK_SIZE * 2 + 10))
+
+
+    def test_digest_is_the_same_either_way(self):
+        in_memory = output.OutputStore(None, None, self.spill_dir).buffer()
+        spilled = output.OutputStore(4, None, self.spill_dir).buffer()
+        for buf in (in_memory, spilled):
+            buf.write('hello ')
+            buf.write('world')
+        self.assertTrue(spilled.spilled)
+        self.assertEqual(in_memory.digest(), spilled.digest())
+
+
+    def test_closed_buffers_take_no_more_output(self):
+        store = output.OutputStore(None, None, self.spill_dir)
+        buf = store.buffer()
+        buf.write('abc')
+        buf.close()
+        buf.write('def')
+        self.assertEqual(buf.size, 0)
+        self.assertEqual(buf.getvalue(), '')
+        self.assertEqual(store.in_memory, 0)
+        # Closing twice gives nothing back twice.
+        buf.close()
+        self.assertEqual(store.in_memory, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
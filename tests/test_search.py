@@ -0,0 +1,196 @@
+"""
+Tests for the output index used by :grep.
+"""
+
+import gc
+import os
+import re
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'dyssh'))
+
+import output
+import records
+import search
+
+
+def history(*pieces, **kwargs):
+    """
+    A record of a command that wrote <pieces>, which has finished unless
+    running is given.
+    """
+    hist = records.Record('cmd', output.OutputBuffer())
+    for piece in pieces:
+        hist['output'].write(piece)
+    if not kwargs.get('running'):
+        hist['exitcode'] = 0
+    return hist
+
+
+class RequiredPiecesTest(unittest.TestCase):
+
+    def test_literals(self):
+        self.assertEqual(search.required_pieces('error'), [('error', False)])
+        self.assertEqual(search.required_pieces('Disk Full'),
+            [('disk', False), ('full', False)])
+
+
+    def test_whole_words(self):
+        # Only the words between two breaks are known to be whole.
+        self.assertEqual(search.required_pieces('no such file'),
+            [('no', False), ('such', True), ('file', False)])
+        self.assertEqual(search.required_pieces(' disk '), [('disk', True)])
+
+
+    def test_digits_are_breaks(self):
+        self.assertEqual(search.required_pieces('eth0 down'),
+            [('eth', False), ('down', False)])
+        self.assertEqual(search.required_pieces(r'\d+'), [])
+        self.assertEqual(search.required_pieces('404'), [])
+
+
+    def test_groups_and_repeats(self):
+        self.assertEqual(search.required_pieces('(?:abc)+def'),
+            [('abc', False), ('def', False)])
+        self.assertEqual(search.required_pieces('(abc)*def'),
+            [('def', False)])
+        self.assertEqual(search.required_pieces('ab?c'),
+            [('a', False), ('c', False)])
+        self.assertEqual(search.required_pieces(r'fail\w*'),
+            [('fail', False)])
+
+
+    def test_branches(self):
+        self.assertEqual(search.required_pieces('foo|bar'), [])
+        self.assertEqual(search.required_pieces('x (foo|bar) y'),
+            [('x', False), ('y', False)])
+
+
+class OutputIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = search.OutputIndex()
+
+
+    def run_command(self, *pieces):
+        """
+        A finished command whose output went through the index.
+        """
+        hist = history(running = True)
+        for piece in pieces:
+            hist['output'].write(piece)
+            self.index.feed('host', hist, piece)
+        hist['exitcode'] = 0
+        self.index.end('host', hist)
+        return hist
+
+
+    def candidates(self, items, pattern):
+        items = [('host%d' % i, h) for i, h in enumerate(items)]
+        return [h for host, h in self.index.candidates(items, pattern)]
+
+
+    def test_rules_out_commands_without_the_words(self):
+        disk = self.run_command('Disk full\n')
+        good = self.run_command('all good\n')
+        self.assertEqual(self.candidates([disk, good], 'disk'), [disk])
+        self.assertEqual(self.candidates([disk, good], 'good|full'),
+            [disk, good])
+        self.assertEqual(self.candidates([disk, good], 'nothing'), [])
+
+
+    def test_words_split_across_pieces(self):
+        hist = self.run_command('the di', 'sk is fu', 'll')
+        self.assertEqual(self.candidates([hist], 'disk'), [hist])
+        self.assertEqual(self.candidates([hist], 'full'), [hist])
+        self.assertEqual(self.candidates([hist], 'di'), [hist])
+        self.assertEqual(self.index.words.get('di'), None)
+
+
+    def test_whole_words(self):
+        disks = self.run_command('two disks\n')
+        self.assertEqual(self.candidates([disks], 'isk'), [disks])
+        self.assertEqual(self.candidates([disks], ' disk '), [])
+        self.assertEqual(self.candidates([disks], ' disks '), [disks])
+
+
+    def test_running_commands_are_always_searched(self):
+        hist = history('nothing to see', running = True)
+        self.assertEqual(self.candidates([hist], 'disk'), [hist])
+
+
+    def test_output_that_was_never_indexed(self):
+        hist = history('disk full')
+        self.assertEqual(self.candidates([hist], 'disk'), [hist])
+        self.assertEqual(self.candidates([hist], 'cpu'), [])
+        self.assertTrue(self.index.entries[id(hist)].complete)
+
+
+    def test_output_that_partly_bypassed_the_index(self):
+        # Output read during a :join goes straight to the buffer.
+        hist = history(running = True)
+        hist['output'].write('first ')
+        self.index.feed('host', hist, 'first ')
+        hist['output'].write('second')
+        hist['exitcode'] = 0
+        self.index.end('host', hist)
+        self.assertEqual(self.candidates([hist], 'second'), [hist])
+        self.assertEqual(self.candidates([hist], 'first'), [hist])
+        self.assertEqual(self.index.entries[id(hist)].size, 12)
+
+
+    def test_separate_stderr(self):
+        hist = history('out')
+        hist['stderr'] = output.OutputBuffer()
+        hist['stderr'].write('err')
+        self.index.feed('host', hist, 'out')
+        self.assertEqual(self.index.entries, {})
+        self.assertEqual(self.candidates([hist], 'err'), [hist])
+        self.assertEqual(self.candidates([hist], 'out'), [hist])
+        self.assertEqual(self.candidates([hist], 'other'), [])
+
+
+    def test_unindexable_output_is_always_searched(self):
+        hist = self.run_command('x' * (search.MAX_WORD + 1))
+        self.assertTrue(self.index.entries[id(hist)].unindexable)
+        self.assertEqual(self.candidates([hist], 'disk'), [hist])
+
+
+    def test_patterns_without_words_search_everything(self):
+        hists = [self.run_command('a'), self.run_command('b')]
+        self.assertEqual(self.candidates(hists, r'\d+'), hists)
+
+
+    def test_forgets_records_that_are_gone(self):
+        hist = self.run_command('disk')
+        self.assertEqual(self.index.words, {'disk': set([id(hist)])})
+        del hist
+        gc.collect()
+        self.assertEqual(self.index.entries, {})
+        self.assertEqual(self.index.words, {})
+
+
+class SearchTest(unittest.TestCase):
+
+    def test_search(self):
+        index = search.OutputIndex()
+        disk = history('ok\nDisk full on /var\nok\r\ndisk full on /tmp\n')
+        good = history('all good\n')
+        hist = history('out\n')
+        hist['stderr'] = output.OutputBuffer()
+        hist['stderr'].write('full disk\n')
+        items = [('a', disk), ('b', good), ('c', hist)]
+        regex = re.compile('(?i)disk')
+        expected = [
+            ('a', disk, [('output', 2, 'Disk full on /var'),
+                ('output', 4, 'disk full on /tmp')]),
+            ('c', hist, [('stderr', 1, 'full disk')]),
+        ]
+        self.assertEqual(search.search(items, regex), expected)
+        self.assertEqual(search.search(items, regex, index), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+"""
+Tests for the sync deltas: the rolling checksum match in delta(), and
+rebuilding files from the encoded instructions with the real remote helper.
+"""
+
+import hashlib
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'dyssh'))
+
+import sync
+
+
+BLOCK = 1024
+
+
+def noise(n, seed = 0):
+    r = random.Random(seed)
+    return ''.join(chr(r.randint(0, 255)) for i in xrange(n))
+
+
+def signature(data, block = BLOCK):
+    """
+    The signature of <data>, made the way the helper makes it.
+    """
+    sig = []
+    for i in xrange(0, len(data), block):
+        d = data[i:i + block]
+        sig.append(struct.pack('>I', zlib.adler32(d) & 0xffffffff))
+        sig.append(hashlib.md5(d).digest())
+    return ''.join(sig)
+
+
+def apply(ops, old, new, block = BLOCK):
+    """
+    Rebuild a file from <old> using <ops>, taking literal data from <new>.
+    """
+    out = []
+    for op, first, n in ops:
+        if op == 'copy':
+            out.append(old[first * block:(first + n) * block])
+        else:
+            out.append(new[first:first + n])
+    return ''.join(out)
+
+
+class DeltaTest(unittest.TestCase):
+
+    def check(self, old, new):
+        """
+        Return the instructions for turning <old> into <new>, after checking
+        that they do so.
+        """
+        ops = sync.delta(new, signature(old), BLOCK)
+        self.assertEqual(apply(ops, old, new), new)
+        return ops
+
+
+    def literal(self, ops):
+        return sum(n for op, first, n in ops if op == 'data')
+
+
+    def test_unchanged(self):
+        data = noise(BLOCK * 8)
+        self.assertEqual(self.check(data, data), [('copy', 0, 8)])
+
+
+    def test_short_last_block(self):
+        data = noise(BLOCK * 8 + 100)
+        self.assertEqual(self.check(data, data), [('copy', 0, 9)])
+
+
+    def test_changed_byte(self):
+        old = noise(BLOCK * 8)
+        new = old[:BLOCK * 3 + 10] + 'X' + old[BLOCK * 3 + 11:]
+        ops = self.check(old, new)
+        self.assertEqual(ops, [('copy', 0, 3), ('data', BLOCK * 3, BLOCK),
+            ('copy', 4, 4)])
+
+
+    def test_insert(self):
+        # Everything after the insertion is found again by rolling the
+        # checksum along one byte at a time.
+        old = noise(BLOCK * 8)
+        new = old[:BLOCK * 2 + 7] + 'inserted' + old[BLOCK * 2 + 7:]
+        ops = self.check(old, new)
+        self.assertTrue(self.literal(ops) <= BLOCK + len('inserted'))
+        self.assertEqual(ops[-1], ('copy', 3, 5))
+
+
+    def test_delete(self):
+        old = noise(BLOCK * 8)
+        new = old[:BLOCK * 5 + 3] + old[BLOCK * 5 + 40:]
+        ops = self.check(old, new)
+        self.assertEqual(ops[0], ('copy', 0, 5))
+        self.assertEqual(ops[-1], ('copy', 6, 2))
+        self.assertTrue(self.literal(ops) < BLOCK)
+
+
+    def test_append(self):
+        old = noise(BLOCK * 4)
+        new = old + noise(300, seed = 1)
+        self.assertEqual(self.check(old, new),
+            [('copy', 0, 4), ('data', BLOCK * 4, 300)])
+
+
+    def test_moved_blocks(self):
+        old = noise(BLOCK * 4)
+        new = old[BLOCK * 2:] + old[:BLOCK * 2]
+        self.assertEqual(self.check(old, new), [('copy', 2, 2),
+            ('copy', 0, 2)])
+
+
+    def test_short_block_only_matches_at_the_end(self):
+        # The remote file's short last block can't be copied into the middle
+        # of the file, only to its end.
+        old = noise(BLOCK * 2 + 50)
+        tail = old[BLOCK * 2:]
+        ops = self.check(old, tail + old[:BLOCK * 2])
+        self.assertEqual(ops, [('data', 0, 50), ('copy', 0, 2)])
+        ops = self.check(old, old[:BLOCK] + tail)
+        self.assertEqual(ops, [('copy', 0, 1), ('copy', 2, 1)])
+
+
+    def test_no_remote_file(self):
+        new = noise(BLOCK * 3)
+        self.assertEqual(self.check('', new), [('data', 0, BLOCK * 3)])
+
+
+    def test_nothing_in_common(self):
+        old, new = noise(BLOCK * 3), noise(BLOCK * 3, seed = 1)
+        self.assertEqual(self.check(old, new), [('data', 0, BLOCK * 3)])
+
+
+    def test_smaller_than_a_block(self):
+        old = noise(100)
+        self.assertEqual(self.check(old, old), [('copy', 0, 1)])
+        self.assertEqual(self.check(old, old[:50]), [('data', 0, 50)])
+
+
+    def test_encode(self):
+        new = 'abcdef'
+        records = list(sync.encode([('copy', 3, 2), ('data', 1, 4)], new))
+        self.assertEqual(records, ['C' + struct.pack('>II', 3, 2),
+            'D' + struct.pack('>I', 4) + 'bcde', 'E'])
+
+
+    def test_encode_splits_large_literals(self):
+        new = noise(sync.LITERAL_SIZE + 10)
+        records = list(sync.encode([('data', 0, len(new))], new))
+        self.assertEqual(len(records), 3)
+        self.assertEqual(''.join(r[5:] for r in records[:2]), new)
+
+
+class HelperTest(unittest.TestCase):
+    """
+    Runs the helper locally, as sync runs it on each remote host.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = 'dyssh-test-')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def helper(self, args, stdin = ''):
+        p = subprocess.Popen([sys.executable, '-c', sync.HELPER] +
+            [str(a) for a in args], stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE)
+        out = p.communicate(stdin)[0]
+        return p.returncode, out
+
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+
+    def sync(self, old, new, digest = None):
+        """
+        Update a file holding <old> to <new> with the helper, and return the
+        helper's exit status and what the file ends up holding.
+        """
+        remote = self.write('remote', old)
+        local = self.write('local', new)
+        block = sync.block_size(len(new))
+        status, sig = self.helper(['sig', remote, block])
+        self.assertEqual(status, 0)
+        self.assertEqual(sig, signature(old, block))
+        tree = sync.Tree(local, remote)
+        ops, size = tree.delta(local, sig, block)
+        stdin = ''.join(sync.encode(ops, new))
+        self.assertEqual(len(stdin), size)
+        if digest is None:
+            digest = hashlib.sha1(new).hexdigest()
+        status, out = self.helper(['patch', remote, block, digest,
+            remote + '.tmp'], stdin)
+        with open(remote, 'rb') as f:
+            return status, f.read()
+
+
+    def test_patch(self):
+        old = noise(300000)
+        new = old[:1000] + 'changed' + old[1000:200000] + old[210000:] + \
+            'more'
+        self.assertEqual(self.sync(old, new), (0, new))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'remote.tmp')))
+
+
+    def test_patch_with_a_bad_digest(self):
+        old = noise(5000)
+        new = old + 'more'
+        status, data = self.sync(old, new, digest = '0' * 40)
+        self.assertEqual(status, 3)
+        # The remote file is left alone.
+        self.assertEqual(data, old)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'remote.tmp')))
+
+
+    def test_sums(self):
+        path = self.write('file', 'hello')
+        missing = os.path.join(self.dir, 'missing')
+        status, out = self.helper(['sums'],
+            '\0'.join(['5', path, '4', path, '1', missing]))
+        self.assertEqual(status, 0)
+        self.assertEqual(out.splitlines(), ['5 %s' %
+            hashlib.sha1('hello').hexdigest(), '5 -', '- -'])
+
+
+if __name__ == '__main__':
+    unittest.main()